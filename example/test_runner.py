@@ -6,6 +6,7 @@ from inspect import getmembers, ismodule
 from django.conf import settings
 from django.test.simple import run_tests as django_test_runner
 from django.db.models import get_app, get_apps
+from django.db.models.signals import post_syncdb
 
 test_dir = os.path.dirname(__file__)
 sys.path.insert(0, test_dir)
@@ -39,6 +40,13 @@ def get_all_coverage_modules(app_module, exclude_files=[]):
     return mod_list
 
 
+def create_search_index(sender, **kwargs):
+    """Create the full-text table in the test database, even if
+    ``PAGE_SEARCH_INDEX`` is disabled, so both search backends are
+    tested."""
+    from pages.search import install_search_index
+    install_search_index()
+
 def run_tests(test_labels=('pages',), verbosity=1, interactive=True,
         extra_tests=[]):
     cov = coverage()
@@ -46,6 +54,7 @@ def run_tests(test_labels=('pages',), verbosity=1, interactive=True,
     cov.use_cache(0)
     cov.start()
     app = get_app('pages')
+    post_syncdb.connect(create_search_index, sender=app)
     modules = get_all_coverage_modules(app, exclude_files=['auto_render.py'])
     results = django_test_runner(test_labels, verbosity, interactive,
         extra_tests)
@@ -15,9 +15,11 @@ from pages.models import Page, Content, PageAlias
 from pages.http import get_language_from_request, get_template_from_request
 
 from pages.utils import get_placeholders
+from pages.search import search_pages
 from pages.utils import has_page_add_permission, get_language_from_request
 from pages.templatetags.pages_tags import PlaceholderNode
 from pages.admin.utils import get_connected, make_inline_admin
+from pages.admin.utils import get_admin_rows
 from pages.admin.forms import PageForm
 from pages.admin.views import traduction, get_content, sub_menu
 from pages.admin.views import change_status, modify_content, delete_content
@@ -291,10 +293,16 @@ class PageAdmin(admin.ModelAdmin):
         q=request.POST.get('q', '').strip()
 
         if q:
-            page_ids = list(set([c.page.pk for c in Content.objects.filter(body__icontains=q)]))
+            if settings.PAGE_SEARCH_INDEX:
+                page_ids = search_pages(q)
+            else:
+                page_ids = list(Content.objects.filter(body__icontains=q,
+                    current=True).values_list('page', flat=True).distinct())
             pages = Page.objects.filter(pk__in=page_ids)
         else:
             pages = Page.objects.root()
+        # the tree is displayed in the default language
+        pages = get_admin_rows(pages.select_related('author'), request)
 
         context = {
             'language': language,
@@ -326,7 +334,6 @@ class PageAdmin(admin.ModelAdmin):
                 # to display this message
                 # _('Page could not been moved.')
             else:
-                page.invalidate()
                 target.invalidate()
                 page.move_to(target, position)
                 return self.list_pages(request,
@@ -48,9 +48,9 @@ class PageForm(forms.ModelForm):
         
         if settings.PAGE_UNIQUE_SLUG_REQUIRED:
             if self.instance.id:
-                if Content.objects.exclude(page=self.instance).filter(body=slug, type="slug").count():
+                if Content.objects.exclude(page=self.instance).filter(body=slug, type="slug", current=True).count():
                     raise forms.ValidationError(_('Another page with this slug already exists'))
-            elif Content.objects.filter(body=slug, type="slug").count():
+            elif Content.objects.filter(body=slug, type="slug", current=True).count():
                 raise forms.ValidationError(_('Another page with this slug already exists'))
 
         if not settings.PAGE_UNIQUE_SLUG_REQUIRED:
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import urllib
 from pages import settings
 from django.contrib import admin
 from django.forms import ModelForm
@@ -6,7 +7,7 @@ from django.core.urlresolvers import get_mod_func
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
-from pages.models import Page, Content
+from pages.models import Page, Content, PageLink
 from pages.utils import get_placeholders
 
 def get_connected():
@@ -42,3 +43,63 @@ def make_inline_admin(model_class, options):
         max_num = options.get('max_num', 0)
     return ModelOptions
 
+def get_expanded_ids(request):
+    """Return the set of the ids of the pages expanded in the admin tree,
+    stored by the javascript in the ``tree_expanded`` cookie."""
+    cookie = urllib.unquote(request.COOKIES.get('tree_expanded', ''))
+    return set([int(page_id) for page_id in cookie.split(',')
+        if page_id.isdigit()])
+
+def get_admin_rows(pages, request):
+    """Return the rows of the admin tree: every page followed by the
+    descendants displayed by its expanded children, in tree order. The
+    rows are annotated for the ``admin/pages/page/row.html`` template
+    with a constant number of queries:
+
+    * ``admin_has_children``, ``True`` if the page has children,
+    * ``admin_expanded``, ``True`` if the children of the page are
+      displayed,
+    * ``admin_permission``, ``True`` if the user has the permission on
+      the page, the row is not displayed otherwise,
+    * ``admin_languages``, a ``(language, name, has content)`` tuple per
+      language,
+
+    and their slug, url and broken link flag are loaded.
+
+    :param pages: the pages at the top of the tree.
+    :param request: the request of the admin user.
+    """
+    expanded = get_expanded_ids(request)
+    children = {}
+    if expanded:
+        for child in Page.objects.filter(parent__in=expanded).select_related(
+                'author').order_by('tree_id', 'lft'):
+            children.setdefault(child.parent_id, []).append(child)
+    rows = []
+    stack = list(pages)
+    stack.reverse()
+    while stack:
+        page = stack.pop()
+        rows.append(page)
+        page.admin_has_children = page.rght - page.lft > 1
+        page.admin_expanded = page.admin_has_children and page.id in expanded
+        if page.admin_expanded:
+            stack.extend(reversed(children.get(page.id, [])))
+    if not rows:
+        return rows
+    page_ids = [page.id for page in rows]
+    Content.objects.prefetch_for_pages(rows, ('slug', ),
+        settings.PAGE_DEFAULT_LANGUAGE)
+    if settings.PAGE_LINK_FILTER:
+        PageLink.objects.prefetch_broken_links(rows)
+    languages = set(Content.objects.filter(page__in=page_ids,
+        current=True).values_list('page', 'language').distinct())
+    permission = 'All'
+    if settings.PAGE_PERMISSION:
+        from pages.models import PagePermission
+        permission = PagePermission.objects.get_page_id_list(request.user)
+    for page in rows:
+        page.admin_permission = permission == 'All' or page in permission
+        page.admin_languages = [(code, name, (page.id, code) in languages)
+            for (code, name) in settings.PAGE_LANGUAGES]
+    return rows
@@ -8,6 +8,7 @@ from pages import settings
 from pages.models import Page, Content
 from pages.utils import get_placeholders
 from pages.http import auto_render
+from pages.admin.utils import get_admin_rows
 #from pages.admin.utils import set_body_pagelink, delete_body_pagelink_by_language
 
 def change_status(request, page_id):
@@ -68,8 +69,18 @@ traduction = auto_render(traduction)
 
 def get_content(request, page_id, content_id):
     """Get the content for a particular page"""
-    content_instance = get_object_or_404(Content, pk=content_id)
-    return HttpResponse(content_instance.body)
+    try:
+        content_id = int(content_id)
+    except ValueError:
+        raise Http404
+    try:
+        content_instance = Content.objects.get(pk=content_id)
+    except Content.DoesNotExist:
+        # the revision could have been pruned
+        content_instance = Content.objects.get_archived_content(content_id)
+        if content_instance is None:
+            raise Http404
+    return HttpResponse(Content.objects.get_revision_body(content_instance))
 get_content = staff_member_required(get_content)
 get_content = auto_render(get_content)
 
@@ -77,9 +88,7 @@ def sub_menu(request, page_id):
     """Render the children of the requested page with the sub_menu
     template."""
     page = Page.objects.get(id=page_id)
-    pages = page.children.all()
-    has_permission = page.has_page_permission(request)
-    page_languages = settings.PAGE_LANGUAGES
+    pages = get_admin_rows(page.children.select_related('author'), request)
     return "admin/pages/page/sub_menu.html", locals()
     
 sub_menu = staff_member_required(sub_menu)
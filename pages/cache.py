@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""Two tiers cache for the page data: a cache living in the memory of the
+process in front of the Django cache.
+
+The keys stored in this cache have to be versioned with
+:meth:`Page.get_cache_key <pages.models.Page.get_cache_key>`: the value
+of a key never changes, a new generation of the key is used instead. The
+generations are always read from the Django cache so the local tier can't
+serve data that has been invalidated by another process.
+
+This module also provides the :class:`IdentityMap` of the page lookups
+made during a request, the :class:`TemplateCache` of the parsed
+placeholders and the cache of the responses of the ``details`` view."""
+import threading, time
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template import Template, TemplateSyntaxError
+from django.template.defaulttags import CycleNode, IfChangedNode
+from django.template.loader_tags import BlockNode
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from pages import settings
+
+# the generation counters should outlive the keys they namespace
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+def new_generation():
+    """Return a new generation number. The numbers are based on the time
+    so a counter that has been evicted from the cache never restarts
+    from a generation that has already been used."""
+    return int(time.time() * 1000)
+
+def get_generations(keys):
+    """Return a dictionnary of the generation counters stored under the
+    given cache keys with a single cache lookup. The missing counters
+    are created.
+
+    :param keys: a list of cache keys.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if generations.get(key) is None:
+            generations[key] = new_generation()
+            cache.add(key, generations[key], GENERATION_TIMEOUT)
+    return generations
+
+def incr_generation(key):
+    """Start a new generation of the counter stored under ``key``: every
+    cache key built with the previous generation becomes unreachable.
+    Return the new generation, or ``None`` if the counter was missing.
+
+    :param key: the cache key of the counter.
+    """
+    try:
+        generation = cache.incr(key)
+    except ValueError:
+        generation = None
+    # memcached returns None for missing keys
+    if generation is None:
+        cache.set(key, new_generation(), GENERATION_TIMEOUT)
+    return generation
+
+
+class LocalCache(object):
+    """A least recently used cache bounded in number of entries and in
+    time, a ``None`` timeout meaning no time limit. The entries are kept
+    in a circular doubly linked list of ``[previous, next, key, value,
+    expires]`` lists, the least recently used entry being the first
+    one."""
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove every entry."""
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        # the entry becomes the most recently used one
+        last = self._root[0]
+        entry[0], entry[1] = last, self._root
+        last[1] = self._root[0] = entry
+
+    def _unlink(self, entry):
+        entry[0][1], entry[1][0] = entry[1], entry[0]
+
+    def get(self, key, default=None):
+        """Return the value of ``key`` or ``default`` if the key is
+        missing or expired."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            if entry[4] is not None and entry[4] < time.time():
+                del self._entries[key]
+                return default
+            self._link(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """Set the value of ``key``, evicting the least recently used
+        entry if the cache is full."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self._entries) >= self.max_entries:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._entries[oldest[2]]
+            expires = None
+            if self.timeout is not None:
+                expires = time.time() + self.timeout
+            entry = [None, None, key, value, expires]
+            self._link(entry)
+            self._entries[key] = entry
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PageCache(object):
+    """The two tiers cache. The ``local_hits``, ``shared_hits`` and
+    ``misses`` counters are updated on every lookup."""
+
+    def __init__(self, max_entries, timeout):
+        if max_entries:
+            self.local = LocalCache(max_entries, timeout)
+        else:
+            self.local = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the hit and miss counters."""
+        self.local_hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        """Return the hit and miss counters as a dictionnary."""
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+        }
+
+    def get(self, key):
+        """Return the value of ``key`` or ``None`` if it is in none of the
+        tiers."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return a dictionnary of the values found for ``keys``. The
+        keys missing in the local tier are fetched from the Django cache
+        with a single lookup."""
+        values = {}
+        missing = []
+        for key in keys:
+            value = None
+            if self.local is not None:
+                value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        self.local_hits += len(values)
+        if missing:
+            shared = cache.get_many(missing)
+            for key, value in shared.items():
+                if value is None:
+                    continue
+                values[key] = value
+                self.shared_hits += 1
+                if self.local is not None:
+                    self.local.set(key, value)
+            self.misses += len(keys) - len(values)
+        return values
+
+    def set(self, key, value):
+        """Set the value of ``key`` in both tiers."""
+        cache.set(key, value)
+        if self.local is not None:
+            self.local.set(key, value)
+
+page_cache = PageCache(settings.PAGE_LOCAL_CACHE_MAX_ENTRIES,
+    settings.PAGE_LOCAL_CACHE_TIMEOUT)
+
+
+# the nodes that keep a state between two renders: a template that
+# contains them can't be shared by the requests and the threads
+STATEFUL_NODES = (CycleNode, IfChangedNode, BlockNode)
+
+class TemplateCache(object):
+    """A bounded cache of the templates compiled from the body of the
+    parsed placeholders, keyed by a hash of the body. The syntax errors
+    are cached as well, the templates that contain one of the
+    :data:`STATEFUL_NODES` are not. ``compile_times`` holds the duration
+    of the last compilation of every placeholder, in seconds."""
+
+    def __init__(self, max_entries):
+        if max_entries:
+            self.templates = LocalCache(max_entries, None)
+        else:
+            self.templates = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the hit and miss counters and the compile times."""
+        self.hits = self.misses = self.errors = 0
+        self.compile_times = {}
+
+    def stats(self):
+        """Return the hit, miss and syntax error counters and the compile
+        times as a dictionnary."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'compile_times': dict(self.compile_times),
+        }
+
+    def get_template(self, body, name):
+        """Return the template compiled from ``body``. Raise
+        ``TemplateSyntaxError`` if the body is not a valid template.
+
+        :param body: the body of the placeholder.
+        :param name: the name of the placeholder.
+        """
+        key = md5_constructor(smart_str(body)).hexdigest()
+        compiled = None
+        if self.templates is not None:
+            compiled = self.templates.get(key)
+        if compiled is None:
+            self.misses += 1
+            start = time.time()
+            try:
+                compiled = Template(body, name=name)
+            except TemplateSyntaxError, error:
+                compiled = error
+            self.compile_times[name] = time.time() - start
+            if self.templates is not None and not (
+                    isinstance(compiled, Template) and
+                    compiled.nodelist.get_nodes_by_type(STATEFUL_NODES)):
+                self.templates.set(key, compiled)
+        else:
+            self.hits += 1
+        if isinstance(compiled, TemplateSyntaxError):
+            self.errors += 1
+            raise compiled
+        return compiled
+
+template_cache = TemplateCache(settings.PAGE_PARSED_CACHE_MAX_ENTRIES)
+
+class IdentityMap(object):
+    """The pages and the page contents loaded during a request, by id and
+    by path, so a page is loaded only once when several template tags
+    refer to it. See :func:`get_identity_map`."""
+
+    def __init__(self):
+        self.pages = {}
+        self.paths = {}
+        self.contents = {}
+        self.first_root_id = None
+        # the page displayed by the view and the pages whose content,
+        # other than the title and the slug, has been displayed
+        self.current_page = None
+        self.displayed_page_ids = set()
+        # the ETag and the Last-Modified date of the response
+        self.validators = None
+        # the navigations by site and language
+        self.navigations = {}
+
+    def add_page(self, page):
+        """Register a page loaded by other means. Return the page."""
+        self.pages[page.id] = page
+        return page
+
+    def get_page(self, page_id):
+        """Return the page ``page_id``. Raise ``Page.DoesNotExist`` if the
+        page doesn't exist."""
+        from pages.models import Page
+        if page_id not in self.pages:
+            try:
+                self.pages[page_id] = Page.objects.get(pk=page_id)
+            except Page.DoesNotExist:
+                self.pages[page_id] = None
+        if self.pages[page_id] is None:
+            raise Page.DoesNotExist
+        return self.pages[page_id]
+
+    def get_page_from_path(self, path, lang, exclude_drafts=True):
+        """Return the page found by
+        :meth:`PageManager.from_path <pages.managers.PageManager.from_path>`
+        for these arguments."""
+        from pages.models import Page
+        key = (path, lang, exclude_drafts)
+        if key not in self.paths:
+            page = Page.objects.from_path(path, lang,
+                exclude_drafts=exclude_drafts)
+            if page:
+                page = self.pages.setdefault(page.id, page)
+            self.paths[key] = page
+        return self.paths[key]
+
+    def get_first_root_id(self):
+        """Return the id of the first root page."""
+        from pages.models import Page
+        if self.first_root_id is None:
+            self.first_root_id = Page.objects.root()[0].id
+        return self.first_root_id
+
+    def forget_page(self, page_id):
+        """Forget the content of a page after a modification."""
+        self.contents.pop(page_id, None)
+
+    def clear(self):
+        """Forget everything, e.g. after a modification of the tree."""
+        self.__init__()
+
+_local = threading.local()
+
+def get_identity_map():
+    """Return the identity map of the current request or ``None`` if no
+    map is installed for this thread."""
+    return getattr(_local, 'identity_map', None)
+
+def start_identity_map():
+    """Install a new identity map for the current thread. The publication
+    transitions that have happened since the previous request are fired
+    first, see :func:`pages.schedule.check_transitions`."""
+    from pages.schedule import check_transitions
+    check_transitions()
+    _local.identity_map = IdentityMap()
+    return _local.identity_map
+
+def end_identity_map():
+    """Remove the identity map of the current thread."""
+    _local.identity_map = None
+
+def get_page(page_id):
+    """Return the page ``page_id`` through the identity map of the current
+    request if there is one. Raise ``Page.DoesNotExist`` if the page
+    doesn't exist."""
+    from pages.models import Page
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return Page.objects.get(pk=page_id)
+    return identity_map.get_page(page_id)
+
+def get_page_from_path(path, lang, exclude_drafts=True):
+    """Return the page found by
+    :meth:`PageManager.from_path <pages.managers.PageManager.from_path>`
+    through the identity map of the current request if there is one."""
+    from pages.models import Page
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return Page.objects.from_path(path, lang,
+            exclude_drafts=exclude_drafts)
+    return identity_map.get_page_from_path(path, lang, exclude_drafts)
+
+RESPONSE_KEY = "page_response_%s"
+
+def get_response_key(request, lang):
+    """Return the cache key of the response to a request for a page.
+
+    :param request: the request object.
+    :param lang: the language of the response.
+    """
+    key = '%s:%s:%s:%d' % (settings.SITE_ID, lang, request.path,
+        request.is_ajax())
+    return RESPONSE_KEY % md5_constructor(smart_str(key)).hexdigest()
+
+def get_response_headers(response):
+    """Return the list of the validation and caching headers of a response
+    to keep with its content."""
+    return [(header, response[header]) for header in ('ETag',
+        'Last-Modified', 'Cache-Control', 'Vary',
+        settings.PAGE_SURROGATE_KEY_HEADER) if response.has_header(header)]
+
+def get_cached_response(key):
+    """Return the response stored under ``key`` or ``None`` if there is
+    none, if it has expired or if one of the pages it depends on has been
+    invalidated since. No database query is made.
+
+    :param key: the key returned by :func:`get_response_key`.
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry['expires'] <= datetime.now():
+        return None
+    if get_generations(entry['stamps'].keys()) != entry['stamps']:
+        return None
+    response = HttpResponse(entry['content'],
+        content_type=entry['content_type'])
+    for header, value in entry.get('headers', ()):
+        response[header] = value
+    return response
+
+def set_cached_response(key, response, page, stamps, page_ids=()):
+    """Store a response until the next publication transition or
+    ``PAGE_RESPONSE_CACHE_TIMEOUT``. The response is valid as long as the
+    page, its ancestors, its tree, the other pages used by the response
+    and the navigation are not invalidated.
+
+    :param key: the key returned by :func:`get_response_key`.
+    :param response: the response object.
+    :param page: the page displayed by the response.
+    :param stamps: the generations read before the rendering.
+    :param page_ids: the ids of the other pages used by the response.
+    """
+    from pages.models import Page
+    from pages.schedule import get_next_transition
+    page_ids = set(page_ids)
+    page_ids.update([p.id for p in page.get_ancestors()] + [page.id])
+    stamps = dict(stamps)
+    stamps.update(get_generations(
+        [Page.PAGE_GENERATION_KEY % page_id for page_id in page_ids] +
+        [Page.PAGE_TREE_GENERATION_KEY % page.tree_id]))
+    now = datetime.now()
+    expires = now + timedelta(seconds=settings.PAGE_RESPONSE_CACHE_TIMEOUT)
+    transition = get_next_transition(now)
+    if transition is not None and transition < expires:
+        expires = transition
+    delta = expires - now
+    timeout = delta.days * 86400 + delta.seconds + 1
+    cache.set(key, {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'headers': get_response_headers(response),
+        'stamps': stamps,
+        'expires': expires,
+    }, timeout)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Export of the published pages to a tree of static files.
+
+Every published page is rendered, in every language and on every site,
+through the :func:`details <pages.views.details>` view, into
+``<directory>/<site domain>/<page url>/index.html`` with a gzipped
+``index.html.gz`` sibling that a web server can serve directly. Without
+``PAGE_USE_LANGUAGE_PREFIX`` the urls of the languages are the same: the
+default language is written to ``index.html`` and the others to
+``index.html.<language>``.
+
+A manifest of the exported files and of their hash is kept in the
+directory so the files whose content hasn't changed are not written
+again, and so an incremental export only renders the pages modified since
+the previous export."""
+import os, gzip
+from datetime import datetime
+from django.conf import settings as django_settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection
+from django.http import Http404
+from django.utils import simplejson, translation
+from django.utils.hashcompat import md5_constructor
+
+from pages import settings
+from pages.models import Page, Content
+
+MANIFEST_NAME = '.pages-export'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def get_sites():
+    """Return the sites to export."""
+    if settings.PAGE_USE_SITE_ID:
+        return list(Site.objects.all())
+    return [Site.objects.get(pk=settings.SITE_ID)]
+
+def set_site(site_id):
+    """Make ``site_id`` the current site of the page queries."""
+    django_settings.SITE_ID = settings.SITE_ID = site_id
+
+def get_navigation_hash(pages):
+    """Return a hash of the tree, the status, the titles and the slugs of
+    the published pages. Every exported page displays them in its menus,
+    a new hash means that every page has to be exported again."""
+    page_ids = [page.id for page in pages]
+    rows = [(page.id, page.parent_id, page.tree_id, page.lft, page.rght)
+        for page in pages]
+    rows.extend(Content.objects.filter(page__in=page_ids,
+        type__in=('title', 'slug'), current=True).order_by('page', 'type',
+        'language').values_list('page', 'type', 'language', 'body'))
+    return md5_constructor(repr(rows)).hexdigest()
+
+def get_file_name(page, lang):
+    """Return the name of the file of a page, relative to the directory
+    of its site."""
+    name = page.get_absolute_url(lang).strip('/')
+    name = os.path.join(*(name.split('/') + ['index.html']))
+    if (not settings.PAGE_USE_LANGUAGE_PREFIX
+            and lang != settings.PAGE_DEFAULT_LANGUAGE):
+        name += '.' + lang
+    return name
+
+def render_page(site, page_id, lang, url, path):
+    """Render a page through the ``details`` view as an anonymous user.
+    Return the response."""
+    from pages.views import details
+    set_site(site.id)
+    translation.activate(lang)
+    request = WSGIRequest({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': url,
+        'SERVER_NAME': site.domain,
+        'SERVER_PORT': '80',
+        'HTTP_HOST': site.domain,
+    })
+    request.user = AnonymousUser()
+    request.LANGUAGE_CODE = lang
+    try:
+        return details(request, path=path, lang=lang)
+    finally:
+        translation.deactivate()
+
+def write_file(file_name, content):
+    """Write a file and its gzipped sibling. The files are renamed into
+    place so the web server never serves a partial file."""
+    directory = os.path.dirname(file_name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_name = file_name + '.tmp'
+    temp_file = open(temp_name, 'wb')
+    try:
+        temp_file.write(content)
+    finally:
+        temp_file.close()
+    os.rename(temp_name, file_name)
+    temp_file = gzip.open(temp_name, 'wb', 9)
+    try:
+        temp_file.write(content)
+    finally:
+        temp_file.close()
+    os.rename(temp_name, file_name + '.gz')
+
+def export_page(job):
+    """Render and write a page. Return the name of the file, the hash of
+    its content, ``None`` if the page couldn't be rendered, and whether
+    the file has been written.
+
+    :param job: a ``(directory, site, page id, language, url, path, file
+        name, previous hash)`` tuple.
+    """
+    directory, site, page_id, lang, url, path, name, previous = job
+    try:
+        response = render_page(site, page_id, lang, url, path)
+    except Http404:
+        return name, None, False
+    if response.status_code != 200:
+        return name, None, False
+    content_hash = md5_constructor(response.content).hexdigest()
+    file_name = os.path.join(directory, name)
+    if content_hash == previous and os.path.exists(file_name):
+        return name, content_hash, False
+    write_file(file_name, response.content)
+    return name, content_hash, True
+
+def init_worker():
+    """Give every process of the pool its own database connection."""
+    connection.close()
+
+def read_manifest(directory):
+    """Return the manifest of the previous export in ``directory``."""
+    try:
+        manifest_file = open(os.path.join(directory, MANIFEST_NAME))
+    except IOError:
+        return {'date': None, 'navigation': {}, 'files': {}}
+    try:
+        return simplejson.load(manifest_file)
+    finally:
+        manifest_file.close()
+
+def write_manifest(directory, manifest):
+    """Write the manifest of an export in ``directory``."""
+    manifest_file = open(os.path.join(directory, MANIFEST_NAME), 'w')
+    try:
+        simplejson.dump(manifest, manifest_file)
+    finally:
+        manifest_file.close()
+
+def get_jobs(directory, manifest, incremental=False):
+    """Return the export jobs of every site and the names of the files
+    that are exported. The ``navigation`` hashes of the manifest are
+    updated.
+
+    :param directory: the export directory.
+    :param manifest: the manifest of the previous export.
+    :param incremental: only export the pages modified since the previous
+        export, with their descendants, when the navigation is unchanged.
+    """
+    jobs, names = [], set()
+    since = manifest['date']
+    if since:
+        since = datetime.strptime(since, DATE_FORMAT)
+    languages = [code for (code, name) in settings.PAGE_LANGUAGES]
+    for site in get_sites():
+        set_site(site.id)
+        pages = list(Page.objects.published().order_by('tree_id', 'lft'))
+        navigation = get_navigation_hash(pages)
+        key = str(site.id)
+        modified = None
+        if (incremental and since and
+                manifest['navigation'].get(key) == navigation):
+            modified = [page for page in pages
+                if page.last_modification_date >= since]
+        manifest['navigation'][key] = navigation
+        for page in pages:
+            for lang in page.get_languages():
+                if lang not in languages:
+                    continue
+                name = os.path.join(site.domain, get_file_name(page, lang))
+                names.add(name)
+                if modified is not None and not [p for p in modified
+                        if p.tree_id == page.tree_id and p.lft <= page.lft
+                        and page.rght <= p.rght]:
+                    continue
+                jobs.append((directory, site, page.id, lang,
+                    page.get_absolute_url(lang), page.get_url(lang), name,
+                    manifest['files'].get(name)))
+    return jobs, names
+
+def export_pages(directory, processes=None, incremental=False):
+    """Export the published pages to ``directory``. Return the number of
+    rendered pages and the number of written files.
+
+    :param directory: the export directory.
+    :param processes: the number of processes rendering the pages,
+        defaults to the number of processors.
+    :param incremental: see :func:`get_jobs`.
+    """
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = read_manifest(directory)
+    start = datetime.now().replace(microsecond=0)
+    site_id = settings.SITE_ID
+    try:
+        jobs, names = get_jobs(directory, manifest, incremental)
+        pool = None
+        if processes is None or processes > 1:
+            try:
+                import multiprocessing
+            except ImportError:
+                pass
+            else:
+                connection.close()
+                pool = multiprocessing.Pool(processes, init_worker)
+        if pool is None:
+            results = map(export_page, jobs)
+        else:
+            try:
+                results = pool.map(export_page, jobs, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        set_site(site_id)
+    written = 0
+    for name, content_hash, changed in results:
+        if content_hash is None:
+            names.discard(name)
+        else:
+            manifest['files'][name] = content_hash
+        written += changed
+    # the files of the pages that are not published anymore
+    for name in set(manifest['files']) - names:
+        del manifest['files'][name]
+        for file_name in (name, name + '.gz'):
+            file_name = os.path.join(directory, file_name)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+    manifest['date'] = start.strftime(DATE_FORMAT)
+    write_manifest(directory, manifest)
+    return len(jobs), written
@@ -1,11 +1,24 @@
 """Page CMS functions related to the ``request`` object."""
+import time
+from email.Utils import parsedate_tz, mktime_tz
 from django.core.handlers.base import BaseHandler
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
 from django.shortcuts import render_to_response
 from django.template import loader, Context, RequestContext
 from django.core.urlresolvers import reverse
 from pages import settings
+from pages.cache import get_identity_map, start_identity_map
+from pages.cache import end_identity_map, get_generations
+from pages.cache import get_response_key, get_cached_response
+from pages.cache import set_cached_response, get_response_headers
+from pages.purge import get_surrogate_keys
+from pages.schedule import get_timeout
 
 def get_request_mock():
     """Build a ``request`` mock that can be used for testing."""
@@ -55,6 +68,165 @@ def auto_render(func):
                             context_instance=RequestContext(request))
     return _dec
 
+def with_identity_map(func):
+    """
+    This view decorator installs an :class:`IdentityMap
+    <pages.cache.IdentityMap>` of the page lookups for the time of the
+    view, unless the ``IdentityMapMiddleware`` already did it.
+    """
+    def _dec(request, *args, **kwargs):
+        if get_identity_map() is not None:
+            return func(request, *args, **kwargs)
+        start_identity_map()
+        try:
+            return func(request, *args, **kwargs)
+        finally:
+            end_identity_map()
+    return _dec
+
+def cache_response(func):
+    """
+    This view decorator keeps the responses of the view in the cache when
+    ``PAGE_RESPONSE_CACHE`` is enabled. Only the ``GET`` requests of the
+    anonymous users without a query string are cached: the staff users
+    can see the drafts. The view has to set the ``current_page`` of the
+    :class:`IdentityMap <pages.cache.IdentityMap>` to the displayed page.
+    """
+    def _dec(request, *args, **kwargs):
+        if (not settings.PAGE_RESPONSE_CACHE or request.method != 'GET'
+                or request.GET or request.user.is_authenticated()
+                or 'only_context' in kwargs or 'template_name' in kwargs):
+            return func(request, *args, **kwargs)
+        from pages.models import Page
+        lang = kwargs.get('lang') or get_language_from_request(request)
+        key = get_response_key(request, lang)
+        response = get_cached_response(key)
+        if response is not None:
+            if response.has_header('ETag') and is_not_modified(request,
+                    response['ETag'], response['Last-Modified']):
+                return get_not_modified_response(response)
+            return response
+        stamps = get_generations([Page.PAGE_NAVIGATION_GENERATION_KEY])
+        response = func(request, *args, **kwargs)
+        identity_map = get_identity_map()
+        if (response.status_code == 200 and identity_map is not None
+                and identity_map.current_page):
+            set_cached_response(key, response, identity_map.current_page,
+                stamps, identity_map.displayed_page_ids)
+        return response
+    return _dec
+
+def get_page_validators(request, page, lang):
+    """Return the ``ETag`` and the ``Last-Modified`` date of the response
+    to a request for a page, as header values. They change with the
+    modification date of the page, the generations of the page and of its
+    tree, the navigation and the user.
+
+    :param request: the request object.
+    :param page: the requested page.
+    :param lang: the language of the response.
+    """
+    from pages.models import Page
+    generations = get_generations([Page.PAGE_GENERATION_KEY % page.id,
+        Page.PAGE_TREE_GENERATION_KEY % page.tree_id,
+        Page.PAGE_NAVIGATION_GENERATION_KEY])
+    last_modified = max(page.last_modification_date,
+        Page.objects.get_navigation_date())
+    etag = md5_constructor(smart_str('%d:%s:%s:%s:%d:%s' % (page.id, lang,
+        sorted(generations.items()), last_modified, request.is_ajax(),
+        request.user.id))).hexdigest()
+    return (quote_etag(etag),
+        http_date(time.mktime(last_modified.timetuple())))
+
+def is_not_modified(request, etag, last_modified):
+    """Return ``True`` if the conditional headers of the request match
+    the validators of the response.
+
+    :param request: the request object.
+    :param etag: the ``ETag`` header of the response.
+    :param last_modified: the ``Last-Modified`` header of the response.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match:
+        try:
+            etags = parse_etags(if_none_match)
+        except ValueError:
+            return False
+        if '*' not in etags and parse_etags(etag)[0] not in etags:
+            return False
+    elif not if_modified_since:
+        return False
+    if if_modified_since:
+        since = parsedate_tz(if_modified_since)
+        if since is None or (mktime_tz(since) <
+                mktime_tz(parsedate_tz(last_modified))):
+            return False
+    return True
+
+def set_page_headers(request, response, etag, last_modified):
+    """Set the validators and the ``Cache-Control`` header of a page
+    response. The responses to the anonymous users are public. The
+    ``max-age`` doesn't go past the next publication transition."""
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    max_age = get_timeout(settings.PAGE_CACHE_CONTROL_MAX_AGE)
+    if request.user.is_authenticated():
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        patch_cache_control(response, public=True, max_age=max_age)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+def get_not_modified_response(response):
+    """Return a ``304`` response with the headers of ``response``."""
+    not_modified = HttpResponseNotModified()
+    for header, value in get_response_headers(response):
+        not_modified[header] = value
+    return not_modified
+
+def conditional_page(func):
+    """
+    This view decorator sets the validators computed by the view, see
+    :func:`get_page_validators`, and the ``Cache-Control`` header on the
+    responses when ``PAGE_CONDITIONAL_GET`` is enabled. The view answers
+    the conditional requests itself, before rendering the template.
+    """
+    def _dec(request, *args, **kwargs):
+        response = func(request, *args, **kwargs)
+        identity_map = get_identity_map()
+        if (isinstance(response, HttpResponse)
+                and response.status_code == 200
+                and identity_map is not None and identity_map.validators):
+            set_page_headers(request, response, *identity_map.validators)
+        return response
+    return _dec
+
+def surrogate_keys(func):
+    """
+    This view decorator tags the responses with the surrogate keys of the
+    pages they depend on when ``PAGE_SURROGATE_KEYS`` is enabled, see
+    :func:`pages.purge.get_surrogate_keys`. The view has to set the
+    ``current_page`` of the :class:`IdentityMap <pages.cache.IdentityMap>`
+    to the displayed page.
+    """
+    def _dec(request, *args, **kwargs):
+        response = func(request, *args, **kwargs)
+        if not settings.PAGE_SURROGATE_KEYS:
+            return response
+        identity_map = get_identity_map()
+        if (isinstance(response, HttpResponse)
+                and response.status_code == 200
+                and identity_map is not None and identity_map.current_page):
+            lang = kwargs.get('lang') or get_language_from_request(request)
+            response[settings.PAGE_SURROGATE_KEY_HEADER] = ' '.join(
+                get_surrogate_keys(identity_map.current_page, lang,
+                identity_map.displayed_page_ids))
+        return response
+    return _dec
+
 def get_slug_and_relative_path(path, lang=None):
     """Return the page's slug and relative path."""
     root = reverse('pages-root')
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""Create the full-text search table of the pages with ``syncdb``."""
+from django.db.models.signals import post_syncdb
+
+from pages import settings
+from pages import models as pages_models
+from pages.search import install_search_index
+
+def create_search_index(sender, **kwargs):
+    if not settings.PAGE_SEARCH_INDEX:
+        return
+    install_search_index()
+
+post_syncdb.connect(create_search_index, sender=pages_models)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Measure the rendering time of the menus against the size of the page
+tree."""
+import time
+from optparse import make_option
+from django.conf import settings as django_settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.template import Template, RequestContext
+
+from pages import settings
+
+MENU_TEMPLATE = ('{% load pages_tags %}{% load_pages %}'
+    '{% for page in pages %}{% pages_menu page %}{% endfor %}')
+
+class Command(NoArgsCommand):
+    help = ('Fill a test database with page trees of growing sizes and '
+        'print the time needed to render their menus with and without '
+        'the navigation snapshot. The generations of the navigation are '
+        'incremented in the cache: run it on a development machine.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='50,200,1000',
+            help='Comma separated numbers of pages.'),
+        make_option('--repeat', type='int', dest='repeat', default=10,
+            help='Number of renderings measured for every size.'),
+    )
+
+    def handle_noargs(self, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        old_name = django_settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.benchmark(sizes, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, sizes, repeat):
+        from django.contrib.auth.models import User
+        from pages.cache import start_identity_map, end_identity_map
+        from pages.http import get_request_mock
+        from pages.models import Page, Content
+        from pages.navigation import get_snapshot, get_size
+        lang = settings.PAGE_DEFAULT_LANGUAGE
+        author = User.objects.create(username='benchmark')
+        request = get_request_mock()
+        template = Template(MENU_TEMPLATE)
+        pages = []
+        enabled = settings.PAGE_NAVIGATION_SNAPSHOT
+        print "%8s %12s %16s %16s" % ('pages', 'snapshot', 'queries (ms)',
+            'snapshot (ms)')
+        for size in sizes:
+            while len(pages) < size:
+                # five children per page, breadth first
+                parent = None
+                if len(pages) >= 5:
+                    # mptt needs the current position of the parent
+                    parent = Page.objects.get(pk=pages[len(pages) / 5 - 1].id)
+                page = Page.objects.create(author=author, parent=parent,
+                    status=Page.PUBLISHED)
+                page.sites.add(settings.SITE_ID)
+                for ctype in ('title', 'slug'):
+                    Content.objects.create_content_if_changed(page, lang,
+                        ctype, 'page-%d' % page.id)
+                pages.append(page)
+            durations = []
+            for snapshot in (False, True):
+                settings.PAGE_NAVIGATION_SNAPSHOT = snapshot
+                start = time.time()
+                for i in range(repeat + 1):
+                    if i == 1:
+                        # the first rendering fills the caches
+                        start = time.time()
+                    start_identity_map()
+                    try:
+                        template.render(RequestContext(request,
+                            {'lang': lang}))
+                    finally:
+                        end_identity_map()
+                durations.append((time.time() - start) * 1000 / repeat)
+            settings.PAGE_NAVIGATION_SNAPSHOT = enabled
+            print "%8d %12d %16.1f %16.1f" % (size,
+                get_size(get_snapshot(settings.SITE_ID, lang)), durations[0],
+                durations[1])
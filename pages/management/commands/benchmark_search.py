@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Measure the latency of the page search against the number of pages."""
+import time, random
+from optparse import make_option
+from datetime import datetime
+from django.conf import settings as django_settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+from pages import settings
+
+VOCABULARY_SIZE = 5000
+BODY_LENGTH = 150
+
+def insert_many(model, objects):
+    """Insert model instances with a single statement, without calling
+    their ``save`` method."""
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields
+        if not isinstance(field, AutoField)]
+    rows = [[field.get_db_prep_save(field.pre_save(obj, True))
+        for field in fields] for obj in objects]
+    connection.cursor().executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields))), rows)
+
+class Command(NoArgsCommand):
+    help = ('Fill a test database with growing numbers of published pages '
+        'and print the time needed to index them and to search them, '
+        'without and with the cache of the results. The bodies are drawn '
+        'from a vocabulary with a Zipf distribution: the common query '
+        'matches most of the pages, the rare one a few.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000,10000,100000',
+            help='Comma separated numbers of pages.'),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+            help='Number of searches measured for every query.'),
+        make_option('--terms', action='store_true', dest='terms',
+            default=False, help='Use the ContentTerm table even on SQLite.'),
+    )
+
+    def handle_noargs(self, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        old_name = django_settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        if not options['terms']:
+            # syncdb only creates the table if the index is enabled
+            from pages.search import install_search_index
+            install_search_index()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            self.benchmark(sizes, options['repeat'], options['terms'])
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, sizes, repeat, terms):
+        from django.contrib.auth.models import User
+        from pages import search
+        from pages.cache import incr_generation
+        from pages.models import Page, Content
+        if terms:
+            search._backend[:] = [search.TermSearchBackend()]
+        lang = settings.PAGE_DEFAULT_LANGUAGE
+        author = User.objects.create(username='benchmark')
+        words = ['word%d' % i for i in range(VOCABULARY_SIZE)]
+        # the weight of the nth word is 1 / n
+        weights, total = [], 0.0
+        for i in range(VOCABULARY_SIZE):
+            total += 1.0 / (i + 1)
+            weights.append(total)
+        def get_word():
+            value = random.random() * total
+            low, high = 0, VOCABULARY_SIZE - 1
+            while low < high:
+                middle = (low + high) / 2
+                if weights[middle] < value:
+                    low = middle + 1
+                else:
+                    high = middle
+            return words[low]
+        queries = (('common', words[0]), ('rare', words[VOCABULARY_SIZE / 2]),
+            ('two words', '%s %s' % (words[1], words[20])),
+            ('prefix', words[12]))
+        print "%8s %10s %10s" % ('pages', 'index (s)', 'results') + ''.join(
+            ["%16s" % ('%s (ms)' % name) for (name, query) in queries] +
+            ["%16s" % 'cached (ms)'])
+        count = 0
+        random.seed(0)
+        now = datetime.now()
+        for size in sizes:
+            pages = []
+            for i in range(count, size):
+                pages.append(Page(author=author, status=Page.PUBLISHED,
+                    publication_date=now, last_modification_date=now,
+                    tree_id=i + 1, lft=1, rght=2, level=0))
+            insert_many(Page, pages)
+            page_ids = list(Page.objects.filter(tree_id__gt=count).values_list(
+                'id', flat=True))
+            sites = Page._meta.get_field('sites')
+            connection.cursor().executemany(
+                'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+                sites.m2m_db_table(), sites.m2m_column_name(),
+                sites.m2m_reverse_name()), [(page_id, settings.SITE_ID)
+                for page_id in page_ids])
+            contents = []
+            for page_id in page_ids:
+                contents.append(Content(page_id=page_id, language=lang,
+                    type='title', body='page %d' % page_id))
+                contents.append(Content(page_id=page_id, language=lang,
+                    type='slug', body='page-%d' % page_id))
+                contents.append(Content(page_id=page_id, language=lang,
+                    type='body', body=' '.join([get_word()
+                    for j in range(BODY_LENGTH)])))
+            insert_many(Content, contents)
+            Page.objects.invalidate_navigation()
+            count = size
+            start = time.time()
+            search.rebuild_index()
+            index_duration = time.time() - start
+            results = len(search.search_published_pages(queries[0][1], lang))
+            latencies = []
+            for name, query in queries:
+                search.get_results_page(query, lang)
+                duration = 0
+                for i in range(repeat):
+                    # a new generation of the index, the results are not
+                    # cached
+                    incr_generation(search.SEARCH_GENERATION_KEY)
+                    start = time.time()
+                    search.get_results_page(query, lang)
+                    duration += time.time() - start
+                latencies.append(duration * 1000 / repeat)
+            search.get_results_page(queries[0][1], lang)
+            start = time.time()
+            for i in range(repeat):
+                search.get_results_page(queries[0][1], lang)
+            latencies.append((time.time() - start) * 1000 / repeat)
+            print "%8d %10.1f %10d" % (size, index_duration, results) + ''.join(
+                ["%16.1f" % latency for latency in latencies])
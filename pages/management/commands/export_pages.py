@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Export the published pages to static files."""
+from optparse import make_option
+from django.core.management.base import LabelCommand
+
+from pages.export import export_pages
+
+class Command(LabelCommand):
+    help = ('Render every published page, in every language and on every '
+        'site, into a directory of static files with their gzipped '
+        'version.')
+    args = '<directory>'
+    label = 'directory'
+    option_list = LabelCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+            help='Number of processes rendering the pages. '
+            'Defaults to the number of processors.'),
+        make_option('--incremental', action='store_true', dest='incremental',
+            default=False, help='Only render the pages modified since the '
+            'previous export, unless the navigation has changed.'),
+    )
+
+    def handle_label(self, directory, **options):
+        rendered, written = export_pages(directory,
+            processes=options.get('processes'),
+            incremental=options['incremental'])
+        print "%d pages rendered, %d files written." % (rendered, written)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Delete the old content revisions."""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+from pages import settings
+from pages.models import Content
+
+class Command(NoArgsCommand):
+    help = ('Delete the old content revisions according to the retention '
+        'policy and append them to the archive file if one is defined.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--keep', type='int', dest='keep',
+            help='Number of revisions to keep, the current one included. '
+            'Defaults to PAGE_CONTENT_REVISION_KEEP.'),
+        make_option('--max-age', type='int', dest='max_age',
+            help='Number of days revisions are kept. '
+            'Defaults to PAGE_CONTENT_REVISION_MAX_AGE.'),
+        make_option('--archive', dest='archive',
+            help='Gzip file where the deleted revisions are appended. '
+            'Defaults to PAGE_CONTENT_REVISION_ARCHIVE.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=100, help='Number of pages processed at once.'),
+    )
+
+    def handle_noargs(self, **options):
+        keep = options.get('keep')
+        if keep is None:
+            keep = settings.PAGE_CONTENT_REVISION_KEEP
+        max_age = options.get('max_age')
+        if max_age is None:
+            max_age = settings.PAGE_CONTENT_REVISION_MAX_AGE
+        archive = options.get('archive') or settings.PAGE_CONTENT_REVISION_ARCHIVE
+        pruned = Content.objects.prune_revisions(keep=keep, max_age=max_age,
+            archive=archive, batch_size=options['batch_size'])
+        print "%d revisions deleted." % pruned
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Publish the scheduled drafts and fire the publication transitions."""
+import time
+from datetime import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+from pages import settings
+from pages.models import Page
+from pages.schedule import check_transitions, get_next_transition
+
+class Command(NoArgsCommand):
+    help = ('Publish the drafts whose publication date has come and '
+        'invalidate the cached navigation when a page appears or disappears '
+        'because of its publication dates. With --loop, the command keeps '
+        'running and wakes up at every transition.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep running until interrupted.'),
+        make_option('--interval', type='int', dest='interval', default=60,
+            help='Maximum number of seconds between two checks with '
+                '--loop, for the transitions added by other processes.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            published, changed = self.publish()
+            if verbosity > 0 and (published or changed):
+                print "%d drafts published, %d pages changed state." % (
+                    published, changed)
+            if not options['loop']:
+                break
+            now = datetime.now()
+            delay = options['interval']
+            transition = get_next_transition(now)
+            if transition is not None:
+                delta = transition - now
+                delay = min(delay, delta.days * 86400 + delta.seconds + 1)
+            time.sleep(delay)
+
+    def publish(self):
+        """Publish the scheduled drafts and fire the transitions. Return
+        the number of published drafts and of pages that have changed
+        state."""
+        published = 0
+        if settings.PAGE_SHOW_START_DATE:
+            drafts = Page.objects.filter(status=Page.DRAFT,
+                publication_date__lte=datetime.now())
+            for page in drafts:
+                page.status = Page.PUBLISHED
+                page.save()
+                published += 1
+        return published, len(set(check_transitions()))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Flag the current revision of every content."""
+from django.core.management.base import NoArgsCommand
+
+from pages.models import Content
+
+class Command(NoArgsCommand):
+    help = ('Flag the latest revision of every content as the current one. '
+        'Run it once after adding the current column to an existing '
+        'pages_content table.')
+
+    def handle_noargs(self, **options):
+        Content.objects.rebuild_current()
+        print "%d current contents." % Content.objects.filter(
+            current=True).count()
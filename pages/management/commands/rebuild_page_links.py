@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""Resolve again the links between the pages."""
+from django.core.management.base import NoArgsCommand
+
+from pages.models import PageLink
+
+class Command(NoArgsCommand):
+    help = ('Resolve from scratch the page links of the current contents '
+        'and rebuild the link table.')
+
+    def handle_noargs(self, **options):
+        PageLink.objects.rebuild()
+        print "%d page links, %d broken." % (PageLink.objects.count(),
+            PageLink.objects.filter(broken=True).count())
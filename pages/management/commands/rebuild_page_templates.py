@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Compute again the effective template of the pages."""
+from django.core.management.base import NoArgsCommand
+
+from pages.models import Page
+
+class Command(NoArgsCommand):
+    help = ('Compute again the template inherited by every page. Run it '
+        'once after adding the effective_template column to an existing '
+        'pages_page table.')
+
+    def handle_noargs(self, **options):
+        print "%d page templates updated." % Page.objects.update_templates()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""Rebuild the url index of the pages."""
+from django.core.management.base import NoArgsCommand
+
+from pages.models import PageUrl
+
+class Command(NoArgsCommand):
+    help = 'Rebuild from scratch the url index used to resolve the pages.'
+
+    def handle_noargs(self, **options):
+        PageUrl.objects.rebuild()
+        print "%d urls indexed." % PageUrl.objects.count()
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Rebuild the full-text index of the contents."""
+from django.core.management.base import NoArgsCommand
+
+from pages.search import install_search_index, rebuild_index
+
+class Command(NoArgsCommand):
+    help = ('Index the current revision of every content from scratch. The '
+        'SQLite full-text table is created if needed.')
+
+    def handle_noargs(self, **options):
+        install_search_index()
+        print "%d contents indexed." % rebuild_index()
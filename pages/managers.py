@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 """Django page CMS ``managers``."""
-import itertools, re
-from datetime import datetime
+import itertools, re, gzip, bisect, operator, os
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 from django.db import models, connection
 from django.contrib.sites.models import Site
 from django.db.models import Q
-from django.core.cache import cache
+from django.utils import simplejson
 
 from pages import settings
-from pages.utils import normalize_url, filter_link
+from pages.utils import normalize_url, resolve_links, apply_delta
+from pages.cache import page_cache, get_identity_map
+from pages.cache import get_generations, incr_generation
+from pages.cache import GENERATION_TIMEOUT
+from pages.purge import purge_pages, purge_navigation
+from django.core.cache import cache
 from django.contrib.auth.models import User
 
 class PageManager(models.Manager):
@@ -33,6 +39,273 @@ class PageManager(models.Manager):
         for child in range(1, child):
             self.populate_pages(parent=p, child=child, depth=(depth-1))
     
+    def get_cache_keys(self, pages, key, *args):
+        """Return a dictionnary of the cache keys ``key`` of a list of
+        pages by page id. The generations of the pages are loaded with a
+        single cache lookup, see
+        :meth:`Page.get_cache_key <pages.models.Page.get_cache_key>`.
+
+        :param pages: a list of pages.
+        :param key: one of the ``PAGE_*_KEY`` constants.
+        :param args: the other arguments of the key.
+        """
+        tree_key = key in self.model.PAGE_TREE_KEYS
+        generation_keys = []
+        for page in pages:
+            generation_keys.append(self.model.PAGE_GENERATION_KEY % page.id)
+            if tree_key:
+                generation_keys.append(
+                    self.model.PAGE_TREE_GENERATION_KEY % page.tree_id)
+        generations = get_generations(generation_keys)
+        keys = {}
+        for page in pages:
+            cache_key = '%s_%d' % (key % ((page.id,) + args),
+                generations[self.model.PAGE_GENERATION_KEY % page.id])
+            if tree_key:
+                cache_key = '%s_%d' % (cache_key, generations[
+                    self.model.PAGE_TREE_GENERATION_KEY % page.tree_id])
+            keys[page.id] = cache_key
+        return keys
+
+    def invalidate(self, page_id):
+        """Invalidate the cached data of a page by starting a new
+        generation of its cache keys, see
+        :meth:`Page.invalidate <pages.models.Page.invalidate>`.
+
+        :param page_id: the id of the concerned page.
+        """
+        incr_generation(self.model.PAGE_GENERATION_KEY % page_id)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.forget_page(page_id)
+        purge_pages([page_id])
+
+    def invalidate_navigation(self, page=None):
+        """Invalidate the cached responses of every page after a
+        modification that can change the navigation: new title, new url,
+        new publication status or dates, page creation or deletion.
+
+        :param page: the modified page if only its title or its
+            publication status or dates have changed. The navigation
+            snapshots are then updated instead of being built again, see
+            :mod:`pages.navigation`.
+        """
+        generation = incr_generation(
+            self.model.PAGE_NAVIGATION_GENERATION_KEY)
+        cache.set(self.model.PAGE_NAVIGATION_DATE_KEY, datetime.now(),
+            GENERATION_TIMEOUT)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.navigations.clear()
+        if (page is not None and generation is not None
+                and settings.PAGE_NAVIGATION_SNAPSHOT):
+            from pages.navigation import update_snapshots
+            update_snapshots(page, generation)
+        purge_navigation()
+
+    def prefetch_children_for_frontend(self, page, expanded=None):
+        """Load the published descendants of a page with a single query
+        and keep on every loaded page the list of its published children,
+        returned by :meth:`Page.get_children_for_frontend
+        <pages.models.Page.get_children_for_frontend>`. Return the loaded
+        pages in tree order, ``page`` included.
+
+        :param page: the page at the top of the tree.
+        :param expanded: if defined, only the children of this page and of
+            its ancestors are loaded.
+        """
+        def is_expanded(node):
+            return expanded is None or (node.tree_id == expanded.tree_id
+                and node.lft <= expanded.lft and node.rght >= expanded.rght)
+        pages = [page]
+        if not is_expanded(page):
+            return pages
+        descendants = self.filter_published(page.get_descendants())
+        if expanded is not None:
+            descendants = descendants.filter(parent__lft__lte=expanded.lft,
+                parent__rght__gte=expanded.rght)
+        page._children_for_frontend = []
+        loaded = {page.id: page}
+        for node in descendants.order_by('lft'):
+            parent = loaded.get(node.parent_id)
+            # the descendants of an unpublished page are not displayed
+            if parent is None:
+                continue
+            parent._children_for_frontend.append(node)
+            loaded[node.id] = node
+            pages.append(node)
+            if is_expanded(node):
+                node._children_for_frontend = []
+        return pages
+
+    def get_ancestor_rows(self, page):
+        """Load the ancestors of a page, with their slugs, titles and urls
+        in every language, with three queries. Return them as a list of
+        tuples, the root first, see :meth:`from_ancestor_rows`.
+
+        :param page: the concerned page object.
+        """
+        from pages.models import Content, PageUrl
+        ancestors = list(page.get_ancestors())
+        page_ids = [ancestor.id for ancestor in ancestors]
+        content_dicts = Content.objects.load_content_dicts(page_ids,
+            ('slug', 'title'))
+        urls = {}
+        for page_id, language, url in PageUrl.objects.filter(
+                page__in=page_ids).values_list('page', 'language', 'url'):
+            urls[(page_id, language)] = url
+        first_root = None
+        if settings.PAGE_HIDE_ROOT_SLUG and ancestors:
+            first_root = self.root()[0].id
+        languages = [code for (code, name) in settings.PAGE_LANGUAGES]
+        rows, paths = [], {}
+        for ancestor in ancestors:
+            content_dict = content_dicts[ancestor.id]
+            slugs = content_dict.get('slug', {})
+            url_dict = {}
+            for language in languages:
+                slug = slugs.get(language) or ([slugs[code] for code in
+                    languages if slugs.get(code)] + [''])[0]
+                # the path of a page that has not been indexed
+                if language in paths:
+                    paths[language] += '/' + slug
+                else:
+                    paths[language] = slug
+                if ancestor.id == first_root:
+                    url_dict[language] = ''
+                else:
+                    url_dict[language] = urls.get((ancestor.id, language),
+                        paths[language])
+            rows.append((ancestor.id, ancestor.parent_id, ancestor.tree_id,
+                ancestor.lft, ancestor.rght, ancestor.level, ancestor.status,
+                slugs, content_dict.get('title', {}), url_dict))
+        return rows
+
+    def from_ancestor_rows(self, rows):
+        """Return the ancestors loaded by :meth:`get_ancestor_rows` as
+        page objects whose slug, title and url don't need any query."""
+        ancestors = []
+        for (page_id, parent_id, tree_id, lft, rght, level, status, slugs,
+                titles, urls) in rows:
+            page = self.model(id=page_id, parent_id=parent_id,
+                tree_id=tree_id, lft=lft, rght=rght, level=level,
+                status=status)
+            page._content_dict = {'slug': slugs, 'title': titles}
+            page._content_types = ('slug', 'title')
+            page._url_dict = urls
+            ancestors.append(page)
+        return ancestors
+
+    def get_effective_template(self, page_id):
+        """Return the template inherited from a page by its children: the
+        template of the page or of its closer parent, or an empty string.
+
+        :param page_id: the id of the page, or ``None`` for the root pages.
+        """
+        if page_id is None:
+            return ''
+        template, effective_template = self.filter(pk=page_id).values_list(
+            'template', 'effective_template')[0]
+        if template:
+            return template
+        if effective_template is None:
+            # not computed yet
+            for template in self.get(pk=page_id).get_ancestors(
+                    ascending=True).values_list('template', flat=True):
+                if template:
+                    return template
+            return ''
+        return effective_template
+
+    def update_templates(self, page=None):
+        """Compute again the :attr:`effective_template
+        <pages.models.Page.effective_template>` of a page and of its
+        descendants, or of every page. This method is called by
+        :meth:`update_tree_data <pages.models.Page.update_tree_data>` every
+        time a page is moved in the tree. Return the number of updated
+        pages.
+
+        :param page: the page at the top of the subtree.
+        """
+        if page is None:
+            pages = self.all()
+            inherited = {}
+        else:
+            # the position of the page object can be outdated
+            page = self.get(pk=page.id)
+            pages = page.get_descendants(include_self=True)
+            inherited = {page.parent_id:
+                self.get_effective_template(page.parent_id)}
+        updates = {}
+        for page_id, parent_id, template, effective_template in \
+                pages.order_by('tree_id', 'lft').values_list('id', 'parent',
+                'template', 'effective_template'):
+            inherited[page_id] = template or inherited.get(parent_id, '')
+            if inherited[page_id] != effective_template:
+                updates.setdefault(inherited[page_id], []).append(page_id)
+        for template, page_ids in updates.items():
+            # keep the number of query parameters low
+            for i in range(0, len(page_ids), 500):
+                self.filter(pk__in=page_ids[i:i + 500]).update(
+                    effective_template=template)
+        if updates:
+            # the templates are kept in the navigation snapshots
+            self.invalidate_navigation()
+        return sum([len(page_ids) for page_ids in updates.values()])
+
+    def get_navigation_date(self):
+        """Return the date of the last modification that can change the
+        navigation, see :meth:`invalidate_navigation`."""
+        date = cache.get(self.model.PAGE_NAVIGATION_DATE_KEY)
+        if date is None:
+            # unknown, any later request will share this date
+            date = datetime.now()
+            cache.add(self.model.PAGE_NAVIGATION_DATE_KEY, date,
+                GENERATION_TIMEOUT)
+        return date
+
+    def get_transitions(self, limit=None):
+        """Return the upcoming publications and ends of publication as a
+        list of ``(date, page id)`` tuples ordered by date. The drafts
+        scheduled for publication are included, see the
+        ``publish_pages`` command.
+
+        :param limit: the maximum number of dates of each kind. The
+            returned list is cut at the last date known for sure.
+        """
+        now = datetime.now()
+        queries = []
+        if settings.PAGE_SHOW_START_DATE:
+            queries.append((self.filter(publication_date__gt=now,
+                status__in=(self.model.PUBLISHED, self.model.DRAFT)),
+                'publication_date'))
+        if settings.PAGE_SHOW_END_DATE:
+            queries.append((self.filter(publication_end_date__gt=now,
+                status=self.model.PUBLISHED), 'publication_end_date'))
+        transitions, horizon = [], None
+        for query, field in queries:
+            rows = query.order_by(field).values_list(field, 'id')
+            if limit is not None:
+                rows = rows[:limit]
+            rows = list(rows)
+            transitions.extend(rows)
+            if limit is not None and len(rows) == limit:
+                # the later dates of this kind are unknown
+                if horizon is None or rows[-1][0] < horizon:
+                    horizon = rows[-1][0]
+        transitions.sort()
+        if horizon is not None:
+            transitions = [t for t in transitions if t[0] <= horizon]
+        return transitions
+
+    def get_next_transition(self):
+        """Return the date of the next publication or end of publication
+        of a page, or ``None``."""
+        transitions = self.get_transitions(limit=1)
+        if transitions:
+            return transitions[0][0]
+        return None
+
     def on_site(self, site_id=None):
         """Return a :class:`QuerySet` of pages that are published on the site
         defined by the ``SITE_ID`` setting.
@@ -97,8 +370,14 @@ class PageManager(models.Manager):
     def from_path(self, complete_path, lang, exclude_drafts=True):
         """Return a :class:`Page <pages.models.Page>` according to
         the page's path."""
-        from pages.models import Content, Page
+        from pages.models import Content, Page, PageUrl
         from pages.http import get_slug_and_relative_path
+        page = PageUrl.objects.from_path(complete_path, lang,
+            exclude_drafts=exclude_drafts)
+        if page:
+            return page
+        # the path is not in the url index, it could be an old slug,
+        # a bare slug or a page that has not been indexed yet
         slug, path, lang = get_slug_and_relative_path(complete_path, lang)
         page_ids = Content.objects.get_page_ids_by_slug(slug)
         pages_list = self.on_site().filter(id__in=page_ids)
@@ -139,7 +418,7 @@ class ContentManager(models.Manager):
             body = self.sanitize(body)
         try:
             content = self.filter(page=page, language=language,
-                                  type=ctype).latest('creation_date')
+                        type=ctype, current=True).latest('creation_date')
             content.body = body
         except self.model.DoesNotExist:
             content = self.model(page=page, language=language, body=body,
@@ -161,7 +440,7 @@ class ContentManager(models.Manager):
             body = self.sanitize(body)
         try:
             content = self.filter(page=page, language=language,
-                                  type=ctype).latest('creation_date')
+                        type=ctype, current=True).latest('creation_date')
             if content.body == body:
                 return content
         except self.model.DoesNotExist:
@@ -169,6 +448,89 @@ class ContentManager(models.Manager):
         content = self.create(page=page, language=language, body=body,
                 type=ctype)
 
+    def load_content_dicts(self, page_ids, types=None):
+        """Load the current content of every type and language of several
+        pages with a single query. Return a dictionnary of the form
+        ``{page_id: {type: {language: body}}}``. If ``PAGE_LINK_FILTER`` is
+        enabled, the bodies have their page links resolved.
+
+        :param page_ids: the ids of the concerned pages.
+        :param types: if defined, only these content types are loaded.
+        """
+        content_dicts = dict([(page_id, {}) for page_id in page_ids])
+        if not page_ids:
+            return content_dicts
+        contents = self.filter(page__in=page_ids, current=True)
+        if types is not None:
+            contents = contents.filter(type__in=types)
+        contents = contents.order_by('id').values_list('page', 'type',
+            'language', 'body', 'rendered')
+        for page_id, ctype, language, body, rendered in contents:
+            if settings.PAGE_LINK_FILTER and rendered is not None:
+                body = rendered
+            content_dicts[page_id].setdefault(ctype, {})[language] = body
+        return content_dicts
+
+    def get_content_dict(self, page):
+        """Return the current content of every type and language of a page
+        as a dictionnary of the form ``{type: {language: body}}``. The
+        dictionnary is loaded with a single query and cached.
+
+        :param page: the concerned page object.
+        """
+        from pages.models import Page
+        if getattr(page, '_content_types', False) is None:
+            return page._content_dict
+        identity_map = get_identity_map()
+        if identity_map is not None and page.id in identity_map.contents:
+            return identity_map.contents[page.id]
+        key = page.get_cache_key(Page.PAGE_CONTENT_DICT_KEY)
+        content_dict = page_cache.get(key)
+        if content_dict is None:
+            content_dict = self.load_content_dicts([page.id])[page.id]
+            page_cache.set(key, content_dict)
+        if identity_map is not None:
+            identity_map.contents[page.id] = content_dict
+        return content_dict
+
+    def prefetch_for_pages(self, pages, types=None, language=None):
+        """Load the content of a list of pages with one cache lookup and
+        at most one query, and keep it on the page objects: the following
+        :meth:`get_content`, ``slug`` and ``title`` calls on these objects
+        don't hit the cache or the database anymore. Return the list
+        of pages.
+
+        :param pages: a list or a :class:`QuerySet` of pages.
+        :param types: if defined, only these content types are loaded
+            from the database.
+        :param language: if defined, the urls of the pages in this
+            language are also loaded.
+        """
+        from pages.models import Page, PageUrl
+        pages = list(pages)
+        keys = Page.objects.get_cache_keys(pages,
+            Page.PAGE_CONTENT_DICT_KEY)
+        cached = page_cache.get_many(keys.values())
+        missing = []
+        for page in pages:
+            content_dict = cached.get(keys[page.id])
+            if content_dict is None:
+                missing.append(page)
+            else:
+                page._content_dict = content_dict
+                page._content_types = None
+        content_dicts = self.load_content_dicts(
+            list(set([page.id for page in missing])), types)
+        for page in missing:
+            page._content_dict = content_dicts[page.id]
+            page._content_types = types
+            # only complete dictionnaries can be shared
+            if types is None:
+                page_cache.set(keys[page.id], page._content_dict)
+        if language:
+            PageUrl.objects.prefetch_for_pages(pages, language)
+        return pages
+
     def get_content(self, page, language, ctype, language_fallback=False):
         """Gets the latest :class:`Content <pages.models.Content>`
         for a particular page and language. Falls back to another
@@ -179,43 +541,291 @@ class ContentManager(models.Manager):
         :param ctype: the content type.
         :param language_fallback: fallback to another language if ``True``.
         """
-        PAGE_CONTENT_DICT_KEY = "page_content_dict_%s_%s"
         if not language:
             language = settings.PAGE_DEFAULT_LANGUAGE
 
-        content_dict = cache.get(PAGE_CONTENT_DICT_KEY % (str(page.id), ctype))
-        #content_dict = None
+        if ctype not in ('title', 'slug'):
+            # the titles and the slugs are part of the navigation
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                identity_map.displayed_page_ids.add(page.id)
 
-        if not content_dict:
-            content_dict = {}
-            for lang in settings.PAGE_LANGUAGES:
-                try:
-                    content = self.filter(
-                        language=lang[0],
-                        type=ctype,
-                        page=page
-                    ).latest()
-                    content_dict[lang[0]] = content.body
-                except self.model.DoesNotExist:
-                    content_dict[lang[0]] = ''
-            cache.set(PAGE_CONTENT_DICT_KEY % (page.id, ctype), content_dict)
+        types = getattr(page, '_content_types', False)
+        if types is not False and (types is None or ctype in types):
+            # the content has been prefetched
+            content_dict = page._content_dict.get(ctype, {})
+        else:
+            content_dict = self.get_content_dict(page).get(ctype, {})
 
         if language in content_dict and content_dict[language]:
-            return filter_link(content_dict[language], page, language, ctype)
+            return content_dict[language]
 
         if language_fallback:
             for lang in settings.PAGE_LANGUAGES:
                 if lang[0] in content_dict and content_dict[lang[0]]:
-                    return filter_link(content_dict[lang[0]], page, lang[0], ctype)
+                    return content_dict[lang[0]]
         return ''
 
+    def rebuild_current(self):
+        """Flag the latest revision of every (page, language, type) as
+        the current one. Only needed to fix existing data, the flag is
+        maintained by :meth:`Content.save <pages.models.Content.save>`."""
+        latest = {}
+        contents = self.order_by('creation_date', 'id').values_list('id',
+            'page', 'language', 'type')
+        for content_id, page_id, language, ctype in contents:
+            latest[(page_id, language, ctype)] = content_id
+        current_ids = latest.values()
+        self.update(current=False)
+        for index in range(0, len(current_ids), 500):
+            self.filter(pk__in=current_ids[index:index + 500]).update(
+                current=True)
+        # only the current revisions keep a rendered body
+        self.filter(current=False, rendered__isnull=False).update(
+            rendered=None)
+
+    def prune_revisions(self, keep=None, max_age=None, archive=None,
+            batch_size=100):
+        """Delete the old revisions according to a retention policy. The
+        current revisions are never deleted. The revisions are processed
+        by batches of pages so the memory usage doesn't depend on the size
+        of the table. Return the number of deleted revisions.
+
+        :param keep: the number of revisions to keep for every page,
+            language and content type, the current one included.
+        :param max_age: the number of days revisions are kept.
+        :param archive: the path of a gzip file where the deleted
+            revisions are appended, see :meth:`archive_revisions`.
+        :param batch_size: the number of pages processed at once.
+        """
+        from pages.models import Page
+        if keep is None and max_age is None:
+            return 0
+        limit = None
+        if max_age is not None:
+            limit = datetime.now() - timedelta(days=max_age)
+        archive_file = None
+        if archive:
+            archive_file = open(archive, 'ab')
+        pruned = 0
+        last_id = 0
+        try:
+            while True:
+                page_ids = list(Page.objects.filter(id__gt=last_id).order_by(
+                    'id').values_list('id', flat=True)[:batch_size])
+                if not page_ids:
+                    break
+                last_id = page_ids[-1]
+
+                revisions = {}
+                contents = self.filter(page__in=page_ids, current=False
+                    ).order_by('-creation_date', '-id').values_list('id',
+                    'page', 'language', 'type', 'creation_date')
+                for content_id, page_id, language, ctype, date in contents:
+                    revisions.setdefault((page_id, language, ctype),
+                        []).append((content_id, date))
+
+                content_ids = []
+                for group in revisions.values():
+                    group_ids = []
+                    # the current revision is the first one to keep
+                    for index, (content_id, date) in enumerate(group):
+                        if keep is not None and index + 1 < keep:
+                            continue
+                        if limit is not None and date >= limit:
+                            continue
+                        group_ids.append(content_id)
+                    # oldest first, a delta only depends on newer revisions
+                    group_ids.reverse()
+                    content_ids.extend(group_ids)
+
+                for index in range(0, len(content_ids), batch_size):
+                    batch = content_ids[index:index + batch_size]
+                    if archive_file:
+                        self.archive_revisions(archive_file,
+                            self.filter(pk__in=batch))
+                    self.filter(pk__in=batch).delete()
+                pruned += len(content_ids)
+                self.filter(page__in=page_ids, current=False,
+                    rendered__isnull=False).update(rendered=None)
+        finally:
+            if archive_file:
+                archive_file.close()
+        return pruned
+
+    def get_previous_revision(self, content):
+        """Return the revision that precedes a content or ``None``.
+
+        :param content: the concerned content object.
+        """
+        previous = self.filter(page=content.page_id,
+            language=content.language, type=content.type).filter(
+            Q(creation_date__lt=content.creation_date) |
+            Q(creation_date=content.creation_date, id__lt=content.id)
+            ).order_by('-creation_date', '-id')[0:1]
+        if len(previous):
+            return previous[0]
+        return None
+
+    def get_revision_bodies(self, page_id, language, ctype):
+        """Return the full body of every revision of a page content as a
+        dictionnary of the form ``{content_id: body}``. The revisions
+        stored as deltas are rebuilt from the next revision.
+
+        :param page_id: the id of the concerned page.
+        :param language: the wanted language.
+        :param ctype: the content type.
+        """
+        bodies = {}
+        body = None
+        revisions = self.filter(page=page_id, language=language,
+            type=ctype).order_by('-creation_date', '-id').values_list('id',
+            'body', 'delta')
+        for content_id, revision_body, delta in revisions:
+            if delta:
+                body = apply_delta(body, revision_body)
+            else:
+                body = revision_body
+            bodies[content_id] = body
+        return bodies
+
+    def get_revision_body(self, content):
+        """Return the full body of a revision.
+
+        :param content: the concerned content object.
+        """
+        if not content.delta:
+            return content.body
+        return self.get_revision_bodies(content.page_id, content.language,
+            content.type)[content.id]
+
+    def expand_revisions(self, revisions):
+        """Replace the deltas of a list of consecutive revisions, newest
+        first, by their full body. The first revision of the list must
+        be the next revision of the second one or be stored in full.
+
+        :param revisions: the list of revisions.
+        """
+        for index, revision in enumerate(revisions):
+            if revision.delta:
+                if index == 0:
+                    revision.body = self.get_revision_body(revision)
+                else:
+                    revision.body = apply_delta(revisions[index - 1].body,
+                        revision.body)
+                revision.delta = False
+        return revisions
+
+    def archive_revisions(self, archive_file, contents):
+        """Append revisions to an archive file. Every revision is a JSON
+        object compressed as a gzip member of its own, so the file is a
+        regular gzip file. The position of every revision is kept in the
+        :class:`ArchivedContent <pages.models.ArchivedContent>` table.
+
+        :param archive_file: a file object opened in append mode.
+        :param contents: the revisions to archive.
+        """
+        from pages.models import ArchivedContent
+        bodies = {}
+        archive_file.seek(0, 2)
+        for content in contents:
+            body = content.body
+            if content.delta:
+                key = (content.page_id, content.language, content.type)
+                if key not in bodies:
+                    bodies[key] = self.get_revision_bodies(*key)
+                body = bodies[key][content.id]
+            date = content.creation_date
+            member = StringIO()
+            member_file = gzip.GzipFile(fileobj=member, mode='wb')
+            member_file.write(simplejson.dumps({
+                'id': content.id,
+                'page': content.page_id,
+                'language': content.language,
+                'type': content.type,
+                'body': body,
+                'creation_date': [date.year, date.month, date.day,
+                    date.hour, date.minute, date.second, date.microsecond],
+            }) + '\n')
+            member_file.close()
+            offset = archive_file.tell()
+            archive_file.write(member.getvalue())
+            ArchivedContent.objects.filter(content_id=content.id).delete()
+            ArchivedContent.objects.create(content_id=content.id,
+                page_id=content.page_id, language=content.language,
+                type=content.type, creation_date=date,
+                archive=os.path.abspath(archive_file.name), offset=offset,
+                size=len(member.getvalue()))
+        archive_file.flush()
+
+    def read_archive(self, entries):
+        """Read archived revisions as unsaved
+        :class:`Content <pages.models.Content>` objects, in the order of
+        the entries. The revisions of a missing archive file are left out.
+
+        :param entries: a list of :class:`ArchivedContent
+            <pages.models.ArchivedContent>` objects.
+        """
+        files = {}
+        revisions = []
+        try:
+            for entry in entries:
+                if entry.archive not in files:
+                    try:
+                        files[entry.archive] = open(entry.archive, 'rb')
+                    except IOError:
+                        files[entry.archive] = None
+                archive_file = files[entry.archive]
+                if archive_file is None:
+                    continue
+                archive_file.seek(entry.offset)
+                member = gzip.GzipFile(fileobj=StringIO(
+                    archive_file.read(entry.size)))
+                revision = simplejson.loads(member.read())
+                revisions.append(self.model(id=revision['id'],
+                    page_id=revision['page'], language=revision['language'],
+                    type=revision['type'], body=revision['body'],
+                    creation_date=datetime(*revision['creation_date']),
+                    current=False))
+        finally:
+            for archive_file in files.values():
+                if archive_file is not None:
+                    archive_file.close()
+        return revisions
+
+    def get_archived_revisions(self, page, language, ctype, limit=None):
+        """Return the archived revisions of a page content, newest first.
+
+        :param page: the concerned page object.
+        :param language: the wanted language.
+        :param ctype: the content type.
+        :param limit: the maximum number of returned revisions.
+        """
+        from pages.models import ArchivedContent
+        entries = ArchivedContent.objects.filter(page_id=page.id,
+            language=language, type=ctype).order_by('-creation_date',
+            '-content_id')
+        if limit is not None:
+            entries = entries[:limit]
+        return self.read_archive(entries)
+
+    def get_archived_content(self, content_id):
+        """Return an archived revision by its id or ``None``.
+
+        :param content_id: the id the revision had in the database.
+        """
+        from pages.models import ArchivedContent
+        revisions = self.read_archive(ArchivedContent.objects.filter(
+            content_id=content_id))
+        return revisions and revisions[0] or None
+
     def get_content_slug_by_slug(self, slug):
         """Returns the latest :class:`Content <pages.models.Content>`
         slug object that match the given slug for the current site domain.
 
         :param slug: the wanted slug.
         """
-        content = self.filter(type='slug', body=slug)
+        content = self.filter(type='slug', body=slug, current=True)
         if settings.PAGE_USE_SITE_ID:
             content = content.filter(page__sites__id=settings.SITE_ID)
         try:
@@ -226,43 +836,379 @@ class ContentManager(models.Manager):
             return content
 
     def get_page_ids_by_slug(self, slug):
-        """Return all page's id matching the given slug.
+        """Return all page's id matching the given slug. Every revision
+        is searched so an old slug still resolves to its page.
 
         :param slug: the wanted slug.
         """
-        sql = '''SELECT pages_content.page_id,
-            MAX(pages_content.creation_date)
-            FROM pages_content WHERE (pages_content.type = %s
-            AND pages_content.body =%s)
-            GROUP BY pages_content.page_id'''
-            
-        cursor = connection.cursor()
-        cursor.execute(sql, ('slug', slug, ))
-        return [c[0] for c in cursor.fetchall()]
+        return list(self.filter(type='slug',
+            body=slug).values_list('page', flat=True).distinct())
+
+class PageUrlManager(models.Manager):
+    """:class:`PageUrl <pages.models.PageUrl>` manager. Maintain the
+    denormalized url index used to resolve the pages paths."""
+
+    def get_url(self, page, language=None):
+        """Return the indexed url of a page or ``None`` if the page
+        has not been indexed in this language.
+
+        :param page: the concerned page object.
+        :param language: the wanted language.
+        """
+        if not language:
+            language = settings.PAGE_DEFAULT_LANGUAGE
+        urls = self.filter(page=page, language=language).values_list('url',
+            flat=True)
+        if len(urls):
+            return urls[0]
+        return None
+
+    def from_path(self, complete_path, lang, exclude_drafts=True):
+        """Return the :class:`Page <pages.models.Page>` indexed under the
+        given path or ``None``. Pages indexed in the given language are
+        preferred over the other ones.
+
+        :param complete_path: the complete path to the page.
+        :param lang: the wanted language.
+        :param exclude_drafts: ignore the pages with a draft status.
+        """
+        from pages.models import Page
+        if not lang:
+            lang = settings.PAGE_DEFAULT_LANGUAGE
+        urls = self.filter(url=complete_path.strip('/')).select_related('page')
+        if settings.PAGE_USE_SITE_ID:
+            urls = urls.filter(page__sites=settings.SITE_ID)
+        if exclude_drafts:
+            urls = urls.exclude(page__status=Page.DRAFT)
+        page = None
+        for page_url in urls:
+            if page_url.language == lang:
+                return page_url.page
+            if page is None:
+                page = page_url.page
+        return page
+
+    def prefetch_for_pages(self, pages, language=None):
+        """Load the urls of a list of pages with a single query and keep
+        them on the page objects for :meth:`Page.get_url
+        <pages.models.Page.get_url>`.
+
+        :param pages: a list of pages.
+        :param language: the wanted language.
+        """
+        from pages.models import Page
+        if not pages:
+            return
+        urls = dict(self.filter(page__in=[page.id for page in pages],
+            language=language or settings.PAGE_DEFAULT_LANGUAGE
+            ).values_list('page', 'url'))
+        first_root = None
+        if settings.PAGE_HIDE_ROOT_SLUG:
+            first_root = Page.objects.root()[0].id
+        for page in pages:
+            if page.id == first_root:
+                url = ''
+            else:
+                url = urls.get(page.id)
+            if url is not None:
+                if not hasattr(page, '_url_dict'):
+                    page._url_dict = {}
+                page._url_dict[language] = url
+
+    def get_slugs(self, **filters):
+        """Return the current slugs of the pages selected by the given
+        :class:`Content <pages.models.Content>` filters, as a dictionnary
+        of the form ``{page_id: {language: slug}}``."""
+        from pages.models import Content
+        slugs = {}
+        contents = Content.objects.filter(type='slug', current=True,
+            **filters).order_by('id').values_list('page', 'language', 'body')
+        for page_id, language, body in contents:
+            slugs.setdefault(page_id, {})[language] = body
+        return slugs
+
+    def index_page(self, page):
+        """Update the index entries of a page and of all its descendants.
+        This method should be called every time the path of a page
+        changes: new slug or move in the tree.
+
+        :param page: the concerned page object.
+        """
+        from pages.models import Page
+        # the given instance could be outdated if the tree has been
+        # modified since it has been fetched
+        page = Page.objects.get(pk=page.pk)
+        languages = [lang[0] for lang in settings.PAGE_LANGUAGES]
+        max_length = self.model._meta.get_field('url').max_length
+        ancestors = list(page.get_ancestors())
+        subtree = {
+            'page__tree_id': page.tree_id,
+            'page__lft__range': (page.lft, page.rght),
+        }
+        slugs = self.get_slugs(**subtree)
+        if ancestors:
+            slugs.update(self.get_slugs(
+                page__in=[ancestor.id for ancestor in ancestors]))
+
+        def get_slug(page_id, language):
+            # same fallback rules than ContentManager.get_content
+            page_slugs = slugs.get(page_id, {})
+            if page_slugs.get(language):
+                return page_slugs[language]
+            for lang in languages:
+                if page_slugs.get(lang):
+                    return page_slugs[lang]
+            return ''
+
+        def get_paths(page_id, parent_paths):
+            paths = {}
+            for lang in languages:
+                paths[lang] = parent_paths[lang] + get_slug(page_id, lang)
+            return paths
+
+        parent_paths = dict([(lang, u'') for lang in languages])
+        for ancestor in ancestors:
+            parent_paths = get_paths(ancestor.id, parent_paths)
+            for lang in languages:
+                parent_paths[lang] += u'/'
+
+        existing = {}
+        for page_url in self.filter(**subtree):
+            existing[(page_url.page_id, page_url.language)] = page_url
+
+        paths = {}
+        for node in page.get_descendants(include_self=True):
+            if node.id == page.id:
+                paths[node.id] = get_paths(node.id, parent_paths)
+            else:
+                paths[node.id] = get_paths(node.id, dict(
+                    [(lang, path + u'/') for (lang, path) in
+                    paths[node.parent_id].items()]))
+            for lang in languages:
+                url = paths[node.id][lang]
+                if len(url) > max_length:
+                    # too long to be indexed, the page will be resolved
+                    # by slug like the pages that are not indexed
+                    continue
+                page_url = existing.pop((node.id, lang), None)
+                if page_url and page_url.url == url:
+                    continue
+                if page_url is None:
+                    page_url = self.model(page=node, language=lang)
+                page_url.url = url
+                page_url.save()
+        # languages that are not used anymore and urls that became too long
+        if existing:
+            self.filter(pk__in=[page_url.pk for page_url in
+                existing.values()]).delete()
+        # the cached urls of the whole subtree are outdated
+        page.invalidate_tree()
+        if settings.PAGE_LINK_FILTER:
+            from pages.models import PageLink
+            PageLink.objects.update_dependents(paths.keys())
+
+    def rebuild(self):
+        """Rebuild the whole index from scratch."""
+        from pages.models import Page
+        self.all().delete()
+        for page in Page.objects.root():
+            self.index_page(page)
+
+class PageLinkManager(models.Manager):
+    """Manager of the :class:`PageLink <pages.models.PageLink>` table
+    and of the rendered body of the contents."""
+
+    def update_links(self, page_id, language):
+        """Resolve the page links of the current contents of a page in a
+        language, store the rendered bodies and the links of the page.
+
+        :param page_id: the id of the concerned page.
+        :param language: the concerned language.
+        """
+        from pages.models import Content, Page
+        contents = Content.objects.filter(page=page_id, language=language,
+            current=True).exclude(type__in=('title', 'slug'))
+        # the contents that have or had page links
+        contents = contents.filter(Q(body__contains='page_') |
+            Q(rendered__isnull=False))
+        links = {}
+        changed = False
+        for content_id, body, rendered in contents.values_list('id',
+                'body', 'rendered'):
+            new_rendered, targets = resolve_links(body, language)
+            if new_rendered != rendered:
+                Content.objects.filter(pk=content_id).update(
+                    rendered=new_rendered)
+                changed = True
+            links.update(targets)
+        self.filter(source=page_id, language=language).delete()
+        for target_id, broken in links.items():
+            self.create(source_id=page_id, target_id=target_id,
+                language=language, broken=broken)
+        if changed:
+            Page.objects.invalidate(page_id)
+
+    def update_dependents(self, page_ids):
+        """Resolve again the links of the pages that link to the given
+        pages. This method should be called every time the url of a page
+        changes or a page is deleted.
+
+        :param page_ids: the ids of the concerned pages.
+        """
+        page_ids = list(page_ids)
+        if not page_ids:
+            return
+        dependents = set(self.filter(target_id__in=page_ids).values_list(
+            'source', 'language'))
+        for page_id, language in dependents:
+            self.update_links(page_id, language)
+
+    def prefetch_broken_links(self, pages):
+        """Load the broken link flag of a list of pages with a single
+        query, see
+        :meth:`Page.has_broken_link <pages.models.Page.has_broken_link>`.
+        Return the list of pages.
+
+        :param pages: a list or a :class:`QuerySet` of pages.
+        """
+        pages = list(pages)
+        broken = set(self.filter(source__in=[page.id for page in pages],
+            broken=True).values_list('source', flat=True))
+        for page in pages:
+            page._broken_link = page.id in broken
+        return pages
+
+    def rebuild(self):
+        """Resolve the links of every page from scratch."""
+        from pages.models import Content
+        self.all().delete()
+        Content.objects.filter(current=False, rendered__isnull=False).update(
+            rendered=None)
+        for page_id, language in set(Content.objects.filter(current=True
+                ).values_list('page', 'language')):
+            self.update_links(page_id, language)
+
+class PagePermissionSet(object):
+    """The pages a user has rights on, as the ids of single pages and as
+    the ``(tree_id, lft, rght)`` bounds of the subtrees. A page belongs to
+    the set if it is one of the single pages or if it is inside one of the
+    subtrees, which is found by a binary search on the sorted bounds::
+
+        permission = PagePermission.objects.get_page_id_list(user)
+        if permission == 'All' or page in permission:
+            ...
+
+    :param page_ids: the ids of the single pages.
+    :param intervals: the ``(tree_id, lft, rght)`` bounds of the subtrees.
+    """
+
+    def __init__(self, page_ids=(), intervals=()):
+        self.page_ids = set(page_ids)
+        self.intervals = []
+        for interval in sorted(intervals):
+            # a subtree inside the previous one is useless
+            if (self.intervals and self.intervals[-1][0] == interval[0]
+                    and self.intervals[-1][2] >= interval[2]):
+                continue
+            self.intervals.append(interval)
+        self.starts = [(tree_id, lft) for (tree_id, lft, rght)
+            in self.intervals]
+
+    def contains_node(self, page_id, tree_id, lft):
+        """Return ``True`` if the page is in the set.
+
+        :param page_id: the id of the page.
+        :param tree_id: the tree of the page.
+        :param lft: the left bound of the page in its tree.
+        """
+        if page_id in self.page_ids:
+            return True
+        index = bisect.bisect_right(self.starts, (tree_id, lft)) - 1
+        if index < 0:
+            return False
+        interval = self.intervals[index]
+        return interval[0] == tree_id and lft <= interval[2]
+
+    def __contains__(self, page):
+        """``page`` is a page or a page id. A page id costs a query if it
+        isn't one of the single pages."""
+        from pages.models import Page
+        if isinstance(page, Page):
+            return self.contains_node(page.id, page.tree_id, page.lft)
+        if page in self.page_ids:
+            return True
+        node = Page.objects.filter(pk=page).values_list('tree_id', 'lft')
+        return bool(node) and self.contains_node(page, *node[0])
+
+    def filter(self, queryset):
+        """Restrict a :class:`QuerySet` of pages to the pages of the set.
+
+        :param queryset: a :class:`QuerySet` of pages.
+        """
+        queries = [Q(tree_id=tree_id, lft__gte=lft, rght__lte=rght)
+            for (tree_id, lft, rght) in self.intervals]
+        if self.page_ids:
+            queries.append(Q(pk__in=list(self.page_ids)))
+        if not queries:
+            return queryset.none()
+        return queryset.filter(reduce(operator.or_, queries))
+
+    def __iter__(self):
+        """Iterate over the ids of the pages of the set."""
+        from pages.models import Page
+        return iter(self.filter(Page.objects.all()).values_list('id',
+            flat=True))
 
 class PagePermissionManager(models.Manager):
     """Hierachic page permission manager."""
 
     def get_page_id_list(self, user):
-        """Give a list of :class:`Page <pages.models.Page>` ids where the
-        user has rights or the string
-        "All" if the user has all rights.
+        """Give a :class:`PagePermissionSet` of the pages where the user
+        has rights or the string "All" if the user has all rights.
+
+        The set of every user is cached until the permissions change or
+        a page is created, moved or deleted, see :meth:`invalidate`.
 
         :param user: the interested user.
         """
         if user.is_superuser:
             return 'All'
-        id_list = []
-        for perm in self.filter(user=user):
+        from pages.models import Page
+        keys = [self.model.PAGE_PERMISSION_GENERATION_KEY,
+            Page.PAGE_NAVIGATION_GENERATION_KEY]
+        generations = get_generations(keys)
+        key = '%s_%d_%d' % (self.model.PAGE_PERMISSION_KEY % user.id,
+            generations[keys[0]], generations[keys[1]])
+        permission = cache.get(key)
+        if permission is None:
+            permission = self.build_page_id_list(user)
+            cache.set(key, permission, GENERATION_TIMEOUT)
+        return permission
+
+    def build_page_id_list(self, user):
+        """Build the permission set of a user from the database, see
+        :meth:`get_page_id_list`.
+
+        :param user: the interested user.
+        """
+        page_ids, intervals = [], []
+        for perm in self.filter(user=user).select_related('page'):
             if perm.type == 0:
                 return "All"
-            if perm.page.id not in id_list:
-                id_list.append(perm.page.id)
+            if perm.page is None:
+                continue
             if perm.type == 2:
-                for page in perm.page.get_descendants():
-                    if page.id not in id_list:
-                        id_list.append(page.id)
-        return id_list
+                intervals.append((perm.page.tree_id, perm.page.lft,
+                    perm.page.rght))
+            else:
+                page_ids.append(perm.page.id)
+        return PagePermissionSet(page_ids, intervals)
+
+    def invalidate(self):
+        """Forget the cached permission sets of every user. The pages
+        being created, moved or deleted start a new generation of the
+        navigation, which invalidates the sets as well."""
+        incr_generation(self.model.PAGE_PERMISSION_GENERATION_KEY)
 
 class PageAliasManager(models.Manager):
     """:class:`PageAlias <pages.models.PageAlias>` manager."""
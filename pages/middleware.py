@@ -0,0 +1,17 @@
+"""Page CMS middlewares."""
+from pages.cache import start_identity_map, end_identity_map
+
+class IdentityMapMiddleware(object):
+    """Install an :class:`IdentityMap <pages.cache.IdentityMap>` of the
+    page lookups for every request. Without this middleware, the map is
+    only installed by the :func:`details <pages.views.details>` view."""
+
+    def process_request(self, request):
+        start_identity_map()
+
+    def process_response(self, request, response):
+        end_identity_map()
+        return response
+
+    def process_exception(self, request, exception):
+        end_identity_map()
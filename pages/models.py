@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 """Django page CMS ``models``."""
 from datetime import datetime
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 import mptt
-from pages.utils import get_placeholders, normalize_url
+from pages.utils import normalize_url, make_delta
 from pages.managers import PageManager, ContentManager
 from pages.managers import PagePermissionManager, PageAliasManager
+from pages.managers import PagePermissionSet
+from pages.managers import PageUrlManager, PageLinkManager
+from pages.cache import page_cache, get_identity_map, incr_generation
+from pages.purge import purge_pages
+from pages.search import update_index, unindex_contents
+from pages.navigation import NAVIGATION_FIELDS
 from pages import settings
 
 class Page(models.Model):
@@ -56,8 +62,15 @@ class Page(models.Model):
     PAGE_URL_KEY = "page_%d_language_%s_url"
     #PAGE_TEMPLATE_KEY = "page_%d_template"
     #PAGE_CHILDREN_KEY = "page_children_%d_%d"
-    PAGE_CONTENT_DICT_KEY = "page_content_dict_%d_%s"
-    PAGE_BROKEN_LINK_KEY = "page_broken_link_%s"
+    PAGE_CONTENT_DICT_KEY = "page_content_dict_%d"
+    PAGE_ANCESTORS_KEY = "page_%d_ancestors"
+    # generation counters, see get_cache_key
+    PAGE_GENERATION_KEY = "page_%d_generation"
+    PAGE_TREE_GENERATION_KEY = "page_tree_%d_generation"
+    PAGE_NAVIGATION_GENERATION_KEY = "page_navigation_generation"
+    PAGE_NAVIGATION_DATE_KEY = "page_navigation_date"
+    # the keys that depend on the ancestors of the page
+    PAGE_TREE_KEYS = (PAGE_URL_KEY, PAGE_ANCESTORS_KEY)
 
     author = models.ForeignKey(User, verbose_name=_('author'))
     
@@ -77,6 +90,9 @@ class Page(models.Model):
     status = models.IntegerField(_('status'), choices=STATUSES, default=DRAFT)
     template = models.CharField(_('template'), max_length=100, null=True,
             blank=True)
+    # the template of the page or of its closer parent, empty if none
+    effective_template = models.CharField(_('effective template'),
+            max_length=100, null=True, blank=True, editable=False)
     
     # Disable could make site tests fail
     sites = models.ManyToManyField(Site, default=[settings.SITE_ID], 
@@ -115,9 +131,46 @@ class Page(models.Model):
             else:
                 self.publication_date = None
         self.last_modification_date = datetime.now()
-        # let's assume there is no more broken links after a save
-        cache.delete(self.PAGE_BROKEN_LINK_KEY % self.id)
+        created = self.id is None
+        previous = None
+        if not created:
+            previous = Page.objects.filter(pk=self.id).values_list(
+                'parent', *NAVIGATION_FIELDS)
+            previous = previous and previous[0] or None
+        self.effective_template = (self.template or
+            Page.objects.get_effective_template(self.parent_id))
+        navigation = tuple([getattr(self, name)
+            for name in NAVIGATION_FIELDS])
         super(Page, self).save(*args, **kwargs)
+        if created:
+            Page.objects.invalidate_navigation()
+        elif previous is None or navigation != previous[1:]:
+            Page.objects.invalidate_navigation(self)
+        if previous is not None and previous[0] != self.parent_id:
+            # mptt has moved the page under its new parent
+            self.update_tree_data()
+        elif (previous is not None and
+                previous[-1] != self.effective_template):
+            # the descendants inherit the template
+            Page.objects.update_templates(self)
+
+    def delete(self, *args, **kwargs):
+        """Override the default ``delete`` method to resolve again the
+        links to the deleted pages and to remove their contents from the
+        search index."""
+        page_ids = [page.id for page in
+            self.get_descendants(include_self=True)]
+        content_ids = []
+        if settings.PAGE_SEARCH_INDEX:
+            content_ids = list(Content.objects.filter(page__in=page_ids,
+                current=True).values_list('id', flat=True))
+        super(Page, self).delete(*args, **kwargs)
+        if content_ids:
+            unindex_contents(content_ids)
+        Page.objects.invalidate_navigation()
+        purge_pages(page_ids)
+        if settings.PAGE_LINK_FILTER:
+            PageLink.objects.update_dependents(page_ids)
 
     def _get_calculated_status(self):
         """Get the calculated status of the page based on
@@ -136,48 +189,98 @@ class Page(models.Model):
     calculated_status = property(_get_calculated_status)
 
     def get_children_for_frontend(self):
-        """Return a :class:`QuerySet` of published children page"""
+        """Return a :class:`QuerySet` of published children page, or the
+        list of the children loaded by
+        :meth:`PageManager.prefetch_children_for_frontend
+        <pages.managers.PageManager.prefetch_children_for_frontend>`."""
+        if '_children_for_frontend' in self.__dict__:
+            return self._children_for_frontend
         return Page.objects.filter_published(self.get_children())
 
-    def invalidate(self):
-        """Invalidate cached data for this page."""
-
-        cache.delete(self.PAGE_LANGUAGES_KEY % (self.id))
-        #cache.delete(self.PAGE_TEMPLATE_KEY % (self.id))
-
-        p_names = [p.name for p in get_placeholders(self.get_template())]
-        if 'slug' not in p_names:
-            p_names.append('slug')
-        if 'title' not in p_names:
-            p_names.append('title')
-        for name in p_names:
-            cache.delete(self.PAGE_CONTENT_DICT_KEY % (self.id, name))
+    def get_cache_key(self, key, *args):
+        """Return the cache key ``key`` of this page. The key is namespaced
+        by the generation of the page and, for the
+        :attr:`PAGE_TREE_KEYS`, by the generation of the page tree.
 
-        for lang in settings.PAGE_LANGUAGES:
-            cache.delete(self.PAGE_URL_KEY % (self.id, lang[0]))
-        cache.delete(self.PAGE_URL_KEY % (self.id, "None"))
+        :param key: one of the ``PAGE_*_KEY`` constants.
+        :param args: the other arguments of the key.
+        """
+        return Page.objects.get_cache_keys([self], key, *args)[self.id]
 
+    def invalidate(self):
+        """Invalidate cached data for this page by starting a new
+        generation of its cache keys."""
+        Page.objects.invalidate(self.id)
+        # prefetched data
+        for attribute in ('_content_dict', '_content_types', '_url_dict',
+                '_children_for_frontend', '_ancestors'):
+            if attribute in self.__dict__:
+                delattr(self, attribute)
+
+    def update_tree_data(self):
+        """Update the data that depend on the position of the page in the
+        tree: the indexed urls and the inherited templates of the page and
+        of its descendants. This is done every time the page is moved."""
+        PageUrl.objects.index_page(self)
+        Page.objects.update_templates(self)
+
+    def invalidate_tree(self):
+        """Invalidate the cached urls of every page of the tree of this
+        page by starting a new generation of the tree. This has to be done
+        every time the path of a page changes."""
+        incr_generation(self.PAGE_TREE_GENERATION_KEY % self.tree_id)
+        Page.objects.invalidate_navigation()
+        # the responses of the descendants are tagged with this page
+        purge_pages([self.id])
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.clear()
+        if '_url_dict' in self.__dict__:
+            del self._url_dict
+
+    def get_cached_ancestors(self):
+        """Return the ancestors of the page, the root first, as page
+        objects carrying their slugs, titles and urls. The ancestors are
+        cached until the tree of the page changes, see
+        :meth:`PageManager.get_ancestor_rows
+        <pages.managers.PageManager.get_ancestor_rows>`."""
+        if '_ancestors' in self.__dict__:
+            return self._ancestors
+        if self.parent_id is None:
+            rows = []
+        else:
+            key = self.get_cache_key(self.PAGE_ANCESTORS_KEY)
+            rows = page_cache.get(key)
+            if rows is None:
+                rows = Page.objects.get_ancestor_rows(self)
+                page_cache.set(key, rows)
+        self._ancestors = Page.objects.from_ancestor_rows(rows)
+        return self._ancestors
 
     def get_languages(self):
         """
         Return a list of all used languages for this page.
         """
-        languages = cache.get(self.PAGE_LANGUAGES_KEY % (self.id))
+        key = self.get_cache_key(self.PAGE_LANGUAGES_KEY)
+        languages = page_cache.get(key)
         if languages:
             return languages
 
         languages = [c['language'] for
                             c in Content.objects.filter(page=self,
-                            type="slug").values('language')]
+                            type="slug", current=True).values('language')]
         languages = list(set(languages)) # remove duplicates
         languages.sort()
-        cache.set(self.PAGE_LANGUAGES_KEY % (self.id), languages)
+        page_cache.set(key, languages)
         return languages
 
     def is_first_root(self):
         """Return ``True`` if the page is the first root page."""
-        if self.parent:
+        if self.parent_id:
             return False
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            return identity_map.get_first_root_id() == self.id
         return Page.objects.root()[0].id == self.id
 
     def get_absolute_url(self, language=None):
@@ -193,17 +296,23 @@ class Page(models.Model):
 
     def get_url(self, language=None):
         """Return url of this page, adding all parent's slug."""
-        url = cache.get(self.PAGE_URL_KEY % (self.id, language))
+        if language in getattr(self, '_url_dict', {}):
+            # the url has been prefetched
+            return self._url_dict[language]
+        key = self.get_cache_key(self.PAGE_URL_KEY, language)
+        url = page_cache.get(key)
         if url:
             return url
         if settings.PAGE_HIDE_ROOT_SLUG and self.is_first_root():
             url = ''
         else:
-            url = u'%s' % self.slug(language)
-        for ancestor in self.get_ancestors(ascending=True):
-            url = ancestor.slug(language) + u'/' + url
+            url = PageUrl.objects.get_url(self, language)
+        if url is None:
+            # the page has not been indexed yet
+            url = u'/'.join([ancestor.slug(language) for ancestor in
+                self.get_cached_ancestors()] + [self.slug(language)])
 
-        cache.set(self.PAGE_URL_KEY % (self.id, language), url)
+        page_cache.set(key, url)
         
         return url
 
@@ -244,6 +353,11 @@ class Page(models.Model):
         if self.template:
             return self.template
 
+        if self.effective_template is not None:
+            return self.effective_template or settings.DEFAULT_PAGE_TEMPLATE
+
+        # the effective template hasn't been computed yet, see
+        # PageManager.update_templates
         template = None
         for p in self.get_ancestors(ascending=True):
             if p.template:
@@ -278,31 +392,37 @@ class Page(models.Model):
             permission = PagePermission.objects.get_page_id_list(request.user)
             if permission == "All":
                 return True
-            if self.id in permission:
-                return True
-            return False
+            return self in permission
 
     def has_broken_link(self):
         """
         Return ``True`` if the page have broken links to other pages
         into the content.
         """
-        return cache.get(self.PAGE_BROKEN_LINK_KEY % self.id)
+        if not settings.PAGE_LINK_FILTER:
+            return False
+        if hasattr(self, '_broken_link'):
+            # the flag has been prefetched
+            return self._broken_link
+        return PageLink.objects.filter(source=self, broken=True).count() > 0
 
     def valid_targets(self, perms="All"):
         """Return a :class:`QuerySet` of valid targets for moving a page
         into the tree.
 
-        :param perms: the level of permission of the concerned user.
+        :param perms: the level of permission of the concerned user, as
+            returned by :meth:`PagePermissionManager.get_page_id_list
+            <pages.managers.PagePermissionManager.get_page_id_list>`.
         """
-        exclude_list = [self.id]
-        for p in self.get_descendants():
-            exclude_list.append(p.id)
-        if perms != "All":
-            return Page.objects.filter(id__in=perms).exclude(
-                                                id__in=exclude_list)
+        if perms == "All":
+            targets = Page.objects.all()
+        elif isinstance(perms, PagePermissionSet):
+            targets = perms.filter(Page.objects.all())
         else:
-            return Page.objects.exclude(id__in=exclude_list)
+            targets = Page.objects.filter(id__in=perms)
+        # the page and its descendants
+        return targets.exclude(tree_id=self.tree_id, lft__gte=self.lft,
+            rght__lte=self.rght)
 
     def slug_with_level(self, language=None):
         """Display the slug of the page prepended with insecable
@@ -329,6 +449,21 @@ try:
 except mptt.AlreadyRegistered:
     pass
 
+def move_to(page, target, position='first-child'):
+    """Move the page in the tree, then update the data that depend on its
+    position.
+
+    :param target: the page used as a reference for the move.
+    :param position: ``first-child``, ``last-child``, ``left`` or
+        ``right``.
+    """
+    page.invalidate()
+    page._tree_manager.move_node(page, target, position)
+    page.update_tree_data()
+
+# replace the move_to method installed by mptt.register
+Page.move_to = move_to
+
 if settings.PAGE_PERMISSION:
     class PagePermission(models.Model):
         """
@@ -344,6 +479,9 @@ if settings.PAGE_PERMISSION:
         user = models.ForeignKey(User, verbose_name=_('user'))
         type = models.IntegerField(_('type'), choices=TYPES, default=0)
 
+        PAGE_PERMISSION_KEY = "page_permission_%d"
+        PAGE_PERMISSION_GENERATION_KEY = "page_permission_generation"
+
         objects = PagePermissionManager()
 
         class Meta:
@@ -354,6 +492,13 @@ if settings.PAGE_PERMISSION:
             return "%s :: %s" % (self.user,
                     unicode(PagePermission.TYPES[self.type][1]))
 
+    def invalidate_permissions(sender, **kwargs):
+        """Forget the cached permission sets of the users."""
+        PagePermission.objects.invalidate()
+    # the signals are sent by the bulk deletions of the admin as well
+    post_save.connect(invalidate_permissions, sender=PagePermission)
+    post_delete.connect(invalidate_permissions, sender=PagePermission)
+
 
 class Content(models.Model):
     """A block of content, tied to a :class:`Page <pages.models.Page>`,
@@ -367,6 +512,15 @@ class Content(models.Model):
 
     creation_date = models.DateTimeField(_('creation date'), editable=False,
             default=datetime.now)
+    # the latest revision of a (page, language, type) content; not
+    # indexed: the databases would prefer this index to the page one
+    current = models.BooleanField(_('current'), editable=False,
+            default=True)
+    # the body is a delta with the next revision, see make_delta
+    delta = models.BooleanField(_('delta'), editable=False, default=False)
+    # the body with the page links resolved, see PageLinkManager
+    rendered = models.TextField(_('rendered body'), editable=False,
+            null=True)
     objects = ContentManager()
 
     class Meta:
@@ -374,6 +528,88 @@ class Content(models.Model):
         verbose_name = _('content')
         verbose_name_plural = _('contents')
 
+    def save(self, *args, **kwargs):
+        """Override the default ``save`` method to make a new content the
+        current revision and to keep the page content cache, the links, the
+        url index and the search index up to date."""
+        created = self.id is None
+        if created:
+            self.current = True
+        else:
+            self.expand_previous_revision()
+        super(Content, self).save(*args, **kwargs)
+        if created:
+            previous = Content.objects.filter(page=self.page_id,
+                language=self.language, type=self.type,
+                current=True).exclude(pk=self.id)
+            if settings.PAGE_CONTENT_REVISION_DELTA:
+                for revision in previous.filter(delta=False):
+                    delta = make_delta(self.body, revision.body)
+                    if delta is not None:
+                        Content.objects.filter(pk=revision.pk).update(
+                            body=delta, delta=True)
+            replaced_ids = []
+            if settings.PAGE_SEARCH_INDEX:
+                replaced_ids = list(previous.values_list('id', flat=True))
+            # only the current revision keeps a rendered body
+            previous.update(current=False, rendered=None)
+        if settings.PAGE_SEARCH_INDEX:
+            update_index(self, created and replaced_ids or ())
+        if settings.PAGE_LINK_FILTER and self.type not in ('title', 'slug'):
+            PageLink.objects.update_links(self.page_id, self.language)
+        # the Last-Modified date of the page follows its contents
+        Page.objects.filter(pk=self.page_id).update(
+            last_modification_date=datetime.now())
+        Page.objects.invalidate(self.page_id)
+        if self.type == 'title':
+            Page.objects.invalidate_navigation(self.page)
+            # the descendants keep the titles of their ancestors
+            incr_generation(Page.PAGE_TREE_GENERATION_KEY % self.page.tree_id)
+        if self.type == 'slug':
+            PageUrl.objects.index_page(self.page)
+    save = transaction.commit_on_success(save)
+
+    def delete(self):
+        """Override the default ``delete`` method to keep the current
+        revision, the page content cache, the links, the url index and the
+        search index up to date."""
+        previous = self.expand_previous_revision()
+        content_id = self.id
+        super(Content, self).delete()
+        if self.current and previous:
+            # the previous revision becomes the current one
+            Content.objects.filter(pk=previous.pk).update(current=True)
+        if settings.PAGE_SEARCH_INDEX:
+            unindex_contents([content_id])
+            if self.current and previous:
+                previous.current = True
+                update_index(previous)
+        if settings.PAGE_LINK_FILTER and self.type not in ('title', 'slug'):
+            PageLink.objects.update_links(self.page_id, self.language)
+        # the Last-Modified date of the page follows its contents
+        Page.objects.filter(pk=self.page_id).update(
+            last_modification_date=datetime.now())
+        Page.objects.invalidate(self.page_id)
+        if self.type == 'title':
+            Page.objects.invalidate_navigation(self.page)
+            # the descendants keep the titles of their ancestors
+            incr_generation(Page.PAGE_TREE_GENERATION_KEY % self.page.tree_id)
+        if self.type == 'slug':
+            PageUrl.objects.index_page(self.page)
+    delete = transaction.commit_on_success(delete)
+
+    def expand_previous_revision(self):
+        """Store the previous revision in full if it is a delta with the
+        body this revision has in the database. Return the previous
+        revision."""
+        previous = Content.objects.get_previous_revision(self)
+        if previous and previous.delta:
+            previous.body = Content.objects.get_revision_body(previous)
+            previous.delta = False
+            Content.objects.filter(pk=previous.pk).update(
+                body=previous.body, delta=False)
+        return previous
+
     def __unicode__(self):
         return "%s :: %s" % (self.page.slug(), self.body[0:15])
 
@@ -394,3 +630,91 @@ class PageAlias(models.Model):
     def __unicode__(self):
         return "%s => %s" % (self.url, self.page.get_url())
 
+
+
+class PageUrl(models.Model):
+    """Denormalized full url of a :class:`Page <pages.models.Page>` for
+    a particular language. This index is maintained by the
+    :class:`PageUrlManager <pages.managers.PageUrlManager>` and can be
+    rebuilt with the ``rebuild_page_urls`` command."""
+    page = models.ForeignKey(Page, related_name='urls',
+            verbose_name=_('page'))
+    language = models.CharField(_('language'), max_length=5)
+    url = models.CharField(_('url'), max_length=255, db_index=True)
+    objects = PageUrlManager()
+
+    class Meta:
+        unique_together = ('page', 'language')
+        verbose_name = _('page url')
+        verbose_name_plural = _('page urls')
+
+    def __unicode__(self):
+        return "%s :: %s" % (self.language, self.url)
+
+
+class PageLink(models.Model):
+    """A link from the content of a :class:`Page <pages.models.Page>` to
+    another page, for a particular language. The links are resolved when
+    the content is saved by the
+    :class:`PageLinkManager <pages.managers.PageLinkManager>`, and
+    resolved again when the target page is moved, renamed or deleted. The
+    table can be rebuilt with the ``rebuild_page_links`` command."""
+    source = models.ForeignKey(Page, related_name='links',
+            verbose_name=_('source page'))
+    # not a foreign key: the link outlives the deletion of the target
+    target_id = models.PositiveIntegerField(_('target page id'),
+            db_index=True)
+    language = models.CharField(_('language'), max_length=5)
+    broken = models.BooleanField(_('broken'), default=False)
+    objects = PageLinkManager()
+
+    class Meta:
+        verbose_name = _('page link')
+        verbose_name_plural = _('page links')
+
+    def __unicode__(self):
+        return "%s :: %s => %d" % (self.language, self.source_id,
+            self.target_id)
+
+
+class ContentTerm(models.Model):
+    """A term of the current revision of a
+    :class:`Content <pages.models.Content>`, with the number of times it
+    appears. This index is used by the page search when the database has
+    no full-text search, see :mod:`pages.search`, and can be rebuilt with
+    the ``rebuild_search_index`` command."""
+    content = models.ForeignKey(Content, related_name='terms',
+            verbose_name=_('content'))
+    page = models.ForeignKey(Page, verbose_name=_('page'))
+    language = models.CharField(_('language'), max_length=5)
+    term = models.CharField(_('term'), max_length=50, db_index=True)
+    count = models.PositiveIntegerField(_('count'), default=1)
+
+    class Meta:
+        verbose_name = _('content term')
+        verbose_name_plural = _('content terms')
+
+    def __unicode__(self):
+        return "%s :: %s" % (self.language, self.term)
+
+class ArchivedContent(models.Model):
+    """The position of a pruned revision in the archive file, see
+    :meth:`ContentManager.prune_revisions
+    <pages.managers.ContentManager.prune_revisions>`. Every revision is a
+    gzip member of its own, so it is read without decompressing the rest of
+    the archive."""
+    content_id = models.IntegerField(_('content id'), unique=True)
+    page_id = models.IntegerField(_('page id'), db_index=True)
+    language = models.CharField(_('language'), max_length=5)
+    type = models.CharField(_('type'), max_length=100)
+    creation_date = models.DateTimeField(_('creation date'))
+    archive = models.CharField(_('archive'), max_length=255)
+    offset = models.PositiveIntegerField(_('offset'))
+    size = models.PositiveIntegerField(_('size'))
+
+    class Meta:
+        verbose_name = _('archived content')
+        verbose_name_plural = _('archived contents')
+
+    def __unicode__(self):
+        return "%s :: %s" % (self.archive, self.content_id)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Snapshot of the navigation of a site in a language.
+
+The pages displayed by the menus, with their tree position, publication
+state, title, slug and url, are stored in the cache as a list of rows in
+tree order, one snapshot per site and language. A snapshot is valid for a
+generation of the navigation, see :meth:`PageManager.invalidate_navigation
+<pages.managers.PageManager.invalidate_navigation>`: a new title or a new
+publication state of a page patches the snapshots of the previous
+generation, any other modification of the navigation makes the next
+request rebuild them with three queries.
+
+The :class:`Navigation` of a request turns a snapshot into page objects
+linked to their published children, read by the menu tags without any
+query."""
+import cPickle as pickle
+from datetime import datetime
+from django.core.cache import cache
+
+from pages import settings
+from pages.cache import get_generations, get_identity_map
+from pages.cache import GENERATION_TIMEOUT
+from pages.schedule import get_timeout
+
+NAVIGATION_SNAPSHOT_KEY = "page_navigation_rows_%d_%s"
+# the fields of a page that patch the snapshots when they change, see
+# Page.save, the effective template last
+NAVIGATION_FIELDS = ('status', 'publication_date', 'publication_end_date',
+    'author_id', 'template', 'redirect_to_id', 'redirect_to_url',
+    'effective_template')
+# the fields of a page stored in the snapshots
+SNAPSHOT_FIELDS = ('id', 'parent_id', 'tree_id', 'lft', 'rght', 'level',
+    'creation_date', 'last_modification_date') + NAVIGATION_FIELDS
+
+def get_snapshot_key(site_id, lang):
+    """Return the cache key of the snapshot of a site in a language."""
+    return NAVIGATION_SNAPSHOT_KEY % (site_id, lang)
+
+def get_contents(content_dict, lang):
+    """Return the body of a content type in a language, or in the first
+    language that has one, as a ``{language: body}`` dictionnary."""
+    if content_dict.get(lang):
+        return {lang: content_dict[lang]}
+    for language, name in settings.PAGE_LANGUAGES:
+        if content_dict.get(language):
+            return {language: content_dict[language]}
+    return {}
+
+def get_row(page, content_dict, url, lang):
+    """Return the snapshot row of a page: the values of the
+    :data:`SNAPSHOT_FIELDS` followed by the slug, the title and the url.
+    """
+    return tuple([getattr(page, name) for name in SNAPSHOT_FIELDS]) + (
+        get_contents(content_dict.get('slug', {}), lang),
+        get_contents(content_dict.get('title', {}), lang), url)
+
+def build_snapshot(site_id, lang):
+    """Return the rows of the published pages of a site in a language,
+    in tree order.
+
+    :param site_id: the id of the site.
+    :param lang: the language of the titles, slugs and urls.
+    """
+    from pages.models import Page, Content, PageUrl
+    pages = Page.objects.filter(status=Page.PUBLISHED)
+    if settings.PAGE_USE_SITE_ID:
+        pages = pages.filter(sites=site_id)
+    pages = list(pages.order_by('tree_id', 'lft'))
+    content_dicts = Content.objects.load_content_dicts(
+        [page.id for page in pages], ('slug', 'title'))
+    PageUrl.objects.prefetch_for_pages(pages, lang)
+    return [get_row(page, content_dicts[page.id], page.get_url(lang), lang)
+        for page in pages]
+
+def get_size(snapshot):
+    """Return the size in bytes of a serialized snapshot."""
+    return len(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+
+def store_snapshot(site_id, lang, snapshot):
+    """Store a snapshot in the cache. A snapshot larger than
+    ``PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE`` is replaced by a marker so the
+    menus are loaded from the database without trying to build it again
+    for this generation. The snapshot expires with the next publication
+    transition."""
+    if get_size(snapshot) > settings.PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE:
+        snapshot = {'generation': snapshot['generation'], 'pages': None}
+    cache.set(get_snapshot_key(site_id, lang), snapshot,
+        get_timeout(GENERATION_TIMEOUT))
+    return snapshot
+
+def get_snapshot(site_id, lang):
+    """Return the snapshot of the current generation of the navigation,
+    built if needed.
+
+    :param site_id: the id of the site.
+    :param lang: the language of the titles, slugs and urls.
+    """
+    from pages.models import Page
+    key = Page.PAGE_NAVIGATION_GENERATION_KEY
+    generation = get_generations([key])[key]
+    snapshot = cache.get(get_snapshot_key(site_id, lang))
+    if snapshot is None or snapshot['generation'] != generation:
+        snapshot = store_snapshot(site_id, lang, {'generation': generation,
+            'pages': build_snapshot(site_id, lang)})
+    return snapshot
+
+def update_snapshots(page, generation):
+    """Patch the snapshots of the previous generation of the navigation
+    after a new title or a new publication state of a page, and store
+    them under the new generation. A snapshot that can't be patched is
+    left to the next request.
+
+    :param page: the modified page.
+    :param generation: the new generation of the navigation.
+    """
+    from django.contrib.sites.models import Site
+    from pages.models import Page, Content
+    if settings.PAGE_USE_SITE_ID:
+        site_ids = page.sites.values_list('id', flat=True)
+    else:
+        site_ids = Site.objects.values_list('id', flat=True)
+    languages = [code for (code, name) in settings.PAGE_LANGUAGES]
+    keys = dict([(get_snapshot_key(site_id, lang), (site_id, lang))
+        for site_id in site_ids for lang in languages])
+    published = page.status == Page.PUBLISHED
+    content_dict = None
+    for key, snapshot in cache.get_many(keys.keys()).items():
+        if (snapshot['generation'] != generation - 1
+                or snapshot['pages'] is None):
+            continue
+        site_id, lang = keys[key]
+        rows = list(snapshot['pages'])
+        page_ids = [row[0] for row in rows]
+        if page.id not in page_ids:
+            if published:
+                # the page has to be inserted in the tree
+                continue
+            store_snapshot(site_id, lang, {'generation': generation,
+                'pages': rows})
+            continue
+        index = page_ids.index(page.id)
+        if published:
+            if content_dict is None:
+                content_dict = Content.objects.load_content_dicts([page.id],
+                    ('slug', 'title'))[page.id]
+            rows[index] = get_row(page, content_dict, rows[index][-1], lang)
+        else:
+            del rows[index]
+        store_snapshot(site_id, lang, {'generation': generation,
+            'pages': rows})
+
+class Navigation(object):
+    """The pages of a snapshot as page objects carrying their content,
+    their url and their published children, see
+    :meth:`Page.get_children_for_frontend
+    <pages.models.Page.get_children_for_frontend>`. The ``roots`` are the
+    published root pages, like :meth:`PageManager.navigation
+    <pages.managers.PageManager.navigation>`, and ``pages`` are the pages
+    by id.
+
+    The page objects are not loaded from the database but they carry every
+    field of the page except the tags. The ``last_modification_date`` is
+    the one of the last modification of the navigation: the new contents
+    of a page don't update it."""
+
+    def __init__(self, rows, lang):
+        from pages.models import Page
+        now = datetime.now()
+        self.roots = []
+        self.pages = {}
+        for row in rows:
+            fields = dict(zip(SNAPSHOT_FIELDS, row[:-3]))
+            slugs, titles, url = row[-3:]
+            page_id, parent_id = fields['id'], fields['parent_id']
+            if parent_id is None:
+                parent = None
+            else:
+                parent = self.pages.get(parent_id)
+                # the descendants of an unpublished page are not displayed
+                if parent is None:
+                    continue
+                publication_date = fields['publication_date']
+                if (settings.PAGE_SHOW_START_DATE and (publication_date is
+                        None or publication_date > now)):
+                    continue
+                publication_end_date = fields['publication_end_date']
+                if (settings.PAGE_SHOW_END_DATE and publication_end_date
+                        and publication_end_date <= now):
+                    continue
+            page = Page(**fields)
+            page._content_dict = {'slug': slugs, 'title': titles}
+            page._content_types = ('slug', 'title')
+            page._url_dict = {lang: url}
+            page._children_for_frontend = []
+            if parent is None:
+                self.roots.append(page)
+            else:
+                parent._children_for_frontend.append(page)
+            self.pages[page_id] = page
+
+    def get_root(self, page_id):
+        """Return the root page of the page ``page_id``, or ``None`` if
+        the page is not in the navigation."""
+        page = self.pages.get(page_id)
+        while page is not None and page.parent_id is not None:
+            page = self.pages[page.parent_id]
+        return page
+
+def get_navigation(lang, site_id=None):
+    """Return the :class:`Navigation` of a site in a language for the
+    current request, or ``None`` if ``PAGE_NAVIGATION_SNAPSHOT`` is not
+    enabled or the snapshot is too large.
+
+    :param lang: the language of the navigation.
+    :param site_id: the id of the site, defaults to ``SITE_ID``.
+    """
+    if not settings.PAGE_NAVIGATION_SNAPSHOT:
+        return None
+    site_id = site_id or settings.SITE_ID
+    identity_map = get_identity_map()
+    if identity_map is not None and (site_id, lang) in identity_map.navigations:
+        return identity_map.navigations[(site_id, lang)]
+    snapshot = get_snapshot(site_id, lang)
+    navigation = None
+    if snapshot['pages'] is not None:
+        navigation = Navigation(snapshot['pages'], lang)
+    if identity_map is not None:
+        identity_map.navigations[(site_id, lang)] = navigation
+    return navigation
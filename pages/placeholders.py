@@ -8,6 +8,7 @@ from django.utils.safestring import SafeUnicode, mark_safe
 
 from pages import settings
 from pages.models import Content, Page
+from pages.cache import template_cache
 from inspect import isclass, getmembers
 import os
 import time
@@ -101,6 +102,11 @@ class PlaceholderNode(template.Node):
 
     def save(self, page, language, data, change):
         """Actually save the placeholder data into the Content object."""
+        if self.parsed and settings.PAGE_PARSED_PRECOMPILE and data:
+            try:
+                template_cache.get_template(data, self.name)
+            except TemplateSyntaxError:
+                pass
         # the page is being changed
         if change:
             # we need create a new content if revision is enabled
@@ -143,7 +149,7 @@ class PlaceholderNode(template.Node):
             return ''
         if self.parsed:
             try:
-                t = template.Template(content, name=self.name)
+                t = template_cache.get_template(content, self.name)
                 content = mark_safe(t.render(context))
             except template.TemplateSyntaxError, error:
                 if global_settings.DEBUG:
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Surrogate keys of the page responses and purge backends for the caching
+proxies.
+
+The responses of the ``details`` view are tagged with the keys of the pages
+they depend on: the displayed page, its ancestors, the other pages whose
+content is displayed, the linked pages and the navigation. When a page is
+modified, its keys are handed to the purge backend set with
+``PAGE_PURGE_BACKEND``, which purges every tagged response from the
+proxy."""
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from pages import settings
+
+PAGE_SURROGATE_KEY = "page-%d"
+NAVIGATION_SURROGATE_KEY = "page-navigation"
+
+def get_surrogate_keys(page, lang, page_ids=()):
+    """Return the surrogate keys of a response displaying a page.
+
+    :param page: the displayed page.
+    :param lang: the language of the response.
+    :param page_ids: the ids of the other pages displayed by the response.
+    """
+    ids = set(page_ids)
+    ids.add(page.id)
+    if page.parent_id:
+        ids.update(page.get_ancestors().values_list('id', flat=True))
+    if settings.PAGE_LINK_FILTER:
+        from pages.models import PageLink
+        ids.update(PageLink.objects.filter(source__in=ids,
+            language=lang).values_list('target_id', flat=True))
+    keys = [PAGE_SURROGATE_KEY % page_id for page_id in sorted(ids)]
+    keys.append(NAVIGATION_SURROGATE_KEY)
+    return keys
+
+class BasePurgeBackend(object):
+    """Base class of the purge backends."""
+
+    def purge(self, keys):
+        """Purge the responses tagged with any of the keys.
+
+        :param keys: a list of surrogate keys.
+        """
+        raise NotImplementedError
+
+class FilePurgeBackend(BasePurgeBackend):
+    """Append the keys to the file ``PAGE_PURGE_FILE``, one line per
+    purge. The file can be consumed by a worker purging the proxy."""
+
+    def purge(self, keys):
+        if not settings.PAGE_PURGE_FILE:
+            raise ImproperlyConfigured('PAGE_PURGE_FILE is not set')
+        purge_file = open(settings.PAGE_PURGE_FILE, 'a')
+        try:
+            purge_file.write(' '.join(keys) + '\n')
+        finally:
+            purge_file.close()
+
+class LocMemPurgeBackend(BasePurgeBackend):
+    """Keep the keys in a queue in memory. Useful for the tests."""
+
+    def __init__(self):
+        self.queue = []
+
+    def purge(self, keys):
+        self.queue.append(list(keys))
+
+    def pop_keys(self):
+        """Empty the queue and return the set of the purged keys."""
+        keys = set()
+        while self.queue:
+            keys.update(self.queue.pop(0))
+        return keys
+
+_backends = {}
+
+def get_purge_backend():
+    """Return the instance of the backend set with ``PAGE_PURGE_BACKEND``,
+    or ``None``."""
+    path = settings.PAGE_PURGE_BACKEND
+    if not path:
+        return None
+    if path not in _backends:
+        try:
+            module, name = path.rsplit('.', 1)
+            backend_class = getattr(import_module(module), name)
+        except (ImportError, AttributeError, ValueError), e:
+            raise ImproperlyConfigured(
+                'Error loading the purge backend %s: "%s"' % (path, e))
+        _backends[path] = backend_class()
+    return _backends[path]
+
+def purge_pages(page_ids):
+    """Purge the responses depending on the pages.
+
+    :param page_ids: a list of page ids.
+    """
+    backend = get_purge_backend()
+    if backend is not None and page_ids:
+        backend.purge([PAGE_SURROGATE_KEY % page_id for page_id in page_ids])
+
+def purge_navigation():
+    """Purge the responses displaying the navigation."""
+    backend = get_purge_backend()
+    if backend is not None:
+        backend.purge([NAVIGATION_SURROGATE_KEY])
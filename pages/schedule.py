@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Schedule of the publication transitions.
+
+With ``PAGE_SHOW_START_DATE`` or ``PAGE_SHOW_END_DATE``, a page appears
+or disappears at a date without any modification in the database. The
+upcoming dates are kept in the cache as a schedule, valid for a
+generation of the navigation, so that:
+
+* the cached responses, navigation snapshots and ``Cache-Control``
+  headers don't outlive the next transition, see :func:`get_timeout`,
+* the first request after a transition invalidates the navigation, see
+  :func:`check_transitions`, which gives new validators to the pages and
+  purges them from the caching proxy.
+
+The ``publish_pages`` command fires the transitions on time, without
+waiting for a request, and publishes the drafts whose publication date
+has come."""
+from datetime import datetime
+from django.core.cache import cache
+
+from pages import settings
+from pages.cache import get_generations, GENERATION_TIMEOUT
+
+SCHEDULE_KEY = "page_schedule"
+SCHEDULE_LOCK_KEY = "page_schedule_lock_%d"
+# the number of dates of each kind kept in the schedule
+SCHEDULE_SIZE = 100
+
+def is_scheduled():
+    """Return ``True`` if the publication dates are taken in account."""
+    return settings.PAGE_SHOW_START_DATE or settings.PAGE_SHOW_END_DATE
+
+def get_schedule():
+    """Return the schedule of the current generation of the navigation,
+    built if needed, as a dictionnary with the ``generation`` and the
+    ``transitions``, a list of ``(date, page id)`` tuples ordered by date.
+    """
+    from pages.models import Page
+    key = Page.PAGE_NAVIGATION_GENERATION_KEY
+    generation = get_generations([key])[key]
+    schedule = cache.get(SCHEDULE_KEY)
+    if schedule is None or schedule['generation'] != generation:
+        schedule = {'generation': generation,
+            'transitions': Page.objects.get_transitions(SCHEDULE_SIZE)}
+        cache.set(SCHEDULE_KEY, schedule, GENERATION_TIMEOUT)
+    return schedule
+
+def get_next_transition(now=None):
+    """Return the date of the next transition, or ``None``."""
+    if not is_scheduled():
+        return None
+    now = now or datetime.now()
+    for date, page_id in get_schedule()['transitions']:
+        if date > now:
+            return date
+    return None
+
+def get_timeout(timeout, now=None):
+    """Return ``timeout``, in seconds, shortened to expire with the next
+    transition.
+
+    :param timeout: the timeout without transition.
+    """
+    now = now or datetime.now()
+    transition = get_next_transition(now)
+    if transition is None:
+        return timeout
+    delta = transition - now
+    return min(timeout, delta.days * 86400 + delta.seconds + 1)
+
+def check_transitions(now=None):
+    """Invalidate the navigation if a transition of the schedule has
+    happened. Return the ids of the pages that have changed state, or an
+    empty list.
+
+    Only one process fires the transitions of a generation, the others
+    read the new schedule."""
+    if not is_scheduled():
+        return []
+    from pages.models import Page
+    now = now or datetime.now()
+    schedule = get_schedule()
+    page_ids = [page_id for (date, page_id) in schedule['transitions']
+        if date <= now]
+    if not page_ids or not cache.add(
+            SCHEDULE_LOCK_KEY % schedule['generation'], True, 60):
+        return []
+    for page_id in set(page_ids):
+        Page.objects.invalidate(page_id)
+    Page.objects.invalidate_navigation()
+    return page_ids
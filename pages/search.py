@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""Full-text index of the current contents of the pages.
+
+The current revision of every content, titles and slugs included, is
+split into lower case terms when it is saved. The terms are stored in a
+SQLite full-text table when the database is SQLite with the FTS module,
+see :class:`SQLiteSearchBackend`, and in the
+:class:`ContentTerm <pages.models.ContentTerm>` table otherwise, see
+:class:`TermSearchBackend`.
+
+The index is maintained when ``PAGE_SEARCH_INDEX`` is ``True``; the
+``rebuild_search_index`` command fills it for the existing contents.
+
+The terms of a query must all be found in the contents of a page. Only
+the last term of a query is also searched as the beginning of a longer
+term, if it has at least ``PAGE_SEARCH_MIN_PREFIX`` characters, see
+:func:`get_query_terms`.
+
+The admin searches every page with :func:`search_pages`. The public
+search, :func:`search_published_pages`, ranks the published pages with
+the BM25 function: every current content is a document, and the score of
+a page is the sum of the scores of its contents. The published pages are
+read once per generation of the navigation, so the index doesn't change
+with the publication state of the pages. A term found in more than
+``PAGE_SEARCH_MAX_POSTINGS`` contents is only read for the pages having
+the other terms of the query, see :func:`rank_pages`."""
+import re, math, array, heapq
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connection, DatabaseError
+from django.db.models import Sum
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import strip_tags
+
+from pages import settings
+from pages.cache import get_generations, incr_generation
+from pages.cache import GENERATION_TIMEOUT
+from pages.schedule import get_timeout
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+ENTITY_RE = re.compile(r'&#?\w+;')
+TERM_MAX_LENGTH = 50
+# the parameters of the BM25 ranking function
+BM25_K1 = 1.2
+BM25_B = 0.75
+# the number of contents and of terms of a language change slowly
+STATISTICS_KEY = "page_search_statistics_%s"
+STATISTICS_TIMEOUT = 60 * 5
+PUBLISHED_IDS_KEY = "page_search_published_%d"
+# the generation of the index, incremented when it is rebuilt
+SEARCH_GENERATION_KEY = "page_search_generation"
+RESULTS_KEY = "page_search_results_%s"
+
+def get_terms(text):
+    """Return the lower case terms of a text, HTML tags and entities
+    excluded, in order."""
+    text = ENTITY_RE.sub(' ', strip_tags(force_unicode(text)))
+    return [word[:TERM_MAX_LENGTH] for word in WORD_RE.findall(text.lower())]
+
+def get_query_terms(query):
+    """Return the terms of a query, without duplicates, as a list of
+    ``(term, prefix)`` tuples: ``prefix`` is ``True`` for the last term
+    of the query if it has at least ``PAGE_SEARCH_MIN_PREFIX``
+    characters."""
+    terms = get_terms(query)
+    if not terms:
+        return []
+    last = terms.pop()
+    query_terms = [(term, False) for term in sorted(set(terms))
+        if term != last]
+    query_terms.append((last, len(last) >= settings.PAGE_SEARCH_MIN_PREFIX))
+    return query_terms
+
+def get_batches(ids, size=500):
+    """Split a list of ids in lists of ``size`` ids, because the databases
+    limit the number of parameters of a query. Return ``[None]`` if
+    ``ids`` is ``None``."""
+    if ids is None:
+        return [None]
+    ids = list(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+def count_terms(text):
+    """Return a ``{term: count}`` dictionnary of the terms of a text."""
+    counts = {}
+    for term in get_terms(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+class BaseSearchBackend(object):
+    """Base class of the search backends. The documents of the index are
+    the current contents, identified by their id."""
+
+    def index(self, contents):
+        """Add contents to the index.
+
+        :param contents: a list of current contents.
+        """
+        raise NotImplementedError
+
+    def unindex(self, content_ids):
+        """Remove contents from the index.
+
+        :param content_ids: a list of content ids.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every content from the index."""
+        raise NotImplementedError
+
+    def get_page_ids(self, term, language=None, prefix=False):
+        """Return the set of the ids of the pages having a content with
+        ``term``, or with a term starting with it if ``prefix`` is
+        ``True``."""
+        raise NotImplementedError
+
+    def get_postings(self, term, language, prefix=False, page_ids=None,
+            limit=None):
+        """Return the contents in ``language`` having ``term``, or a term
+        starting with it if ``prefix`` is ``True``, as a list of ``(page
+        id, content id, number of matching terms, number of terms)``
+        tuples.
+
+        :param page_ids: if defined, only the contents of these pages
+            are returned.
+        :param limit: the maximum number of returned contents.
+        """
+        raise NotImplementedError
+
+    def get_statistics(self, language):
+        """Return the number of indexed contents in ``language`` and
+        their total number of terms."""
+        raise NotImplementedError
+
+    def search(self, query, language=None):
+        """Return the ids of the pages having every term of ``query`` in
+        one of their contents, see :func:`get_query_terms`.
+
+        :param query: the searched text.
+        :param language: only search the contents in this language.
+        """
+        page_ids = None
+        for term, prefix in get_query_terms(query):
+            ids = self.get_page_ids(term, language, prefix)
+            if page_ids is None:
+                page_ids = ids
+            else:
+                page_ids &= ids
+            if not page_ids:
+                break
+        return sorted(page_ids or [])
+
+class TermSearchBackend(BaseSearchBackend):
+    """Store the terms in the :class:`ContentTerm
+    <pages.models.ContentTerm>` table. Works with every database."""
+
+    def index(self, contents):
+        from pages.models import ContentTerm
+        qn = connection.ops.quote_name
+        rows = []
+        for content in contents:
+            for term, count in count_terms(content.body).items():
+                rows.append((content.id, content.page_id, content.language,
+                    term, count))
+        if rows:
+            connection.cursor().executemany(
+                'INSERT INTO %s (%s, %s, %s, %s, %s) VALUES '
+                '(%%s, %%s, %%s, %%s, %%s)' % (qn(ContentTerm._meta.db_table),
+                qn('content_id'), qn('page_id'), qn('language'), qn('term'),
+                qn('count')), rows)
+
+    def unindex(self, content_ids):
+        from pages.models import ContentTerm
+        if content_ids:
+            ContentTerm.objects.filter(content__in=content_ids).delete()
+
+    def clear(self):
+        from pages.models import ContentTerm
+        ContentTerm.objects.all().delete()
+
+    def filter_terms(self, term, prefix):
+        from pages.models import ContentTerm
+        if prefix:
+            return ContentTerm.objects.filter(term__startswith=term)
+        return ContentTerm.objects.filter(term=term)
+
+    def get_page_ids(self, term, language=None, prefix=False):
+        terms = self.filter_terms(term, prefix)
+        if language:
+            terms = terms.filter(language=language)
+        return set(terms.values_list('page', flat=True).distinct())
+
+    def get_postings(self, term, language, prefix=False, page_ids=None,
+            limit=None):
+        from pages.models import ContentTerm
+        terms = self.filter_terms(term, prefix).filter(language=language)
+        frequencies = {}
+        for batch in get_batches(page_ids):
+            rows = terms
+            if batch is not None:
+                rows = rows.filter(page__in=batch)
+            rows = rows.order_by('content').values_list('page', 'content',
+                'count')
+            if limit is not None:
+                rows = rows[:limit]
+            for page_id, content_id, count in rows:
+                key = (page_id, content_id)
+                frequencies[key] = frequencies.get(key, 0) + count
+        lengths = {}
+        for batch in get_batches([content_id for (page_id, content_id)
+                in frequencies]):
+            lengths.update([(row['content'], row['length']) for row in
+                ContentTerm.objects.filter(content__in=batch).values(
+                'content').annotate(length=Sum('count'))])
+        return [(page_id, content_id, frequency, lengths[content_id])
+            for (page_id, content_id), frequency in frequencies.items()]
+
+    def get_statistics(self, language):
+        from pages.models import ContentTerm
+        terms = ContentTerm.objects.filter(language=language)
+        total = terms.aggregate(total=Sum('count'))['total'] or 0
+        return terms.values('content').distinct().count(), total
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """Store the terms in a SQLite FTS4 table, created by ``syncdb`` or
+    by the ``rebuild_search_index`` command. The id of a row is the id of
+    the content."""
+    table = 'pages_content_index'
+
+    def install(self):
+        """Create the full-text table. Return ``False`` if the FTS module
+        is not available."""
+        try:
+            connection.cursor().execute('CREATE VIRTUAL TABLE IF NOT EXISTS '
+                '%s USING fts4(page_id, language, terms)' % self.table)
+        except DatabaseError:
+            return False
+        return True
+
+    def is_installed(self):
+        """Return ``True`` if the full-text table exists."""
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = %s",
+            [self.table])
+        return cursor.fetchone()[0] > 0
+
+    def index(self, contents):
+        rows = [(content.id, content.page_id, content.language,
+            ' '.join(get_terms(content.body))) for content in contents]
+        # like the ContentTerm table, the contents without terms are left
+        rows = [row for row in rows if row[3]]
+        if rows:
+            connection.cursor().executemany('INSERT INTO %s (docid, page_id, '
+                'language, terms) VALUES (%%s, %%s, %%s, %%s)' % self.table,
+                rows)
+
+    def unindex(self, content_ids):
+        content_ids = list(content_ids)
+        # SQLite limits the number of parameters of a query
+        for start in range(0, len(content_ids), 500):
+            ids = content_ids[start:start + 500]
+            connection.cursor().execute('DELETE FROM %s WHERE docid IN (%s)'
+                % (self.table, ', '.join(['%s'] * len(ids))), ids)
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def get_match(self, term, prefix):
+        # the terms only have letters and digits
+        if prefix:
+            return term + '*'
+        return term
+
+    def get_page_ids(self, term, language=None, prefix=False):
+        sql = 'SELECT DISTINCT page_id FROM %s WHERE terms MATCH %%s' % (
+            self.table)
+        params = [self.get_match(term, prefix)]
+        if language:
+            sql += ' AND language = %s'
+            params.append(language)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return set([int(row[0]) for row in cursor.fetchall()])
+
+    def get_postings(self, term, language, prefix=False, page_ids=None,
+            limit=None):
+        # matchinfo 'x' gives 3 numbers per column, the first one is the
+        # number of matching terms in the row, and 'l' the number of
+        # terms of every column: the terms are the third column
+        postings = []
+        for batch in get_batches(page_ids):
+            sql = ("SELECT page_id, docid, matchinfo(%s, 'xl') FROM %s "
+                "WHERE terms MATCH %%s AND language = %%s" % (self.table,
+                self.table))
+            params = [self.get_match(term, prefix), language]
+            if batch is not None:
+                sql += ' AND page_id IN (%s)' % ', '.join(['%s'] * len(batch))
+                params.extend(batch)
+            if limit is not None:
+                sql += ' LIMIT %d' % limit
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            for page_id, content_id, info in cursor.fetchall():
+                info = array.array('I', str(info))
+                postings.append((int(page_id), content_id, info[6], info[11]))
+        return postings
+
+    def get_statistics(self, language):
+        # the terms are separated by a single space
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*), SUM(LENGTH(terms) - "
+            "LENGTH(REPLACE(terms, ' ', '')) + 1) FROM %s WHERE language = %%s"
+            % self.table, [language])
+        count, total = cursor.fetchone()
+        return count, total or 0
+
+_backend = []
+
+def get_search_backend():
+    """Return the :class:`SQLiteSearchBackend` if its table is installed,
+    the :class:`TermSearchBackend` otherwise."""
+    if not _backend:
+        backend = None
+        if django_settings.DATABASE_ENGINE == 'sqlite3':
+            backend = SQLiteSearchBackend()
+            if not backend.is_installed():
+                backend = None
+        _backend.append(backend or TermSearchBackend())
+    return _backend[0]
+
+def install_search_index():
+    """Create the full-text table if the database supports it."""
+    if django_settings.DATABASE_ENGINE == 'sqlite3':
+        backend = SQLiteSearchBackend()
+        # the creation of a table commits the current transaction
+        if not backend.is_installed() and backend.install():
+            del _backend[:]
+
+def update_index(content, replaced_ids=()):
+    """Index the current revision of a content in place of the previous
+    revisions.
+
+    :param content: the saved content.
+    :param replaced_ids: the ids of the contents that are not current
+        anymore.
+    """
+    backend = get_search_backend()
+    backend.unindex([content.id] + list(replaced_ids))
+    if content.current:
+        backend.index([content])
+
+def unindex_contents(content_ids):
+    """Remove contents from the index.
+
+    :param content_ids: a list of content ids.
+    """
+    get_search_backend().unindex(content_ids)
+
+def search_pages(query, language=None):
+    """Return the ids of the pages matching ``query``, see
+    :meth:`BaseSearchBackend.search`."""
+    return get_search_backend().search(query, language)
+
+def rebuild_index(batch_size=500):
+    """Index every current content from scratch. Return the number of
+    indexed contents."""
+    from pages.models import Content
+    backend = get_search_backend()
+    backend.clear()
+    content_ids = list(Content.objects.filter(current=True).values_list('id',
+        flat=True).order_by('id'))
+    for start in range(0, len(content_ids), batch_size):
+        backend.index(Content.objects.filter(
+            pk__in=content_ids[start:start + batch_size]))
+    incr_generation(SEARCH_GENERATION_KEY)
+    return len(content_ids)
+
+def get_statistics(language):
+    """Return the number of indexed contents in ``language`` and their
+    total number of terms, cached for ``STATISTICS_TIMEOUT`` seconds."""
+    key = STATISTICS_KEY % language
+    statistics = cache.get(key)
+    if statistics is None:
+        statistics = get_search_backend().get_statistics(language)
+        cache.set(key, statistics, STATISTICS_TIMEOUT)
+    return statistics
+
+def rank_pages(query, language, page_ids=None, limit=None):
+    """Return the pages having every term of ``query`` in their contents
+    in ``language``, see :func:`get_query_terms`, as a list of ``(page
+    id, score)`` tuples, the best scores first.
+
+    At most ``PAGE_SEARCH_MAX_POSTINGS`` contents are read for a term. A
+    more common term is only read for the pages having the other terms.
+    If every term is that common, the results are only drawn from the
+    first contents of every term.
+
+    :param query: the searched text.
+    :param language: the language of the contents.
+    :param page_ids: if defined, only the pages of this set are returned.
+    :param limit: the maximum number of returned pages.
+    """
+    backend = get_search_backend()
+    max_postings = settings.PAGE_SEARCH_MAX_POSTINGS
+    postings, common = {}, []
+    for term, prefix in get_query_terms(query):
+        term_postings = backend.get_postings(term, language, prefix,
+            limit=max_postings + 1)
+        if not term_postings:
+            return []
+        if len(term_postings) > max_postings:
+            common.append((term, prefix))
+            postings[(term, prefix)] = term_postings[:max_postings]
+        else:
+            postings[(term, prefix)] = term_postings
+    if len(common) < len(postings):
+        candidates = None
+        for key, term_postings in postings.items():
+            if key not in common:
+                ids = set([posting[0] for posting in term_postings])
+                if candidates is None:
+                    candidates = ids
+                else:
+                    candidates &= ids
+        if not candidates:
+            return []
+        for term, prefix in common:
+            postings[(term, prefix)] = backend.get_postings(term, language,
+                prefix, page_ids=candidates)
+    count, total = get_statistics(language)
+    average = count and float(total) / count or 1.0
+    scores = None
+    for key, term_postings in postings.items():
+        # the number of contents of a common term is not known
+        frequency = len(term_postings)
+        if key in common:
+            frequency = max(frequency, max_postings + 1)
+        # the statistics can be a bit late
+        count = max(count, frequency)
+        idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+        term_scores = {}
+        for page_id, content_id, matches, length in term_postings:
+            score = idf * matches * (BM25_K1 + 1) / (matches + BM25_K1 *
+                (1 - BM25_B + BM25_B * length / average))
+            term_scores[page_id] = term_scores.get(page_id, 0) + score
+        if scores is None:
+            scores = term_scores
+        else:
+            scores = dict([(page_id, score + term_scores[page_id])
+                for page_id, score in scores.items()
+                if page_id in term_scores])
+        if not scores:
+            break
+    results = [(-score, page_id) for (page_id, score) in
+        (scores or {}).items() if page_ids is None or page_id in page_ids]
+    if limit is not None and limit < len(results):
+        results = heapq.nsmallest(limit, results)
+    else:
+        results.sort()
+    return [(page_id, -score) for (score, page_id) in results]
+
+_published = {}
+
+def get_published_ids():
+    """Return the set of the ids of the published pages of the current
+    site, see :meth:`PageManager.published
+    <pages.managers.PageManager.published>`. The set is kept in the
+    memory of the process and in the cache for a generation of the
+    navigation, until the next publication transition."""
+    from pages.models import Page
+    key = Page.PAGE_NAVIGATION_GENERATION_KEY
+    generation = get_generations([key])[key]
+    cache_key = PUBLISHED_IDS_KEY % settings.SITE_ID
+    entry = _published.get(cache_key)
+    if entry is None or entry['generation'] != generation:
+        entry = cache.get(cache_key)
+    if entry is None or entry['generation'] != generation:
+        entry = {'generation': generation,
+            'ids': set(Page.objects.published().values_list('id', flat=True))}
+        cache.set(cache_key, entry, get_timeout(GENERATION_TIMEOUT))
+    _published[cache_key] = entry
+    return entry['ids']
+
+def search_published_pages(query, language):
+    """Return the published pages of the current site matching ``query``
+    in ``language`` as a list of ``(page id, score)`` tuples, the best
+    scores first, see :func:`rank_pages`. Only the
+    ``PAGE_SEARCH_MAX_RESULTS`` best pages are returned.
+
+    The results are cached for ``PAGE_SEARCH_RESULTS_TIMEOUT`` seconds,
+    until the navigation changes or the index is rebuilt: the new
+    contents don't invalidate every cached query."""
+    from pages.models import Page
+    terms = [prefix and term + '*' or term
+        for (term, prefix) in get_query_terms(query)]
+    if not terms:
+        return []
+    key = RESULTS_KEY % md5_constructor(smart_str(' '.join([language,
+        str(settings.SITE_ID)] + terms))).hexdigest()
+    stamps = get_generations([SEARCH_GENERATION_KEY,
+        Page.PAGE_NAVIGATION_GENERATION_KEY])
+    entry = cache.get(key)
+    if entry is not None and entry['stamps'] == stamps:
+        return entry['results']
+    results = rank_pages(query, language, get_published_ids(),
+        settings.PAGE_SEARCH_MAX_RESULTS)
+    cache.set(key, {'stamps': stamps, 'results': results},
+        get_timeout(settings.PAGE_SEARCH_RESULTS_TIMEOUT))
+    return results
+
+def get_results_page(query, language, number=1, per_page=None):
+    """Return a page of the results of :func:`search_published_pages` as
+    a :class:`Paginator <django.core.paginator.Paginator>` page whose
+    ``object_list`` holds the page objects, with their title, slug and url
+    loaded and their ``score``. An invalid page number gives the last
+    page.
+
+    :param query: the searched text.
+    :param language: the language of the contents.
+    :param number: the number of the page of results.
+    :param per_page: the number of results per page, defaults to
+        ``PAGE_SEARCH_RESULTS_PER_PAGE``.
+    """
+    from pages.models import Page, Content
+    paginator = Paginator(search_published_pages(query, language),
+        per_page or settings.PAGE_SEARCH_RESULTS_PER_PAGE)
+    try:
+        results = paginator.page(number)
+    except InvalidPage:
+        results = paginator.page(paginator.num_pages)
+    pages = Page.objects.in_bulk([page_id for (page_id, score) in
+        results.object_list])
+    object_list = []
+    for page_id, score in results.object_list:
+        if page_id in pages:
+            pages[page_id].score = score
+            object_list.append(pages[page_id])
+    results.object_list = Content.objects.prefetch_for_pages(object_list,
+        ('title', 'slug'), language)
+    return results
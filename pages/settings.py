@@ -106,6 +106,12 @@ PAGE_USE_SITE_ID = getattr(settings, 'PAGE_USE_SITE_ID', False)
 PAGE_USE_LANGUAGE_PREFIX = getattr(settings, 'PAGE_USE_LANGUAGE_PREFIX',
                                                                         False)
 
+# Set ``PAGE_CONTENT_REVISION_DELTA`` to ``True`` to store the older
+# revisions of a content as differences with the next revision instead of
+# full copies. The current revision is always stored in full.
+PAGE_CONTENT_REVISION_DELTA = getattr(settings, 'PAGE_CONTENT_REVISION_DELTA',
+    False)
+
 # Assign a list of placeholders to PAGE_CONTENT_REVISION_EXCLUDE_LIST
 # to exclude them from the revision process.
 PAGE_CONTENT_REVISION_EXCLUDE_LIST = getattr(settings,
@@ -151,9 +157,110 @@ PAGE_CONNECTED_MODELS = getattr(settings, 'PAGE_CONNECTED_MODELS', False)
 # The page link filter enable a output filter on you content links. The goal
 # is to transform special page class into real links at the last moment.
 # This ensure that even if you have moved a page, the URL will remain correct.
+# The links are resolved when the contents are saved and when the targeted
+# pages change. Run the ``rebuild_page_links`` command after enabling it.
 PAGE_LINK_FILTER = getattr(settings, 'PAGE_LINK_FILTER', False)
 
 
 # This setting is a function that can be defined if you need to pass extra
 # context data to the pages templates.
-PAGE_EXTRA_CONTEXT = getattr(settings, 'PAGE_EXTRA_CONTEXT', None)
\ No newline at end of file
+PAGE_EXTRA_CONTEXT = getattr(settings, 'PAGE_EXTRA_CONTEXT', None)
+
+# Retention policy of the content revisions, enforced by the
+# ``prune_page_revisions`` command. ``PAGE_CONTENT_REVISION_KEEP`` is the
+# number of revisions to keep for every page, language and placeholder
+# (the current one included) and ``PAGE_CONTENT_REVISION_MAX_AGE`` the
+# number of days revisions are kept. When both are defined, a revision is
+# only deleted when it is too old and beyond the number of kept revisions.
+PAGE_CONTENT_REVISION_KEEP = getattr(settings, 'PAGE_CONTENT_REVISION_KEEP',
+    None)
+PAGE_CONTENT_REVISION_MAX_AGE = getattr(settings,
+    'PAGE_CONTENT_REVISION_MAX_AGE', None)
+
+# Path of the gzip file where the pruned revisions are appended. Archived
+# revisions are still listed by the ``show_revisions`` template tag: their
+# position in the file is kept in the database, so a revision is read without
+# decompressing the whole archive. Set it to ``None`` to delete the pruned
+# revisions for good.
+PAGE_CONTENT_REVISION_ARCHIVE = getattr(settings,
+    'PAGE_CONTENT_REVISION_ARCHIVE', None)
+
+# The page data (contents, urls and languages) is kept in a cache living in
+# the memory of every process, in front of the Django cache.
+# ``PAGE_LOCAL_CACHE_MAX_ENTRIES`` is the maximum number of entries of this
+# cache, ``0`` disables it, and ``PAGE_LOCAL_CACHE_TIMEOUT`` the number of
+# seconds an entry is kept.
+PAGE_LOCAL_CACHE_MAX_ENTRIES = getattr(settings,
+    'PAGE_LOCAL_CACHE_MAX_ENTRIES', 1000)
+PAGE_LOCAL_CACHE_TIMEOUT = getattr(settings, 'PAGE_LOCAL_CACHE_TIMEOUT', 60)
+
+# The templates compiled from the body of the parsed placeholders are kept
+# in a cache of ``PAGE_PARSED_CACHE_MAX_ENTRIES`` entries in every process,
+# ``0`` disables it. If ``PAGE_PARSED_PRECOMPILE`` is ``True``, the parsed
+# placeholders are compiled when they are saved.
+PAGE_PARSED_CACHE_MAX_ENTRIES = getattr(settings,
+    'PAGE_PARSED_CACHE_MAX_ENTRIES', 200)
+PAGE_PARSED_PRECOMPILE = getattr(settings, 'PAGE_PARSED_PRECOMPILE', False)
+
+# If ``PAGE_RESPONSE_CACHE`` is ``True``, the responses of the ``details``
+# view to the anonymous users are cached for at most
+# ``PAGE_RESPONSE_CACHE_TIMEOUT`` seconds. A response is invalidated when its
+# page, the ancestors of its page or the navigation change, and expires at
+# the next publication or end of publication of a page.
+PAGE_RESPONSE_CACHE = getattr(settings, 'PAGE_RESPONSE_CACHE', False)
+PAGE_RESPONSE_CACHE_TIMEOUT = getattr(settings, 'PAGE_RESPONSE_CACHE_TIMEOUT',
+    300)
+
+# If ``PAGE_CONDITIONAL_GET`` is ``True``, the responses of the ``details``
+# view carry an ``ETag`` and a ``Last-Modified`` header and the view answers
+# ``304 Not Modified`` to the matching conditional requests before rendering
+# the template. The ``Cache-Control`` header allows the clients and the
+# proxies to keep the responses ``PAGE_CACHE_CONTROL_MAX_AGE`` seconds
+# without revalidating them.
+PAGE_CONDITIONAL_GET = getattr(settings, 'PAGE_CONDITIONAL_GET', False)
+PAGE_CACHE_CONTROL_MAX_AGE = getattr(settings, 'PAGE_CACHE_CONTROL_MAX_AGE', 0)
+
+# If ``PAGE_NAVIGATION_SNAPSHOT`` is ``True``, the published pages, their
+# titles, slugs and urls are kept in the cache as a snapshot per site and
+# language, read by the ``details`` view, the ``load_pages`` tag and the menu
+# tags instead of querying the database. A snapshot larger than
+# ``PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE`` bytes is not used: the default fits
+# a few thousands pages in the 1MB limit of memcached.
+PAGE_NAVIGATION_SNAPSHOT = getattr(settings, 'PAGE_NAVIGATION_SNAPSHOT', False)
+PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE = getattr(settings,
+    'PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE', 512 * 1024)
+
+# If ``PAGE_SURROGATE_KEYS`` is ``True``, the responses of the ``details``
+# view are tagged, in the ``PAGE_SURROGATE_KEY_HEADER`` header, with the keys
+# of the pages they depend on.
+PAGE_SURROGATE_KEYS = getattr(settings, 'PAGE_SURROGATE_KEYS', False)
+PAGE_SURROGATE_KEY_HEADER = getattr(settings, 'PAGE_SURROGATE_KEY_HEADER',
+    'Surrogate-Key')
+
+# The dotted path of the class purging the tagged responses from the caching
+# proxy when the pages are modified, for example
+# ``pages.purge.FilePurgeBackend``, which appends the keys to purge to the
+# file ``PAGE_PURGE_FILE``. Nothing is purged by default.
+PAGE_PURGE_BACKEND = getattr(settings, 'PAGE_PURGE_BACKEND', None)
+PAGE_PURGE_FILE = getattr(settings, 'PAGE_PURGE_FILE', None)
+
+# If ``PAGE_SEARCH_INDEX`` is ``True``, the current contents are kept in a
+# full-text index used by the search of the admin and by the ``search`` view
+# of the published pages, see ``pages.search``. Run the
+# ``rebuild_search_index`` command after enabling it.
+PAGE_SEARCH_INDEX = getattr(settings, 'PAGE_SEARCH_INDEX', False)
+PAGE_SEARCH_RESULTS_PER_PAGE = getattr(settings,
+    'PAGE_SEARCH_RESULTS_PER_PAGE', 10)
+# The search view ranks all the matching pages but only shows the best ones.
+PAGE_SEARCH_MAX_RESULTS = getattr(settings, 'PAGE_SEARCH_MAX_RESULTS', 1000)
+# The last term of a query also matches the longer terms starting with it if
+# it has at least ``PAGE_SEARCH_MIN_PREFIX`` characters.
+PAGE_SEARCH_MIN_PREFIX = getattr(settings, 'PAGE_SEARCH_MIN_PREFIX', 3)
+# The search view reads at most ``PAGE_SEARCH_MAX_POSTINGS`` contents for a
+# term, the more common terms are only read for the pages having the other
+# terms of the query.
+PAGE_SEARCH_MAX_POSTINGS = getattr(settings, 'PAGE_SEARCH_MAX_POSTINGS', 5000)
+# The number of seconds the results of a query are cached. The new contents
+# are found by the queries once their cached results have expired.
+PAGE_SEARCH_RESULTS_TIMEOUT = getattr(settings,
+    'PAGE_SEARCH_RESULTS_TIMEOUT', 60 * 5)
@@ -3,14 +3,17 @@
 from django import template
 from django.utils.safestring import SafeUnicode, mark_safe
 from django.utils.translation import ugettext_lazy as _
-from django.template import Template, TemplateSyntaxError
+from django.template import Template, TemplateSyntaxError, Context
+from django.template.loader import get_template
 #from django.forms import Widget, Textarea, ImageField, CharField
-import urllib
 
 from pages import settings
 from pages.models import Content, Page
 from pages.placeholders import PlaceholderNode, ImagePlaceholderNode
 from pages.placeholders import parse_placeholder
+from pages.cache import get_page, get_page_from_path
+from pages.navigation import get_navigation
+from pages.search import get_results_page
 
 register = template.Library()
 
@@ -19,13 +22,13 @@ PLACEHOLDER_ERROR = _("[Placeholder %(name)s had syntax error: %(error)s]")
 def get_page_from_string_or_id(page_string, lang):
     """Return a Page object from a slug or an id."""
     if type(page_string) == int:
-        return Page.objects.get(pk=int(page_string))
+        return get_page(int(page_string))
     # if we have a string coming from some templates templates
     if (isinstance(page_string, SafeUnicode) or
         isinstance(page_string, unicode)):
         if page_string.isdigit():
-            return Page.objects.get(pk=int(page_string))
-        return Page.objects.from_path(page_string, lang)
+            return get_page(int(page_string))
+        return get_page_from_path(page_string, lang)
     return page_string
 
 def _get_content(context, page, content_type, lang, fallback=True):
@@ -44,6 +47,105 @@ def _get_content(context, page, content_type, lang, fallback=True):
     c = Content.objects.get_content(page, lang, content_type, fallback)
     return c
 
+def _prefetch(pages, lang):
+    """Prefetch the titles, slugs and urls of a list of pages displayed
+    by the navigation tags."""
+    pages = list(pages)
+    missing = [page for page in pages if '_content_dict' not in page.__dict__
+        or lang not in page.__dict__.get('_url_dict', {})]
+    if missing:
+        Content.objects.prefetch_for_pages(missing, ('slug', 'title'), lang)
+    return pages
+
+def _get_menu_pages(page, expanded=None):
+    """Return the pages of the tree loaded under a page by
+    :meth:`PageManager.prefetch_children_for_frontend
+    <pages.managers.PageManager.prefetch_children_for_frontend>`, in tree
+    order.
+
+    :param page: the page at the top of the tree.
+    :param expanded: if defined, only the children of this page and of
+        its ancestors are returned, the other pages are leaves.
+    """
+    pages, stack = [], [page]
+    while stack:
+        node = stack.pop()
+        pages.append(node)
+        if expanded is None or (node.tree_id == expanded.tree_id
+                and node.lft <= expanded.lft and node.rght >= expanded.rght):
+            stack.extend(reversed(node.__dict__.get('_children_for_frontend',
+                [])))
+    return pages
+
+class MenuNode(template.Node):
+    """Render a menu tag with its template. The published descendants of
+    the page are loaded with a single query and rendered from the leaves
+    up: the menu tags nested in the template of a page find the menus of
+    its children already rendered instead of recursing."""
+
+    def __init__(self, func, template_name, expand, page, url=None):
+        self.func = func
+        self.template_name = template_name
+        self.expand = expand
+        self.page = template.Variable(page)
+        self.url = url and template.Variable(url)
+
+    def render(self, context):
+        lang = context.get('lang', settings.PAGE_DEFAULT_LANGUAGE)
+        page = get_page_from_string_or_id(self.page.resolve(context), lang)
+        rendered = getattr(page, '_rendered_menus', {})
+        if self.template_name in rendered:
+            return rendered[self.template_name]
+        url = '/'
+        if self.url:
+            url = self.url.resolve(context)
+        menu_template = get_template(self.template_name)
+        if not isinstance(page, Page):
+            return menu_template.render(Context(self.func(context, page, url),
+                autoescape=context.autoescape))
+        navigation = get_navigation(lang)
+        if (navigation is not None and page.id in navigation.pages
+                and '_children_for_frontend' not in page.__dict__):
+            page = navigation.pages[page.id]
+        expanded = None
+        if self.expand:
+            expanded = context.get('current_page')
+        if self.expand and not isinstance(expanded, Page):
+            pages = [page]
+        elif '_children_for_frontend' in page.__dict__:
+            pages = _get_menu_pages(page, expanded)
+        else:
+            pages = Page.objects.prefetch_children_for_frontend(page,
+                expanded)
+        _prefetch(pages, lang)
+        # the children are rendered before their parent
+        for node in reversed(pages):
+            output = menu_template.render(Context(self.func(context, node,
+                url), autoescape=context.autoescape))
+            node.__dict__.setdefault('_rendered_menus',
+                {})[self.template_name] = output
+        for node in pages:
+            del node._rendered_menus[self.template_name]
+        return output
+
+def register_menu_tag(func, template_name, expand=False):
+    """Register a menu tag rendered by :class:`MenuNode`. The tag takes the
+    page and, optionally, the url.
+
+    :param func: the function returning the context of the template.
+    :param template_name: the template of the menu of a page.
+    :param expand: if ``True``, only the children of the current page and
+        of its ancestors are displayed.
+    """
+    def compile_func(parser, token):
+        bits = token.split_contents()
+        if not 2 <= len(bits) <= 3:
+            raise TemplateSyntaxError('%r expects 1 or 2 arguments' % bits[0])
+        return MenuNode(func, template_name, expand, *bits[1:])
+    compile_func.__doc__ = func.__doc__
+    register.tag(func.__name__, compile_func)
+    return func
+
 """Filters"""
 
 def has_content_in(page, language):
@@ -53,7 +155,8 @@ def has_content_in(page, language):
     :param page: the current page
     :param language: the language you want to look at
     """
-    return Content.objects.filter(page=page, language=language).count() > 0
+    return Content.objects.filter(page=page, language=language,
+        current=True).count() > 0
 register.filter(has_content_in)
 
 def has_permission(page, request):
@@ -79,12 +182,11 @@ def pages_menu(context, page, url='/'):
     path = context.get('path', None)
     site_id = None
     if page:
-        children = page.get_children_for_frontend()
+        children = _prefetch(page.get_children_for_frontend(), lang)
     if 'current_page' in context:
         current_page = context['current_page']
     return locals()
-pages_menu = register.inclusion_tag('pages/menu.html',
-                                    takes_context=True)(pages_menu)
+pages_menu = register_menu_tag(pages_menu, 'pages/menu.html')
 
 def pages_sub_menu(context, page, url='/'):
     """Get the root page of the given page and
@@ -98,35 +200,19 @@ def pages_sub_menu(context, page, url='/'):
     page = get_page_from_string_or_id(page, lang)
     path = context.get('path', None)
     if page:
-        root = page.get_root()
-        children = root.get_children_for_frontend()
+        navigation = get_navigation(lang)
+        root = navigation and navigation.get_root(page.id)
+        if root is None:
+            root = page.get_root()
+        if '_children_for_frontend' not in root.__dict__:
+            Page.objects.prefetch_children_for_frontend(root)
+        children = _prefetch(root.get_children_for_frontend(), lang)
     if 'current_page' in context:
         current_page = context['current_page']
     return locals()
 pages_sub_menu = register.inclusion_tag('pages/sub_menu.html',
                                         takes_context=True)(pages_sub_menu)
 
-def pages_admin_menu(context, page, url='', level=None):
-    """Render the admin table of pages."""
-    request = context['request']
-    
-    if "tree_expanded" in request.COOKIES:
-        cookie_string = urllib.unquote(request.COOKIES['tree_expanded'])
-        if cookie_string:
-            ids = [int(id) for id in 
-                urllib.unquote(request.COOKIES['tree_expanded']).split(',')]
-            if page.id in ids:
-                expanded = True
-    
-    page_languages = settings.PAGE_LANGUAGES
-    has_permission = page.has_page_permission(request)
-    PAGES_MEDIA_URL = settings.PAGES_MEDIA_URL
-    lang = context.get('lang', settings.PAGE_DEFAULT_LANGUAGE)
-
-    return locals()
-pages_admin_menu = register.inclusion_tag('admin/pages/page/menu.html',
-                                        takes_context=True)(pages_admin_menu)
-
 
 def show_content(context, page, content_type, lang=None, fallback=True):
     """Display a content type from a page.
@@ -196,14 +282,20 @@ show_absolute_url = register.inclusion_tag('pages/content.html',
 
 def show_revisions(context, page, content_type, lang=None):
     """Render the last 10 revisions of a page content with a list using
-        the ``pages/revisions.html`` template"""
+        the ``pages/revisions.html`` template. The archived revisions are
+        listed after the ones of the database."""
     if not settings.PAGE_CONTENT_REVISION:
         return {'revisions':None}
-    revisions = Content.objects.filter(page=page, language=lang,
-                                type=content_type).order_by('-creation_date')
+    revisions = Content.objects.expand_revisions(list(Content.objects.filter(
+                        page=page, language=lang, type=content_type).order_by(
+                        '-creation_date', '-id')[0:10]))
+    if len(revisions) < 10:
+        # the older revisions could have been pruned
+        revisions.extend(Content.objects.get_archived_revisions(page, lang,
+                        content_type, 10 - len(revisions)))
     if len(revisions) < 2:
         return {'revisions':None}
-    return {'revisions':revisions[0:10]}
+    return {'revisions':revisions}
 show_revisions = register.inclusion_tag('pages/revisions.html',
                                         takes_context=True)(show_revisions)
 
@@ -228,12 +320,10 @@ def pages_dynamic_tree_menu(context, page, url='/'):
         # if this node is expanded, we also have to render its children
         # a node is expanded if it is the current node or one of its ancestors
         if page.lft <= current_page.lft and page.rght >= current_page.rght:
-            children = page.get_children_for_frontend()
+            children = _prefetch(page.get_children_for_frontend(), lang)
     return locals()
-pages_dynamic_tree_menu = register.inclusion_tag(
-    'pages/dynamic_tree_menu.html',
-    takes_context=True
-)(pages_dynamic_tree_menu)
+pages_dynamic_tree_menu = register_menu_tag(pages_dynamic_tree_menu,
+    'pages/dynamic_tree_menu.html', expand=True)
 
 def pages_breadcrumb(context, page, url='/'):
     """
@@ -250,7 +340,7 @@ def pages_breadcrumb(context, page, url='/'):
     request = context['request']
     site_id = None
     if page:
-        pages = page.get_ancestors()
+        pages = page.get_cached_ancestors()
     return locals()
 pages_breadcrumb = register.inclusion_tag(
     'pages/breadcrumb.html',
@@ -316,7 +406,12 @@ class LoadPagesNode(template.Node):
     """Load page node."""
     def render(self, context):
         if 'pages' not in context:
-            pages = Page.objects.navigation().order_by("tree_id")
+            navigation = get_navigation(context.get('lang',
+                settings.PAGE_DEFAULT_LANGUAGE))
+            if navigation is not None:
+                pages = navigation.roots
+            else:
+                pages = Page.objects.navigation().order_by("tree_id")
             context.update({'pages': pages})
         if 'current_page' not in context:
             context.update({'current_page':None})
@@ -339,6 +434,59 @@ def do_load_pages(parser, token):
 do_load_pages = register.tag('load_pages', do_load_pages)
 
 
+class SearchPagesNode(template.Node):
+    """Search pages node."""
+    def __init__(self, query, varname, lang):
+        self.query = query
+        self.varname = varname
+        self.lang = lang
+    def render(self, context):
+        if not settings.PAGE_SEARCH_INDEX:
+            context[self.varname] = []
+            return ''
+        if self.lang is None:
+            lang = context.get('lang', settings.PAGE_DEFAULT_LANGUAGE)
+        else:
+            lang = self.lang.resolve(context)
+        context[self.varname] = get_results_page(
+            self.query.resolve(context) or '', lang).object_list
+        return ''
+
+def do_search_pages(parser, token):
+    """Store the published pages matching a query, the most relevant
+    first, into a context variable. Only the first
+    ``PAGE_SEARCH_RESULTS_PER_PAGE`` pages are returned, see the
+    :func:`search <pages.views.search>` view for the next ones. The
+    search index has to be enabled with ``PAGE_SEARCH_INDEX``.
+
+    Example::
+
+        {% search_pages "contact address" as results %}
+        {% for page in results %}
+            <a href="{% show_absolute_url page %}">{% show_content page "title" %}</a>
+        {% endfor %}
+
+    Syntax::
+
+        {% search_pages query [lang] as name %}
+
+    :param query: the searched text
+    :param lang: the language of the contents
+    :param name: name of the context variable to store the pages in
+    """
+    bits = token.split_contents()
+    if not 4 <= len(bits) <= 5:
+        raise TemplateSyntaxError('%r expects 3 or 4 arguments' % bits[0])
+    if bits[-2] != 'as':
+        raise TemplateSyntaxError(
+            '%r expects "as" as the second last argument' % bits[0])
+    lang = None
+    if len(bits) == 5:
+        lang = parser.compile_filter(bits[2])
+    return SearchPagesNode(parser.compile_filter(bits[1]), bits[-1], lang)
+do_search_pages = register.tag('search_pages', do_search_pages)
+
+
 def do_placeholder(parser, token):
     """
     Method that parse the placeholder template tag.
@@ -33,4 +33,56 @@ class LinkTestCase(TestCase):
             Content.objects.get_content(page2, 'en-us', 'body'),
             'test <a href="#" class="pagelink_broken">hello</a>'
         )
-        self.assertTrue(page2.has_broken_link())
\ No newline at end of file
+        self.assertTrue(page2.has_broken_link())
+
+    def test_02_link_dependencies(self):
+        """Test that the links are resolved again when the target page
+        changes."""
+        from django.core.management import call_command
+        from pages.models import PageLink
+        setattr(settings, "PAGE_LINK_FILTER", True)
+        page1 = self.create_new_page()
+        page2 = self.create_new_page()
+        page3 = self.create_new_page()
+        content_string = 'test <a href="%s" class="page_%d">hello</a>'
+        Content(page=page2, language='en-us', type='body',
+            body=content_string % ('#', page1.id)).save()
+        link = PageLink.objects.get(source=page2)
+        self.assertEqual((link.target_id, link.language, link.broken),
+            (page1.id, 'en-us', False))
+        self.assertEqual(PageLink.objects.filter(source=page3).count(), 0)
+
+        # the links are not resolved again when the content is read
+        self.assertNumQueries(1, Content.objects.get_content, page2,
+            'en-us', 'body')
+
+        # a new slug for the target
+        Content.objects.create_content_if_changed(page1, 'en-us', 'slug',
+            'new-slug')
+        page1 = Page.objects.get(pk=page1.id)
+        self.assertEqual(page1.get_url('en-us'), 'new-slug')
+        self.assertEqual(
+            Content.objects.get_content(page2, 'en-us', 'body'),
+            content_string % (page1.get_absolute_url('en-us'), page1.id))
+
+        # the link is removed from the content
+        Content.objects.create_content_if_changed(page2, 'en-us', 'body',
+            'no link')
+        self.assertEqual(PageLink.objects.filter(source=page2).count(), 0)
+        self.assertEqual(
+            Content.objects.get_content(page2, 'en-us', 'body'), 'no link')
+        # the old revisions don't keep their rendered body
+        self.assertEqual(Content.objects.filter(page=page2, type='body',
+            rendered__isnull=False).count(), 0)
+
+        # the table can be rebuilt
+        Content.objects.create_content_if_changed(page3, 'en-us', 'body',
+            content_string % ('#', 0))
+        PageLink.objects.all().delete()
+        call_command('rebuild_page_links')
+        self.assertEqual(PageLink.objects.get(source=page3).broken, True)
+        self.assertTrue(page3.has_broken_link())
+        pages = PageLink.objects.prefetch_broken_links(
+            Page.objects.filter(id__in=[page2.id, page3.id]))
+        self.assertEqual([self.assertNumQueries(0, page.has_broken_link)
+            for page in pages], [False, True])
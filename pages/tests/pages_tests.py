@@ -2,6 +2,7 @@
 """Django page CMS test suite module"""
 import django
 from django.conf import settings
+from django.core.cache import cache
 from django.test.client import Client
 from django.template import Template, RequestContext, TemplateDoesNotExist
 from django.http import HttpResponse, HttpResponseRedirect
@@ -360,7 +361,7 @@ class PagesTestCase(TestCase):
 
 
     def test_17_request_mockup(self):
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         self.assertEqual(hasattr(request, 'session'), True)
 
@@ -565,7 +566,7 @@ class PagesTestCase(TestCase):
         page1 = Content.objects.get_content_slug_by_slug('page1').page
 
         from pages.views import details
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         context = details(request, only_context=True)
         self.assertEqual(context['current_page'], page1)
@@ -694,3 +695,1336 @@ class PagesTestCase(TestCase):
         response = client.get(page1.get_absolute_url())
         self.assertTrue(response.status_code == 301)
         self.assertTrue(response['Location'] == url)
+
+    def test_29_page_url_index(self):
+        """Test that the url index follows the slugs and the tree."""
+        from pages.models import PageUrl
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page_data = self.get_new_page_data()
+        page_data['slug'] = 'root'
+        response = client.post('/admin/pages/page/add/', page_data)
+        root_page = Content.objects.get_content_slug_by_slug('root').page
+        page_data['position'] = 'first-child'
+        page_data['target'] = root_page.id
+        page_data['slug'] = 'child'
+        response = client.post('/admin/pages/page/add/', page_data)
+        child = Content.objects.get_content_slug_by_slug('child').page
+
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'),
+            'root/child')
+        self.assertEqual(Page.objects.from_path('root/child', 'en-us'),
+            child)
+        self.assertEqual(child.get_url('en-us'), 'root/child')
+
+        # a new slug for the parent changes the url of the child
+        Content.objects.create_content_if_changed(root_page, 'en-us',
+            'slug', 'new-root')
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'),
+            'new-root/child')
+        self.assertEqual(child.get_url('en-us'), 'new-root/child')
+        self.assertEqual(Page.objects.from_path('new-root/child', 'en-us'),
+            child)
+        # the old slug still resolves
+        self.assertEqual(Page.objects.from_path('root', 'en-us'),
+            root_page)
+
+        # a move changes the url of the moved page
+        response = client.post('/admin/pages/page/%d/move-page/' % child.id,
+            {'position':'left', 'target':root_page.id})
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'), 'child')
+        self.assertEqual(Page.objects.from_path('child', 'en-us'), child)
+
+        # and so do the moves made outside of the admin
+        child = Page.objects.get(pk=child.id)
+        child.move_to(Page.objects.get(pk=root_page.id), 'first-child')
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'),
+            'new-root/child')
+        child = Page.objects.get(pk=child.id)
+        child.parent = None
+        child.save()
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'), 'child')
+
+        from django.core.management import call_command
+        PageUrl.objects.all().delete()
+        call_command('rebuild_page_urls')
+        self.assertEqual(PageUrl.objects.get_url(child, 'en-us'), 'child')
+        self.assertEqual(PageUrl.objects.get_url(root_page, 'fr-ch'),
+            'new-root')
+
+        child.delete()
+        self.assertEqual(PageUrl.objects.filter(page=child.id).count(), 0)
+
+    def test_30_content_dict(self):
+        """Test that the content of a page is loaded with a single query."""
+        page = self.create_new_page()
+        Content(page=page, type='title', language='fr-ch',
+            body='french title').save()
+        Content(page=page, type='body', language='en-us',
+            body='old body').save()
+        Content(page=page, type='body', language='en-us',
+            body='new body').save()
+        page.invalidate()
+        self.assertEqual(
+            self.assertNumQueries(1, page.title, 'fr-ch'), 'french title')
+        self.assertEqual(self.assertNumQueries(0, page.slug), page.slug())
+        self.assertEqual(self.assertNumQueries(0,
+            Content.objects.get_content, page, 'en-us', 'body'), 'new body')
+        self.assertEqual(Content.objects.get_content(page, 'de', 'body'), '')
+        self.assertEqual(Content.objects.get_content_dict(page)['title'],
+            {'en-us': page.title('en-us'), 'fr-ch': 'french title'})
+
+    def test_31_prefetch_for_pages(self):
+        """Test that the content of a list of pages can be prefetched."""
+        pages = [self.create_new_page() for i in range(3)]
+        for page in pages:
+            page.invalidate()
+        pages = list(Page.objects.filter(id__in=[page.id for page in pages]))
+        pages = self.assertNumQueries(2, Content.objects.prefetch_for_pages,
+            pages, ('slug', 'title'), 'en-us')
+        for page in pages:
+            self.assertEqual(self.assertNumQueries(0, page.slug), page.slug())
+            self.assertEqual(self.assertNumQueries(0, page.title),
+                page.title())
+            self.assertEqual(self.assertNumQueries(0, page.get_url, 'en-us'),
+                page.slug())
+        # the cached content is used by the next prefetch
+        pages = list(Page.objects.filter(id__in=[page.id for page in pages]))
+        for page in pages:
+            Content.objects.get_content_dict(page)
+        self.assertNumQueries(0, Content.objects.prefetch_for_pages, pages)
+        self.assertEqual(self.assertNumQueries(0, pages[0].title),
+            pages[0].title())
+
+    def test_32_current_revision(self):
+        """Test that only the latest revision is flagged as current."""
+        page = self.create_new_page()
+        for body in ('body 1', 'body 2', 'body 3'):
+            Content.objects.create_content_if_changed(page, 'en-us', 'body',
+                body)
+        # the admin has created an empty body
+        revisions = Content.objects.filter(page=page, type='body')
+        self.assertEqual(revisions.count(), 4)
+        current = revisions.get(current=True)
+        self.assertEqual(current.body, 'body 3')
+        self.assertEqual(Content.objects.get_content(page, 'en-us', 'body'),
+            'body 3')
+
+        # the previous revision becomes the current one
+        current.delete()
+        self.assertEqual(revisions.get(current=True).body, 'body 2')
+        self.assertEqual(Content.objects.get_content(page, 'en-us', 'body'),
+            'body 2')
+
+        from django.core.management import call_command
+        current_count = Content.objects.filter(current=True).count()
+        Content.objects.update(current=True)
+        call_command('rebuild_current_contents')
+        self.assertEqual(revisions.get(current=True).body, 'body 2')
+        self.assertEqual(Content.objects.filter(current=True).count(),
+            current_count)
+
+    def test_33_prune_revisions(self):
+        """Test the revisions retention policy and the archive."""
+        import os, tempfile, gzip
+        from pages import settings as pages_settings
+        from pages.templatetags.pages_tags import show_revisions
+        page = self.create_new_page()
+        for body in ('body 1', 'body 2', 'body 3', 'body 4'):
+            Content.objects.create_content_if_changed(page, 'en-us', 'body',
+                body)
+        revisions = Content.objects.filter(page=page, type='body')
+        first_id = revisions.order_by('creation_date', 'id')[0].id
+        self.assertEqual(revisions.count(), 5)
+
+        handle, archive = tempfile.mkstemp(suffix='.gz')
+        os.close(handle)
+        os.remove(archive)
+        setattr(pages_settings, "PAGE_CONTENT_REVISION_ARCHIVE", archive)
+        try:
+            from django.core.management import call_command
+            call_command('prune_page_revisions', keep=2, batch_size=1)
+            self.assertEqual([c.body for c in
+                revisions.order_by('-creation_date', '-id')],
+                ['body 4', 'body 3'])
+            self.assertEqual(Content.objects.get_content(page, 'en-us',
+                'body'), 'body 4')
+            self.assertEqual(Content.objects.prune_revisions(keep=2), 0)
+
+            # the pruned revisions are still available
+            archived = Content.objects.get_archived_revisions(page, 'en-us',
+                'body')
+            self.assertEqual([c.body for c in archived],
+                ['body 2', 'body 1', ''])
+            # every revision is read from its own gzip member
+            self.assertEqual([c.body for c in self.assertNumQueries(1,
+                Content.objects.get_archived_revisions, page, 'en-us', 'body',
+                1)], ['body 2'])
+            self.assertEqual(len(gzip.open(archive).readlines()), 3)
+            listed = show_revisions({}, page, 'body', 'en-us')['revisions']
+            self.assertEqual([c.body for c in listed],
+                ['body 4', 'body 3', 'body 2', 'body 1', ''])
+            c = Client()
+            c.login(username= 'batiste', password='b')
+            response = c.get('/admin/pages/page/%d/get-content/%d/' % (
+                page.id, first_id))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, '')
+            response = c.get('/admin/pages/page/%d/get-content/%d/' % (
+                page.id, archived[0].id))
+            self.assertEqual(response.content, 'body 2')
+            response = c.get('/admin/pages/page/%d/get-content/abc/' %
+                page.id)
+            self.assertEqual(response.status_code, 404)
+        finally:
+            setattr(pages_settings, "PAGE_CONTENT_REVISION_ARCHIVE", None)
+            if os.path.exists(archive):
+                os.remove(archive)
+
+    def test_34_delta_revisions(self):
+        """Test the storage of the revisions as deltas."""
+        from pages import settings as pages_settings
+        from pages.templatetags.pages_tags import show_revisions
+        setattr(pages_settings, "PAGE_CONTENT_REVISION_DELTA", True)
+        try:
+            page = self.create_new_page()
+            text = ' '.join(['word%d' % i for i in range(200)])
+            bodies = [text, text.replace('word10 ', 'typo '),
+                text.replace('word150 ', ''), text + ' end']
+            for body in bodies:
+                Content.objects.create_content_if_changed(page, 'en-us',
+                    'body', body)
+            revisions = Content.objects.filter(page=page, type='body',
+                language='en-us').order_by('-creation_date', '-id')
+            self.assertEqual([c.delta for c in revisions],
+                [False, True, True, True, False])
+            self.assertEqual(revisions[0].body, bodies[3])
+            self.assertTrue(len(revisions[1].body) < len(bodies[2]))
+
+            # the bodies are rebuilt by the readers
+            self.assertEqual([Content.objects.get_revision_body(c) for c in
+                revisions], bodies[::-1] + [''])
+            listed = show_revisions({}, page, 'body', 'en-us')['revisions']
+            self.assertEqual([c.body for c in listed], bodies[::-1] + [''])
+            c = Client()
+            c.login(username= 'batiste', password='b')
+            response = c.get('/admin/pages/page/%d/get-content/%d/' % (
+                page.id, revisions[2].id))
+            self.assertEqual(response.content, bodies[1])
+
+            # deleting a revision keeps the older ones readable
+            revisions[1].delete()
+            revisions = revisions.all()
+            self.assertEqual([Content.objects.get_revision_body(c) for c in
+                revisions], [bodies[3], bodies[1], bodies[0], ''])
+            revisions[0].delete()
+            revisions = revisions.all()
+            self.assertEqual(Content.objects.get_content(page, 'en-us',
+                'body'), bodies[1])
+            self.assertFalse(revisions[0].delta)
+            self.assertTrue(revisions[0].current)
+        finally:
+            setattr(pages_settings, "PAGE_CONTENT_REVISION_DELTA", False)
+
+    def test_35_cache_generations(self):
+        """Test that the cache of a page and of its tree is invalidated
+        by starting new generations."""
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page_data = self.get_new_page_data()
+        page_data['slug'] = 'other-root'
+        response = client.post('/admin/pages/page/add/', page_data)
+        other_root = Content.objects.get_content_slug_by_slug(
+            'other-root').page
+        page_data['slug'] = 'root'
+        response = client.post('/admin/pages/page/add/', page_data)
+        root_page = Content.objects.get_content_slug_by_slug('root').page
+        page_data['position'] = 'first-child'
+        page_data['target'] = root_page.id
+        page_data['slug'] = 'child'
+        response = client.post('/admin/pages/page/add/', page_data)
+        child = Content.objects.get_content_slug_by_slug('child').page
+        page_data['target'] = child.id
+        page_data['slug'] = 'grandchild'
+        response = client.post('/admin/pages/page/add/', page_data)
+        grandchild = Content.objects.get_content_slug_by_slug(
+            'grandchild').page
+
+        key = grandchild.get_cache_key(Page.PAGE_URL_KEY, 'en-us')
+        self.assertEqual(grandchild.get_url('en-us'),
+            'root/child/grandchild')
+        self.assertEqual(cache.get(key), 'root/child/grandchild')
+        self.assertEqual(grandchild.get_cache_key(Page.PAGE_URL_KEY,
+            'en-us'), key)
+
+        # a page invalidation doesn't delete anything
+        content_key = grandchild.get_cache_key(Page.PAGE_CONTENT_DICT_KEY)
+        grandchild.invalidate()
+        self.assertNotEqual(
+            grandchild.get_cache_key(Page.PAGE_CONTENT_DICT_KEY),
+            content_key)
+        self.assertEqual(cache.get(key), 'root/child/grandchild')
+
+        # moving the child invalidates the url of the grandchild
+        key = grandchild.get_cache_key(Page.PAGE_URL_KEY, 'en-us')
+        self.assertEqual(grandchild.get_url('en-us'),
+            'root/child/grandchild')
+        response = client.post('/admin/pages/page/%d/move-page/' % child.id,
+            {'position':'first-child', 'target':other_root.id})
+        grandchild = Page.objects.get(pk=grandchild.id)
+        self.assertNotEqual(
+            grandchild.get_cache_key(Page.PAGE_URL_KEY, 'en-us'), key)
+        self.assertEqual(grandchild.get_url('en-us'),
+            'other-root/child/grandchild')
+
+        # an evicted counter restarts from a new generation
+        key = grandchild.get_cache_key(Page.PAGE_URL_KEY, 'en-us')
+        cache.delete(Page.PAGE_TREE_GENERATION_KEY % grandchild.tree_id)
+        self.assertNotEqual(
+            grandchild.get_cache_key(Page.PAGE_URL_KEY, 'en-us'), key)
+
+    def test_36_two_tiers_cache(self):
+        """Test the local cache in front of the Django cache."""
+        from pages.cache import LocalCache, page_cache
+        from pages.cache import incr_generation
+        local = LocalCache(2, 60)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        # b is the least recently used entry
+        local.set('c', 3)
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual([local.get('a'), local.get('c')], [1, 3])
+        self.assertEqual(len(local), 2)
+        expired = LocalCache(2, -1)
+        expired.set('a', 1)
+        self.assertEqual(expired.get('a'), None)
+        self.assertEqual(len(expired), 0)
+
+        page = self.create_new_page()
+        url = page.get_url('en-us')
+        page_cache.reset_stats()
+        self.assertEqual(self.assertNumQueries(0, page.get_url, 'en-us'), url)
+        self.assertEqual(page_cache.stats(),
+            {'local_hits': 1, 'shared_hits': 0, 'misses': 0})
+
+        # a new generation started by another process is seen
+        key = page.get_cache_key(Page.PAGE_URL_KEY, 'en-us')
+        cache.delete(key)
+        page_cache.local.set(key, 'outdated')
+        incr_generation(Page.PAGE_GENERATION_KEY % page.id)
+        self.assertEqual(page.get_url('en-us'), url)
+        self.assertEqual(page_cache.stats()['misses'], 1)
+        page_cache.local.clear()
+        page.get_url('en-us')
+        self.assertEqual(page_cache.stats()['shared_hits'], 1)
+
+    def test_37_identity_map(self):
+        """Test that the pages are loaded once per request."""
+        from pages.cache import get_identity_map, start_identity_map
+        from pages.cache import end_identity_map
+        from pages.templatetags.pages_tags import get_page_from_string_or_id
+        from pages.http import get_request_mock
+        from pages.views import details
+        page = self.create_new_page()
+        page_id = unicode(page.id)
+        path = page.get_url('en-us')
+        start_identity_map()
+        try:
+            found = self.assertNumQueries(1, get_page_from_string_or_id,
+                page_id, 'en-us')
+            self.assertEqual(found, page)
+            self.assertTrue(self.assertNumQueries(0,
+                get_page_from_string_or_id, page.id, 'en-us') is found)
+            self.assertTrue(get_page_from_string_or_id(path, 'en-us')
+                is found)
+            self.assertEqual(self.assertNumQueries(0,
+                get_page_from_string_or_id, path, 'en-us'), found)
+            found.title()
+            self.assertNumQueries(0, Content.objects.get_content_dict, found)
+            self.assertNumQueries(1, found.is_first_root)
+            self.assertNumQueries(0, found.is_first_root)
+            # a modification is seen during the request
+            Content.objects.create_content_if_changed(found, 'en-us',
+                'title', 'new title')
+            self.assertEqual(found.title(), 'new title')
+        finally:
+            end_identity_map()
+        self.assertEqual(get_identity_map(), None)
+
+        # the details view installs its own map
+        request = get_request_mock()
+        context = details(request, path=path, lang='en-us',
+            only_context=True)
+        self.assertEqual(context['current_page'], page)
+        self.assertEqual(get_identity_map(), None)
+
+    def test_38_static_placeholders(self):
+        """Test that the placeholders are found without rendering the
+        template and that the result follows the template files."""
+        import os, tempfile, shutil, time
+        from pages import utils
+        template_dir = tempfile.mkdtemp()
+        old_template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = old_template_dirs + (template_dir,)
+        try:
+            os.mkdir(os.path.join(template_dir, 'placeholders'))
+            base = os.path.join(template_dir, 'placeholders', 'base.html')
+            open(base, 'w').write('{% load pages_tags %}'
+                '{% block a %}{% placeholder one %}{% endblock %}'
+                '{% block b %}{% placeholder two %}{% endblock %}')
+            open(os.path.join(template_dir, 'placeholders', 'child.html'),
+                'w').write('{% extends "placeholders/base.html" %}'
+                '{% load pages_tags %}'
+                '{% block a %}{% placeholder three %}{{ block.super }}'
+                '{% endblock %}'
+                '{% block b %}{% include "tests/test1.html" %}'
+                '{% endblock %}')
+            placeholders = utils.get_placeholders('placeholders/child.html')
+            self.assertEqual([p.name for p in placeholders],
+                ['three', 'one', 'body'])
+            self.assertTrue('placeholders/child.html' in
+                utils._placeholders_cache)
+
+            # a modification of the parent template is seen
+            open(base, 'w').write('{% load pages_tags %}'
+                '{% block a %}{% placeholder four %}{% endblock %}'
+                '{% block b %}{% endblock %}')
+            mtime = time.time() + 10
+            os.utime(base, (mtime, mtime))
+            placeholders = utils.get_placeholders('placeholders/child.html')
+            self.assertEqual([p.name for p in placeholders],
+                ['three', 'four', 'body'])
+        finally:
+            settings.TEMPLATE_DIRS = old_template_dirs
+            shutil.rmtree(template_dir)
+
+    def test_39_parsed_placeholder_cache(self):
+        """Test that the body of a parsed placeholder is compiled once."""
+        from django.template import Context
+        from pages.cache import template_cache
+        from pages.placeholders import PlaceholderNode
+        from pages import settings as pages_settings
+        page = self.create_new_page()
+        Content(page=page, type='parsed', language='en-us',
+            body='{{ lang }} parsed').save()
+        template = Template('{% load pages_tags %}'
+            '{% placeholder parsed parsed %}')
+        context = Context({'current_page': page, 'lang': 'en-us'})
+        template_cache.reset_stats()
+        self.assertEqual(template.render(context), 'en-us parsed')
+        self.assertEqual(template.render(context), 'en-us parsed')
+        stats = template_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertTrue('parsed' in stats['compile_times'])
+
+        # the syntax errors are cached too
+        Content(page=page, type='parsed', language='en-us',
+            body='{% if %}').save()
+        self.assertEqual(template.render(context), '')
+        self.assertEqual(template.render(context), '')
+        self.assertEqual(template_cache.stats()['errors'], 2)
+        self.assertEqual(template_cache.stats()['misses'], 2)
+
+        setattr(pages_settings, "PAGE_PARSED_PRECOMPILE", True)
+        try:
+            PlaceholderNode('parsed', parsed=True).save(page, 'en-us',
+                '{{ lang }} precompiled', True)
+            self.assertEqual(template_cache.stats()['misses'], 3)
+            self.assertEqual(template.render(context), 'en-us precompiled')
+            self.assertEqual(template_cache.stats()['misses'], 3)
+        finally:
+            setattr(pages_settings, "PAGE_PARSED_PRECOMPILE", False)
+
+        # the nodes that keep a state are not shared between two renders
+        Content(page=page, type='parsed', language='en-us',
+            body='{% for i in "ab" %}{% cycle "x" "y" "z" %}{% endfor %}'
+            '{% ifchanged %}{{ lang }}{% endifchanged %}').save()
+        self.assertEqual(template.render(context), 'xyen-us')
+        self.assertEqual(template.render(context), 'xyen-us')
+
+    def test_40_response_cache(self):
+        """Test the cache of the responses of the details view."""
+        from datetime import datetime, timedelta
+        from django.core.urlresolvers import reverse
+        from pages import settings as pages_settings
+        from pages.cache import get_response_key
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page_data = self.get_new_page_data()
+        page_data['slug'] = 'cached'
+        response = client.post('/admin/pages/page/add/', page_data)
+        page = Content.objects.get_content_slug_by_slug('cached').page
+        page.status = Page.PUBLISHED
+        page.save()
+        other = self.create_new_page(client)
+        url = page.get_absolute_url()
+        setattr(pages_settings, "PAGE_RESPONSE_CACHE", True)
+        try:
+            anonymous = Client()
+            response = anonymous.get(url)
+            self.assertEqual(response.status_code, 200)
+            cached = self.assertNumQueries(0, anonymous.get, url)
+            self.assertEqual(cached.content, response.content)
+
+            # a modification of the page
+            Content.objects.create_content_if_changed(page, 'en-us', 'body',
+                'new cached body')
+            self.assertTrue('new cached body' in anonymous.get(url).content)
+            self.assertNumQueries(0, anonymous.get, url)
+
+            # the body of another page doesn't change the navigation
+            Content.objects.create_content_if_changed(other, 'en-us', 'body',
+                'other body')
+            self.assertNumQueries(0, anonymous.get, url)
+            Content.objects.create_content_if_changed(other, 'en-us',
+                'title', 'other title')
+            self.assertEqual(anonymous.get(url).status_code, 200)
+            self.assertNumQueries(0, anonymous.get, url)
+
+            # the staff users see the drafts and are not served from the
+            # cache
+            page.status = Page.DRAFT
+            page.save()
+            self.assertEqual(client.get(url).status_code, 200)
+            self.assertEqual(anonymous.get(url).status_code, 404)
+
+            # the responses expire at the next publication transition
+            page.status = Page.PUBLISHED
+            page.save()
+            setattr(pages_settings, "PAGE_SHOW_END_DATE", True)
+            other.publication_end_date = (datetime.now() +
+                timedelta(minutes=1)).replace(microsecond=0)
+            other.save()
+            anonymous.get(url)
+            class request:
+                path = url
+                def is_ajax(self):
+                    return False
+            entry = cache.get(get_response_key(request(), 'en-us'))
+            self.assertEqual(entry['expires'], other.publication_end_date)
+        finally:
+            setattr(pages_settings, "PAGE_RESPONSE_CACHE", False)
+            setattr(pages_settings, "PAGE_SHOW_END_DATE", False)
+
+    def test_41_conditional_get(self):
+        """Test the validators and the 304 responses of the details view."""
+        import time
+        from django.utils.http import http_date
+        from pages import settings as pages_settings
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page_data = self.get_new_page_data()
+        page_data['slug'] = 'conditional'
+        client.post('/admin/pages/page/add/', page_data)
+        page = Content.objects.get_content_slug_by_slug('conditional').page
+        page.status = Page.PUBLISHED
+        page.save()
+        url = page.get_absolute_url()
+        anonymous = Client()
+        response = anonymous.get(url)
+        self.assertFalse(response.has_header('ETag'))
+        setattr(pages_settings, "PAGE_CONDITIONAL_GET", True)
+        setattr(pages_settings, "PAGE_CACHE_CONTROL_MAX_AGE", 60)
+        try:
+            response = anonymous.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            last_modified = response['Last-Modified']
+            self.assertTrue('public' in response['Cache-Control'])
+            self.assertTrue('max-age=60' in response['Cache-Control'])
+            self.assertTrue('Cookie' in response['Vary'])
+
+            response = anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, '')
+            self.assertEqual(response['ETag'], etag)
+            response = anonymous.get(url, HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+            response = anonymous.get(url,
+                HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+            response = anonymous.get(url,
+                HTTP_IF_MODIFIED_SINCE=http_date(time.time() - 3600))
+            self.assertEqual(response.status_code, 200)
+
+            # a modification of the page changes the validators
+            Content.objects.create_content_if_changed(page, 'en-us', 'body',
+                'new conditional body')
+            response = anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+            # the responses to the staff users are private
+            response = client.get(url)
+            self.assertTrue('private' in response['Cache-Control'])
+            self.assertNotEqual(response['ETag'], etag)
+
+            # the cached responses keep their validators
+            setattr(pages_settings, "PAGE_RESPONSE_CACHE", True)
+            etag = anonymous.get(url)['ETag']
+            response = self.assertNumQueries(0, anonymous.get, url,
+                HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(anonymous.get(url)['ETag'], etag)
+        finally:
+            setattr(pages_settings, "PAGE_CONDITIONAL_GET", False)
+            setattr(pages_settings, "PAGE_CACHE_CONTROL_MAX_AGE", 0)
+            setattr(pages_settings, "PAGE_RESPONSE_CACHE", False)
+
+    def test_42_surrogate_keys(self):
+        """Test the surrogate keys of the responses and the purges."""
+        import os, tempfile
+        from pages import settings as pages_settings
+        from pages.purge import get_purge_backend, FilePurgeBackend
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        root = self.create_new_page(client)
+        page_data = self.get_new_page_data()
+        page_data['target'] = root.id
+        page_data['position'] = 'first-child'
+        client.post('/admin/pages/page/add/', page_data)
+        child = Content.objects.get_content_slug_by_slug(
+            page_data['slug']).page
+        other = self.create_new_page(client)
+        setattr(pages_settings, "PAGE_SURROGATE_KEYS", True)
+        setattr(pages_settings, "PAGE_PURGE_BACKEND",
+            "pages.purge.LocMemPurgeBackend")
+        try:
+            response = Client().get(child.get_absolute_url())
+            self.assertEqual(response['Surrogate-Key'],
+                'page-%d page-%d page-navigation' % (root.id, child.id))
+
+            backend = get_purge_backend()
+            backend.pop_keys()
+            # a modification of the content purges the page
+            Content.objects.create_content_if_changed(child, 'en-us', 'body',
+                'purged body')
+            self.assertEqual(backend.pop_keys(), set(['page-%d' % child.id]))
+            # a new status purges the navigation
+            child.status = Page.DRAFT
+            child.save()
+            self.assertTrue('page-navigation' in backend.pop_keys())
+            # a move purges the descendants of the page
+            client.post('/admin/pages/page/%d/move-page/' % root.id,
+                {'position': 'first-child', 'target': other.id})
+            keys = backend.pop_keys()
+            self.assertTrue('page-%d' % root.id in keys)
+            self.assertTrue('page-navigation' in keys)
+            # a deletion purges the deleted pages
+            deleted_keys = set(['page-%d' % root.id, 'page-%d' % child.id])
+            Page.objects.get(pk=root.id).delete()
+            self.assertTrue(deleted_keys <= backend.pop_keys())
+
+            purge_file = tempfile.mktemp()
+            setattr(pages_settings, "PAGE_PURGE_FILE", purge_file)
+            try:
+                FilePurgeBackend().purge(['page-1', 'page-navigation'])
+                FilePurgeBackend().purge(['page-2'])
+                self.assertEqual(open(purge_file).read(),
+                    'page-1 page-navigation\npage-2\n')
+            finally:
+                os.remove(purge_file)
+        finally:
+            setattr(pages_settings, "PAGE_SURROGATE_KEYS", False)
+            setattr(pages_settings, "PAGE_PURGE_BACKEND", None)
+            setattr(pages_settings, "PAGE_PURGE_FILE", None)
+
+    def test_43_export_pages(self):
+        """Test the export of the pages to static files."""
+        import os, gzip, shutil, tempfile
+        from datetime import datetime, timedelta
+        from django.contrib.sites.models import Site
+        from pages.export import export_pages
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        root = self.create_new_page(client)
+        page_data = self.get_new_page_data()
+        page_data['target'] = root.id
+        page_data['position'] = 'first-child'
+        client.post('/admin/pages/page/add/', page_data)
+        child = Content.objects.get_content_slug_by_slug(
+            page_data['slug']).page
+        other = self.create_new_page(client)
+        draft = self.create_new_page(client, draft=True)
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(export_pages(directory, processes=1), (3, 3))
+            site_directory = os.path.join(directory,
+                Site.objects.get_current().domain)
+            file_name = os.path.join(site_directory,
+                child.get_absolute_url().strip('/'), 'index.html')
+            content = open(file_name).read()
+            self.assertEqual(gzip.open(file_name + '.gz').read(), content)
+            self.assertEqual(Client().get(child.get_absolute_url()).content,
+                content)
+            self.assertFalse(os.path.exists(os.path.join(site_directory,
+                draft.get_absolute_url().strip('/'))))
+
+            # the unchanged files are not written again
+            Page.objects.update(last_modification_date=datetime.now() -
+                timedelta(days=1))
+            self.assertEqual(export_pages(directory, processes=1), (3, 0))
+            # the incremental export renders the modified pages
+            Content.objects.create_content_if_changed(child, 'en-us', 'body',
+                'exported body')
+            self.assertEqual(export_pages(directory, processes=1,
+                incremental=True), (1, 1))
+            self.assertTrue('exported body' in open(file_name).read())
+            # and their descendants
+            Page.objects.get(pk=root.id).save()
+            self.assertEqual(export_pages(directory, processes=1,
+                incremental=True), (2, 0))
+            # a new title changes the menus of every page
+            Content.objects.create_content_if_changed(other, 'en-us',
+                'title', 'exported title')
+            self.assertEqual(export_pages(directory, processes=1,
+                incremental=True)[0], 3)
+            # the files of the unpublished pages are removed
+            child.status = Page.DRAFT
+            child.save()
+            export_pages(directory, processes=1, incremental=True)
+            self.assertFalse(os.path.exists(file_name))
+            self.assertFalse(os.path.exists(file_name + '.gz'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_44_menu_tree(self):
+        """Test that the menu tags load the page tree with a single
+        query."""
+        from pages.http import get_request_mock
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        def create_child(parent, draft=False):
+            page_data = self.get_new_page_data(draft=draft)
+            page_data['target'] = parent.id
+            page_data['position'] = 'last-child'
+            client.post('/admin/pages/page/add/', page_data)
+            return Content.objects.get_content_slug_by_slug(
+                page_data['slug']).page
+        root = self.create_new_page(client)
+        children = [create_child(root) for i in range(3)]
+        grandchildren = [create_child(child) for child in children]
+        draft = create_child(root, draft=True)
+        hidden = create_child(draft)
+        request = get_request_mock()
+        template = Template('{% load pages_tags %}{% pages_menu page %}')
+        def render():
+            context = RequestContext(request, {'lang': 'en-us',
+                'page': Page.objects.get(pk=root.id)})
+            return template.render(context)
+        output = self.assertNumQueries(4, render)
+        for page in [root] + children + grandchildren:
+            self.assertTrue(page.slug() in output)
+        self.assertFalse(draft.slug() in output)
+        self.assertFalse(hidden.slug() in output)
+        self.assertEqual(output.count('<ul>'), 4)
+
+        # the number of queries doesn't depend on the size of the tree
+        create_child(create_child(grandchildren[0]))
+        self.assertNumQueries(4, render)
+
+        # only the branch of the current page is expanded
+        template = Template('{% load pages_tags %}'
+            '{% pages_dynamic_tree_menu page %}')
+        context = RequestContext(request, {'lang': 'en-us',
+            'page': Page.objects.get(pk=root.id),
+            'current_page': children[0]})
+        output = template.render(context)
+        self.assertTrue(children[2].slug() in output)
+        self.assertTrue(grandchildren[0].slug() in output)
+        self.assertFalse(grandchildren[1].slug() in output)
+
+    def test_45_navigation_snapshot(self):
+        """Test the navigation snapshot read by the menu tags."""
+        from pages import settings as pages_settings
+        from pages.cache import start_identity_map, end_identity_map
+        from pages.http import get_request_mock
+        from pages.navigation import get_navigation
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        def create_child(parent, draft=False):
+            page_data = self.get_new_page_data(draft=draft)
+            page_data['target'] = parent.id
+            page_data['position'] = 'last-child'
+            client.post('/admin/pages/page/add/', page_data)
+            return Content.objects.get_content_slug_by_slug(
+                page_data['slug']).page
+        root = self.create_new_page(client)
+        child = create_child(root)
+        grandchild = create_child(child)
+        draft = create_child(root, draft=True)
+        other = self.create_new_page(client)
+        request = get_request_mock()
+        template = Template('{% load pages_tags %}{% load_pages %}'
+            '{% for page in pages %}{% pages_menu page %}{% endfor %}')
+        def render():
+            start_identity_map()
+            try:
+                return template.render(RequestContext(request,
+                    {'lang': 'en-us'}))
+            finally:
+                end_identity_map()
+        expected = render()
+        setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT", True)
+        try:
+            self.assertEqual(render(), expected)
+            output = self.assertNumQueries(0, render)
+            self.assertEqual(output, expected)
+            self.assertTrue(grandchild.slug() in output)
+            self.assertFalse(draft.slug() in output)
+
+            # a new title or a new status patches the snapshot
+            Content.objects.create_content_if_changed(other, 'en-us',
+                'title', 'snapshot title')
+            child = Page.objects.get(pk=child.id)
+            child.status = Page.DRAFT
+            child.save()
+            output = self.assertNumQueries(0, render)
+            self.assertFalse(grandchild.slug() in output)
+            start_identity_map()
+            try:
+                navigation = get_navigation('en-us')
+                self.assertEqual(navigation.pages[other.id].title(),
+                    'snapshot title')
+                self.assertEqual([page.id for page in navigation.roots],
+                    [root.id, other.id])
+                # the pages carry the fields of the real pages
+                page = navigation.pages[other.id]
+                real_page = Page.objects.get(pk=other.id)
+                for name in ('author_id', 'creation_date', 'template',
+                        'effective_template', 'redirect_to_id'):
+                    self.assertEqual(getattr(page, name),
+                        getattr(real_page, name))
+                self.assertEqual(self.assertNumQueries(0, page.get_template),
+                    real_page.get_template())
+            finally:
+                end_identity_map()
+            # a new template patches the snapshot
+            real_page.template = 'pages/nice.html'
+            real_page.save()
+            start_identity_map()
+            try:
+                page = get_navigation('en-us').pages[other.id]
+                self.assertEqual(page.template, 'pages/nice.html')
+                self.assertEqual(page.get_template(), 'pages/nice.html')
+            finally:
+                end_identity_map()
+
+            # a new page rebuilds it
+            new_page = create_child(other)
+            output = render()
+            self.assertTrue(new_page.slug() in output)
+            self.assertNumQueries(0, render)
+
+            # the dynamic menu only walks the expanded branches
+            from pages.templatetags.pages_tags import _get_menu_pages
+            dynamic_template = Template('{% load pages_tags %}'
+                '{% load_pages %}{% for page in pages %}'
+                '{% pages_dynamic_tree_menu page %}{% endfor %}')
+            def render_dynamic():
+                start_identity_map()
+                try:
+                    return dynamic_template.render(RequestContext(request,
+                        {'lang': 'en-us',
+                        'current_page': Page.objects.get(pk=root.id)}))
+                finally:
+                    end_identity_map()
+            setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT", False)
+            expected = render_dynamic()
+            setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT", True)
+            self.assertEqual(render_dynamic(), expected)
+            self.assertFalse(new_page.slug() in expected)
+            start_identity_map()
+            try:
+                page = get_navigation('en-us').pages[other.id]
+                self.assertEqual(len(_get_menu_pages(page)), 2)
+                self.assertEqual(_get_menu_pages(page,
+                    Page.objects.get(pk=root.id)), [page])
+            finally:
+                end_identity_map()
+
+            # a snapshot over the size budget is not used
+            setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE", 10)
+            Page.objects.invalidate_navigation()
+            self.assertEqual(get_navigation('en-us'), None)
+            self.assertEqual(render(), output)
+        finally:
+            setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT", False)
+            setattr(pages_settings, "PAGE_NAVIGATION_SNAPSHOT_MAX_SIZE",
+                512 * 1024)
+
+    def test_46_effective_template(self):
+        """Test the template inherited by the pages."""
+        from django.core.management import call_command
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        def create_page(parent=None, template=''):
+            page_data = self.get_new_page_data()
+            page_data['template'] = template
+            if parent:
+                page_data['target'] = parent.id
+                page_data['position'] = 'last-child'
+            client.post('/admin/pages/page/add/', page_data)
+            return Content.objects.get_content_slug_by_slug(
+                page_data['slug']).page
+        root = create_page(template='pages/nice.html')
+        child = create_page(root)
+        grandchild = create_page(child)
+        other = create_page(template='pages/cool.html')
+        page = Page.objects.get(pk=grandchild.id)
+        self.assertEqual(self.assertNumQueries(0, page.get_template),
+            'pages/nice.html')
+        self.assertEqual(page.get_template_name(), 'nice one')
+        self.assertEqual(Page.objects.get(pk=other.id).get_template(),
+            'pages/cool.html')
+
+        # a new template is inherited by the descendants
+        child = Page.objects.get(pk=child.id)
+        child.template = 'pages/editor.html'
+        child.save()
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            'pages/editor.html')
+        child.template = ''
+        child.save()
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            'pages/nice.html')
+
+        # and follows the moves
+        client.post('/admin/pages/page/%d/move-page/' % child.id,
+            {'position': 'first-child', 'target': other.id})
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            'pages/cool.html')
+        child = Page.objects.get(pk=child.id)
+        child.move_to(Page.objects.get(pk=root.id), 'first-child')
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            'pages/nice.html')
+        child = Page.objects.get(pk=child.id)
+        child.parent = other
+        child.save()
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            'pages/cool.html')
+        Page.objects.filter(pk=other.id).update(template='')
+        self.assertEqual(Page.objects.update_templates(), 3)
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            settings.DEFAULT_PAGE_TEMPLATE)
+
+        # the templates that haven't been computed are found as before
+        Page.objects.update(effective_template=None)
+        self.assertEqual(Page.objects.get(pk=grandchild.id).get_template(),
+            settings.DEFAULT_PAGE_TEMPLATE)
+        call_command('rebuild_page_templates')
+        self.assertEqual(Page.objects.filter(
+            effective_template__isnull=True).count(), 0)
+
+    def test_47_cached_ancestors(self):
+        """Test the cached ancestors of the breadcrumbs and the urls."""
+        from pages.cache import start_identity_map, end_identity_map
+        from pages.http import get_request_mock
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        parent = None
+        pages = []
+        for i in range(5):
+            page_data = self.get_new_page_data()
+            if parent:
+                page_data['target'] = parent.id
+                page_data['position'] = 'last-child'
+            client.post('/admin/pages/page/add/', page_data)
+            parent = Content.objects.get_content_slug_by_slug(
+                page_data['slug']).page
+            pages.append(parent)
+        page = pages[-1]
+        request = get_request_mock()
+        template = Template('{% load pages_tags %}{% pages_breadcrumb page %}')
+        def render():
+            # as a page loaded by a new request
+            page.__dict__.pop('_ancestors', None)
+            start_identity_map()
+            try:
+                return template.render(RequestContext(request,
+                    {'lang': 'en-us', 'page': page}))
+            finally:
+                end_identity_map()
+        expected = render()
+        output = self.assertNumQueries(0, render)
+        self.assertEqual(output, expected)
+        for ancestor in pages:
+            self.assertTrue(ancestor.get_absolute_url() in output)
+            self.assertTrue(ancestor.title() in output)
+
+        # the ancestors follow the titles and the moves
+        Content.objects.create_content_if_changed(pages[1], 'en-us',
+            'title', 'new ancestor title')
+        self.assertTrue('new ancestor title' in render())
+        client.post('/admin/pages/page/%d/move-page/' % pages[2].id,
+            {'position': 'last-child', 'target': pages[0].id})
+        ancestors = Page.objects.get(pk=page.id).get_cached_ancestors()
+        self.assertEqual([ancestor.id for ancestor in ancestors],
+            [pages[0].id, pages[2].id, pages[3].id])
+        self.assertEqual(ancestors[-1].get_url(),
+            Page.objects.get(pk=pages[3].id).get_url())
+        url = Page.objects.get(pk=page.id).get_url()
+        self.assertEqual(url, '/'.join([ancestor.slug() for ancestor in
+            ancestors] + [page.slug()]))
+        self.assertEqual(self.assertNumQueries(0,
+            Page.objects.get(pk=page.id).get_url), url)
+
+    def test_48_publication_schedule(self):
+        """Test the schedule of the publication transitions and the
+        publish_pages command."""
+        from datetime import datetime, timedelta
+        from django.core.management import call_command
+        from pages import settings as pages_settings
+        from pages.cache import get_generations
+        from pages.schedule import get_schedule, get_next_transition
+        from pages.schedule import get_timeout, check_transitions
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page = self.create_new_page(client)
+        draft = self.create_new_page(client, draft=True)
+        key = Page.PAGE_NAVIGATION_GENERATION_KEY
+        end = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        setattr(pages_settings, "PAGE_SHOW_START_DATE", True)
+        setattr(pages_settings, "PAGE_SHOW_END_DATE", True)
+        try:
+            page = Page.objects.get(pk=page.id)
+            page.publication_end_date = end
+            page.save()
+            self.assertEqual(get_schedule()['transitions'], [(end, page.id)])
+            self.assertEqual(self.assertNumQueries(0, get_next_transition),
+                end)
+            self.assertTrue(3590 < get_timeout(86400) <= 3601)
+            self.assertEqual(get_timeout(60), 60)
+
+            # nothing happens before the transition
+            generation = get_generations([key])[key]
+            self.assertEqual(check_transitions(), [])
+            self.assertEqual(get_generations([key])[key], generation)
+            # the first request after the transition fires it once
+            later = end + timedelta(seconds=1)
+            self.assertEqual(check_transitions(later), [page.id])
+            self.assertNotEqual(get_generations([key])[key], generation)
+            self.assertEqual(get_next_transition(later), None)
+
+            # the Cache-Control header expires with the transition
+            setattr(pages_settings, "PAGE_CONDITIONAL_GET", True)
+            setattr(pages_settings, "PAGE_CACHE_CONTROL_MAX_AGE", 86400)
+            response = Client().get(page.get_absolute_url())
+            self.assertFalse('max-age=86400' in response['Cache-Control'])
+
+            # a scheduled draft is published by the command
+            Page.objects.filter(pk=draft.id).update(
+                publication_date=datetime.now() - timedelta(minutes=1))
+            call_command('publish_pages', verbosity=0)
+            draft = Page.objects.get(pk=draft.id)
+            self.assertEqual(draft.status, Page.PUBLISHED)
+            self.assertEqual(draft.calculated_status, Page.PUBLISHED)
+        finally:
+            setattr(pages_settings, "PAGE_SHOW_START_DATE", False)
+            setattr(pages_settings, "PAGE_SHOW_END_DATE", False)
+            setattr(pages_settings, "PAGE_CONDITIONAL_GET", False)
+            setattr(pages_settings, "PAGE_CACHE_CONTROL_MAX_AGE", 0)
+
+    def test_49_search_index(self):
+        """Test the full-text index of the contents and the admin search."""
+        from django.core.management import call_command
+        from pages import settings as pages_settings
+        from pages.search import search_pages, get_search_backend
+        from pages.search import TermSearchBackend, SQLiteSearchBackend
+        from pages.search import rebuild_index, get_terms
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        page1 = self.create_new_page(client)
+        page2 = self.create_new_page(client)
+        Content.objects.create_content_if_changed(page1, 'en-us', 'body',
+            '<p>The quick <b>brown</b> fox&nbsp;jumps</p>')
+        Content.objects.create_content_if_changed(page2, 'fr-ch', 'body',
+            u'Le renard brun saute')
+        self.assertEqual(get_terms(u'<p>Le Renard&amp;brun</p>'),
+            [u'le', u'renard', u'brun'])
+        if (settings.DATABASE_ENGINE == 'sqlite3' and
+                SQLiteSearchBackend().is_installed()):
+            self.assertTrue(isinstance(get_search_backend(),
+                SQLiteSearchBackend))
+        setattr(pages_settings, "PAGE_SEARCH_INDEX", True)
+        try:
+            call_command('rebuild_search_index')
+            for backend in (TermSearchBackend(), get_search_backend()):
+                backend.clear()
+                backend.index(Content.objects.filter(current=True))
+                self.assertEqual(backend.search('brown'), [page1.id])
+                self.assertEqual(backend.search('BROWN fox'), [page1.id])
+                self.assertEqual(backend.search('bro'), [page1.id])
+                self.assertEqual(backend.search('brown renard'), [])
+                self.assertEqual(backend.search('brun', 'en-us'), [])
+                self.assertEqual(backend.search('brun', 'fr-ch'), [page2.id])
+                # the titles are indexed
+                self.assertEqual(backend.search('test page'),
+                    [page1.id, page2.id])
+            rebuild_index()
+
+            # the index follows the current revision
+            Content.objects.create_content_if_changed(page1, 'en-us', 'body',
+                'a lazy dog')
+            self.assertEqual(search_pages('brown'), [])
+            self.assertEqual(search_pages('lazy'), [page1.id])
+            Content.objects.get(page=page1, language='en-us', type='body',
+                current=True).delete()
+            self.assertEqual(search_pages('lazy'), [])
+            self.assertEqual(search_pages('brown'), [page1.id])
+            Content.objects.set_or_create_content(page2, 'fr-ch', 'body',
+                'un chien')
+            self.assertEqual(search_pages('chien'), [page2.id])
+            self.assertEqual(search_pages('renard'), [])
+
+            response = client.post('/admin/pages/page/', {'q': 'chien'})
+            self.assertEqual([page.id for page in response.context['pages']],
+                [page2.id])
+            # the deleted pages leave the index
+            Page.objects.get(pk=page2.id).delete()
+            self.assertEqual(search_pages('chien'), [])
+        finally:
+            setattr(pages_settings, "PAGE_SEARCH_INDEX", False)
+        response = client.post('/admin/pages/page/', {'q': 'brown'})
+        self.assertEqual([page.id for page in response.context['pages']],
+            [page1.id])
+
+    def test_50_search_published_pages(self):
+        """Test the ranked search of the published pages."""
+        from django.http import Http404
+        from django.template import Template, RequestContext
+        from pages import settings as pages_settings
+        from pages.http import get_request_mock
+        from pages.views import search
+        from pages.search import search_published_pages, get_results_page
+        from pages.search import rebuild_index, get_search_backend
+        from pages.search import TermSearchBackend
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        pages = [self.create_new_page(client) for i in range(3)]
+        bodies = ('a garden with a lemon tree and many other trees',
+            'lemon lemon lemon', 'an orange tree')
+        for page, body in zip(pages, bodies):
+            Content.objects.create_content_if_changed(page, 'en-us', 'body',
+                body)
+        request = get_request_mock()
+        request.GET = {'q': 'lemon'}
+        self.assertRaises(Http404, search, request)
+        setattr(pages_settings, "PAGE_SEARCH_INDEX", True)
+        try:
+            rebuild_index()
+            # the shorter and more frequent matches first
+            results = search_published_pages('lemon', 'en-us')
+            self.assertEqual([page_id for (page_id, score) in results],
+                [pages[1].id, pages[0].id])
+            self.assertTrue(results[0][1] > results[1][1] > 0)
+            self.assertEqual([page_id for (page_id, score) in
+                search_published_pages('tree', 'en-us')],
+                [pages[2].id, pages[0].id])
+            self.assertEqual([page_id for (page_id, score) in
+                search_published_pages('lemon tree', 'en-us')],
+                [pages[0].id])
+            self.assertEqual(search_published_pages('lemon', 'fr-ch'), [])
+            # the results are cached, even after a new content
+            Content.objects.create_content_if_changed(pages[1], 'en-us',
+                'body', 'lemon lemon')
+            self.assertEqual(self.assertNumQueries(0, search_published_pages,
+                'lemon', 'en-us'), results)
+
+            # only the last term is a prefix, if it is long enough
+            self.assertEqual([page_id for (page_id, score) in
+                search_published_pages('orange tre', 'en-us')],
+                [pages[2].id])
+            self.assertEqual(search_published_pages('tre orange', 'en-us'),
+                [])
+            self.assertEqual(search_published_pages('or', 'en-us'), [])
+            # the common terms are only read for the pages of the rare ones
+            setattr(pages_settings, "PAGE_SEARCH_MAX_POSTINGS", 2)
+            try:
+                self.assertEqual([page_id for (page_id, score) in
+                    search_published_pages('garden test', 'en-us')],
+                    [pages[0].id])
+                # a query of common terms reads their first contents only
+                self.assertTrue(0 < len(search_published_pages('page',
+                    'en-us')) <= 2)
+            finally:
+                setattr(pages_settings, "PAGE_SEARCH_MAX_POSTINGS", 5000)
+
+            # the pagination
+            results = get_results_page('lemon', 'en-us', 2, per_page=1)
+            self.assertEqual(results.paginator.count, 2)
+            self.assertEqual([page.id for page in results.object_list],
+                [pages[0].id])
+            self.assertEqual(results.object_list[0].title(),
+                pages[0].title())
+            self.assertEqual(get_results_page('lemon', 'en-us', 9,
+                per_page=1).number, 2)
+
+            # the unpublished pages and the new contents
+            page = Page.objects.get(pk=pages[1].id)
+            page.status = Page.DRAFT
+            page.save()
+            Content.objects.create_content_if_changed(pages[2], 'en-us',
+                'body', 'a lemon')
+            self.assertEqual([page_id for (page_id, score) in
+                search_published_pages('lemon', 'en-us')],
+                [pages[2].id, pages[0].id])
+
+            response = search(request)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(pages[2].get_absolute_url() in response.content)
+            self.assertFalse(pages[1].get_absolute_url() in response.content)
+            template = Template('{% load pages_tags %}'
+                '{% search_pages "orange" as results %}'
+                '{% for page in results %}{{ page.id }}{% endfor %}')
+            self.assertEqual(template.render(RequestContext(request,
+                {'lang': 'en-us'})), '')
+            template = Template('{% load pages_tags %}'
+                '{% search_pages "garden" "en-us" as results %}'
+                '{% for page in results %}{{ page.id }}{% endfor %}')
+            self.assertEqual(template.render(RequestContext(request)),
+                str(pages[0].id))
+
+            # both backends give the same statistics
+            backend = TermSearchBackend()
+            backend.clear()
+            backend.index(Content.objects.filter(current=True))
+            for term, prefix in (('lemon', False), ('tre', True)):
+                self.assertEqual(sorted(backend.get_postings(term, 'en-us',
+                    prefix)), sorted(get_search_backend().get_postings(term,
+                    'en-us', prefix)))
+            self.assertEqual(backend.get_statistics('en-us'),
+                get_search_backend().get_statistics('en-us'))
+        finally:
+            setattr(pages_settings, "PAGE_SEARCH_INDEX", False)
+
+    def test_51_admin_tree(self):
+        """Test that the admin tree is rendered with a constant number of
+        queries."""
+        from django.conf import settings as django_settings
+        from django.db import connection, reset_queries
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        def count_queries(url):
+            # a first request consumes the messages of the user
+            client.get(url)
+            debug = django_settings.DEBUG
+            django_settings.DEBUG = True
+            reset_queries()
+            try:
+                response = client.get(url)
+                return response, len(connection.queries)
+            finally:
+                django_settings.DEBUG = debug
+        def add_children(parent, number):
+            children = []
+            for i in range(number):
+                page_data = self.get_new_page_data()
+                page_data['target'] = parent.id
+                page_data['position'] = 'first-child'
+                client.post('/admin/pages/page/add/', page_data)
+                children.append(Content.objects.get_content_slug_by_slug(
+                    page_data['slug']).page)
+            return children
+        root = self.create_new_page(client)
+        children = add_children(root, 2)
+        add_children(children[0], 1)
+        client.cookies['tree_expanded'] = '%d,%d' % (root.id, children[0].id)
+        response, queries = count_queries('/admin/pages/page/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['pages']), 4)
+        # a bigger tree costs the same number of queries
+        children.extend(add_children(root, 3))
+        add_children(children[0], 2)
+        add_children(children[-1], 2)
+        Content.objects.create_content_if_changed(children[-1], 'fr-ch',
+            'title', 'french title')
+        client.cookies['tree_expanded'] = '%d,%d,%d' % (root.id,
+            children[0].id, children[-1].id)
+        response, more_queries = count_queries('/admin/pages/page/')
+        self.assertEqual(more_queries, queries)
+        rows = response.context['pages']
+        self.assertEqual(len(rows), 11)
+        self.assertEqual([page.level for page in rows[:3]], [0, 1, 2])
+        self.assertTrue(rows[0].admin_expanded)
+        self.assertTrue(rows[1].admin_has_children)
+        self.assertFalse(rows[2].admin_has_children)
+        self.assertEqual(response.content.count('<tr id="page-row-'), 11)
+        self.assertTrue('?language=fr-ch" class="changelink" ' in
+            response.content)
+
+        # the children requested by the javascript
+        response = client.get('/admin/pages/page/%d/sub-menu/' % root.id)
+        self.assertEqual(response.content.count('<tr id="page-row-'), 10)
+        response, queries = count_queries('/admin/pages/page/%d/sub-menu/'
+            % children[0].id)
+        self.assertEqual(response.content.count('<tr id="page-row-'), 3)
+        self.assertEqual(count_queries('/admin/pages/page/%d/sub-menu/'
+            % children[-1].id)[1], queries)
+
+    def test_52_page_permission_set(self):
+        """Test the permission sets of the users."""
+        from django.contrib.auth.models import User
+        from pages.models import PagePermission
+        from pages.managers import PagePermissionSet
+        client = Client()
+        client.login(username= 'batiste', password='b')
+        pages = []
+        for slug, target in (('root', None), ('section', 0), ('sub', 1),
+                ('other', 0), ('alone', None), ('child', 4)):
+            page_data = self.get_new_page_data()
+            page_data['slug'] = slug
+            if target is not None:
+                page_data['target'] = pages[target].id
+                page_data['position'] = 'last-child'
+            client.post('/admin/pages/page/add/', page_data)
+            pages.append(Content.objects.get_content_slug_by_slug(slug).page)
+        # the bounds of the pages have changed
+        root, section, sub, other, alone, child = [Page.objects.get(
+            pk=page.id) for page in pages]
+
+        editor = User.objects.create(username='editor', is_staff=True)
+        self.assertEqual(len(list(PagePermission.objects.get_page_id_list(
+            editor))), 0)
+        PagePermission.objects.create(user=editor, page=section, type=2)
+        PagePermission.objects.create(user=editor, page=alone, type=1)
+        permission = PagePermission.objects.get_page_id_list(editor)
+        self.assertTrue(isinstance(permission, PagePermissionSet))
+        for page in (section, sub, alone):
+            self.assertTrue(page in permission)
+            self.assertTrue(page.id in permission)
+        for page in (root, other, child):
+            self.assertFalse(page in permission)
+            self.assertFalse(page.id in permission)
+        self.assertEqual(sorted(permission),
+            sorted([section.id, sub.id, alone.id]))
+        self.assertEqual(list(root.valid_targets(permission)), [alone])
+        self.assertEqual(list(alone.valid_targets(permission)),
+            [section, sub])
+        self.assertEqual(list(section.valid_targets(permission)), [alone])
+
+        # the set is cached
+        self.assertNumQueries(0, PagePermission.objects.get_page_id_list,
+            editor)
+        # a new page in the section
+        page_data = self.get_new_page_data()
+        page_data['target'] = sub.id
+        page_data['position'] = 'first-child'
+        client.post('/admin/pages/page/add/', page_data)
+        new_page = Content.objects.get_content_slug_by_slug(
+            page_data['slug']).page
+        permission = PagePermission.objects.get_page_id_list(editor)
+        self.assertTrue(new_page in permission)
+        self.assertFalse(Page.objects.get(pk=other.id) in permission)
+        # a new permission
+        PagePermission.objects.create(user=editor, page=root, type=2)
+        permission = PagePermission.objects.get_page_id_list(editor)
+        self.assertTrue(other.id in permission)
+        self.assertEqual(len(permission.intervals), 1)
+        PagePermission.objects.filter(user=editor).delete()
+        self.assertEqual(len(list(PagePermission.objects.get_page_id_list(
+            editor))), 0)
+        PagePermission.objects.create(user=editor, type=0)
+        self.assertEqual(PagePermission.objects.get_page_id_list(editor),
+            'All')
@@ -74,7 +74,7 @@ class RegressionTestCase(TestCase):
         page_data['slug'] = 'test-162-slug'
         response = c.post('/admin/pages/page/add/', page_data)
         self.assertRedirects(response, '/admin/pages/page/')
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         temp = loader.get_template('tests/test2.html')
         render = temp.render(RequestContext(request, {}))
@@ -93,7 +93,7 @@ class RegressionTestCase(TestCase):
         Content(page=page, type='title', language='fr-ch',
             body="title-fr-ch").save()
 
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         temp = loader.get_template('tests/test3.html')
         render = temp.render(RequestContext(request, {'page':page}))
@@ -109,7 +109,7 @@ class RegressionTestCase(TestCase):
     def test_30_page_id_in_template(self):
         """Get a page in the templates via the page id."""
         page = self.create_new_page()
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         temp = loader.get_template('tests/test4.html')
         render = temp.render(RequestContext(request, {}))
@@ -117,7 +117,7 @@ class RegressionTestCase(TestCase):
 
     def test_31_bug_178(self):
         """http://code.google.com/p/django-page-cms/issues/detail?id=178"""
-        from pages.utils import get_request_mock
+        from pages.http import get_request_mock
         request = get_request_mock()
         temp = loader.get_template('tests/test5.html')
         render = temp.render(RequestContext(request, {'page':None}))
@@ -1,4 +1,6 @@
 from django.test import TestCase
+from django.conf import settings
+from django.db import connection, reset_queries
 from pages.models import Page, Content, PageAlias
 from django.test.client import Client
 
@@ -27,4 +29,17 @@ class TestCase(TestCase):
         self.assertRedirects(response, '/admin/pages/page/')
         slug_content = Content.objects.get_content_slug_by_slug(
             page_data['slug'])
-        return slug_content.page
\ No newline at end of file
+        return slug_content.page
+
+    def assertNumQueries(self, num, func, *args, **kwargs):
+        """Assert that calling ``func`` executes exactly ``num`` SQL
+        queries and return the result of the call."""
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            result = func(*args, **kwargs)
+            self.assertEqual(len(connection.queries), num)
+        finally:
+            settings.DEBUG = debug
+        return result
\ No newline at end of file
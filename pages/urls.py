@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls.defaults import *
-from pages.views import details
+from pages.views import details, search
 from pages import settings
 
 urlpatterns = patterns('',
@@ -8,6 +8,17 @@ urlpatterns = patterns('',
     url(r'^$', details, name='pages-root'),
 )
 
+# the search shadows a root page with the "search" slug
+if settings.PAGE_SEARCH_INDEX:
+    if settings.PAGE_USE_LANGUAGE_PREFIX:
+        urlpatterns += patterns('',
+            url(r'^(?P<lang>[-\w]+)/search/$', search, name='pages-search'),
+        )
+    else:
+        urlpatterns += patterns('',
+            url(r'^search/$', search, name='pages-search'),
+        )
+
 if settings.PAGE_USE_LANGUAGE_PREFIX:
     urlpatterns += patterns('',
         url(r'^(?P<lang>[-\w]+)/(?P<path>.*)$', details,
@@ -1,85 +1,142 @@
 # -*- coding: utf-8 -*-
 """A collection of functions for Page CMS"""
-import sys, re, logging, pprint, traceback
+import os, sys, re, logging, pprint, traceback
 from django.conf import settings as django_settings
-from django.template import TemplateDoesNotExist
-from django.template import loader, Context, RequestContext
+from django.template import TemplateDoesNotExist, VariableDoesNotExist
+from django.template import loader, Context
 from django.core.cache import cache
+from django.utils import simplejson
 from pages import settings
-from pages.http import get_request_mock, get_language_from_request
+from pages.http import get_language_from_request
 
-def get_context_mock():
-    """return a mockup dictionnary to use in get_placeholders."""
-    context = {'current_page':None}
-    if settings.PAGE_EXTRA_CONTEXT:
-        context.update(settings.PAGE_EXTRA_CONTEXT())
-    return context
+# memoized placeholders: {template name: (placeholders, {file: mtime})}
+_placeholders_cache = {}
 
 def get_placeholders(template_name):
     """Return a list of PlaceholderNode found in the given template.
 
+    The template is not rendered: the compiled node lists are walked,
+    following the ``extends`` and ``include`` tags and the block
+    overrides. The result is memoized until the modification time of one
+    of the template files changes.
+
     :param template_name: the name of the template file
     """
+    cached = _placeholders_cache.get(template_name)
+    if cached:
+        plist, files = cached
+        if dict([(f, _get_mtime(f)) for f in files]) == files:
+            return list(plist)
+    files = {}
     try:
-        temp = loader.get_template(template_name)
+        temp = _load_template(template_name, files)
     except TemplateDoesNotExist:
         return []
-        
-    request = get_request_mock()
-    context = get_context_mock()
-    # I need to render the template in order to extract
-    # placeholder tags
-    temp.render(RequestContext(request, context))
-    plist, blist = [], []
-    _placeholders_recursif(temp.nodelist, plist, blist)
-    return plist
-
-def _placeholders_recursif(nodelist, plist, blist):
+    plist = []
+    _placeholders_recursif(temp.nodelist, plist, {}, files)
+    _placeholders_cache[template_name] = (plist, files)
+    return list(plist)
+
+def _get_mtime(path):
+    """Return the modification time of a file or ``None`` if this is
+    not a file."""
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        return None
+
+def _load_template(template_name, files):
+    """Compile a template and record the modification time of its file
+    into the ``files`` dictionnary."""
+    if loader.template_source_loaders is None:
+        # the loaders are set up by the first lookup
+        loader.find_template_source(template_name)
+    for source_loader in loader.template_source_loaders:
+        try:
+            source, display_name = source_loader(template_name)
+        except TemplateDoesNotExist:
+            continue
+        files[display_name] = _get_mtime(display_name)
+        origin = loader.make_origin(display_name, source_loader,
+            template_name, None)
+        return loader.get_template_from_string(source, origin,
+            template_name)
+    raise TemplateDoesNotExist(template_name)
+
+def _placeholders_recursif(nodelist, plist, blocks, files, supers=()):
     """Recursively search into a template node list for PlaceholderNode
-    node."""
+    node.
+
+    :param blocks: the overriding definitions of the blocks, a
+        dictionnary of lists of ``BlockNode``, the most derived first.
+    :param supers: the definitions of the current block that
+        ``{{ block.super }}`` renders.
+    """
     # I needed to import make this lazy import to make the doc compile
-    from django.template.loader_tags import BlockNode
-    
+    from django.template import VariableNode
+    from django.template.loader_tags import BlockNode, ExtendsNode
+    from django.template.loader_tags import ConstantIncludeNode, IncludeNode
+
     for node in nodelist:
 
-        # extends node
-        if hasattr(node, 'parent_name'):
-            _placeholders_recursif(node.get_parent(Context()).nodelist,
-                                                        plist, blist)
-        # include node
-        elif hasattr(node, 'template'):
-            _placeholders_recursif(node.template.nodelist, plist, blist)
+        if isinstance(node, ExtendsNode):
+            if node.parent_name_expr:
+                # the parent depends on the context
+                continue
+            try:
+                parent = _load_template(node.parent_name, files)
+            except TemplateDoesNotExist:
+                continue
+            parent_blocks = dict(blocks)
+            for block in node.nodelist.get_nodes_by_type(BlockNode):
+                if block not in parent_blocks.get(block.name, []):
+                    parent_blocks[block.name] = (
+                        parent_blocks.get(block.name, []) + [block])
+            _placeholders_recursif(parent.nodelist, plist, parent_blocks,
+                files)
+
+        elif isinstance(node, BlockNode):
+            definitions = blocks.get(node.name, [])
+            if node not in definitions:
+                definitions = definitions + [node]
+            _placeholders_recursif(definitions[0].nodelist, plist, blocks,
+                files, definitions[1:])
+
+        elif isinstance(node, VariableNode):
+            if node.filter_expression.token == 'block.super' and supers:
+                _placeholders_recursif(supers[0].nodelist, plist, blocks,
+                    files, supers[1:])
+
+        elif isinstance(node, (ConstantIncludeNode, IncludeNode)):
+            if isinstance(node, ConstantIncludeNode):
+                if node.template is None:
+                    continue
+                template_name = node.template.name
+            else:
+                try:
+                    template_name = node.template_name.resolve(Context())
+                except VariableDoesNotExist:
+                    # the template name depends on the context
+                    continue
+            try:
+                included = _load_template(template_name, files)
+            except TemplateDoesNotExist:
+                continue
+            _placeholders_recursif(included.nodelist, plist, {}, files)
 
         # It's a placeholder
-        if hasattr(node, 'page') and hasattr(node, 'parsed') and \
+        elif hasattr(node, 'page') and hasattr(node, 'parsed') and \
                 hasattr(node, 'as_varname') and hasattr(node, 'name'):
-            already_in_plist = False
-            for pl in plist:
-                if pl.name == node.name:
-                    already_in_plist = True
-            if not already_in_plist:
-                if len(blist):
-                    node.found_in_block = blist[len(blist)-1]
+            if node.name not in [pl.name for pl in plist]:
                 plist.append(node)
-            node.render(Context())
-
-        for key in ('nodelist', 'nodelist_true', 'nodelist_false'):
-            if isinstance(node, BlockNode):
-                # delete placeholders found in a block of the same name
-                for index, pl in enumerate(plist):
-                    if pl.found_in_block and \
-                            pl.found_in_block.name == node.name \
-                            and pl.found_in_block != node:
-                        del plist[index]
-                blist.append(node)
-            
-            if hasattr(node, key):
-                try:
-                    _placeholders_recursif(getattr(node, key), plist, blist)
-                except:
-                    pass
-            if isinstance(node, BlockNode):
-                blist.pop()
+
+        else:
+            keys = set(getattr(node, 'child_nodelists', ()))
+            keys.update(('nodelist', 'nodelist_true', 'nodelist_false'))
+            for key in keys:
+                if getattr(node, key, None):
+                    _placeholders_recursif(getattr(node, key), plist,
+                        blocks, files, supers)
 
 def has_page_add_permission(request, page=None):
     """Return true if the current user has permission to add a new page.
@@ -129,34 +186,75 @@ def normalize_url(url):
 
 PAGE_CLASS_ID_REGEX = re.compile('page_([0-9]+)')
 
-def filter_link(content, page, language, content_type):
-    """Transform the HTML link href to point to the targeted page
-    absolute URL.
+def resolve_links(content, language):
+    """Transform the HTML links with a ``page_ID`` class to point to the
+    absolute URL of the targeted page. The links to missing pages get the
+    ``pagelink_broken`` class. Return the transformed content, or ``None``
+    if there is no page link, and a dictionnary ``{target id: broken}``.
 
-     >>> filter_link('<a class="page_1">hello</a>', page, 'en-us', body)
-     '<a href="/pages/page-1" class="page_1">hello</a>'
+     >>> resolve_links('<a class="page_1">hello</a>', 'en-us')
+     (u'<a class="page_1" href="/pages/page-1">hello</a>', {1: False})
     """
-    if not settings.PAGE_LINK_FILTER:
-        return content
-    if content_type in ('title', 'slug'):
-        return content
+    if 'page_' not in content:
+        return None, {}
     from BeautifulSoup import BeautifulSoup
     tree = BeautifulSoup(content)
-    tags = tree.findAll('a')
-    if len(tags) == 0:
-        return content
-    for tag in tags:
-        tag_class = tag.get('class', False)
-        if tag_class:
-            # find page link with class 'page_ID'
-            result = PAGE_CLASS_ID_REGEX.search(content)
-            if result and result.group:
-                try:
-                    # TODO: try the cache before fetching the Page object
-                    from pages.models import Page
-                    target_page = Page.objects.get(pk=int(result.group(1)))
-                    tag['href'] = target_page.get_absolute_url(language)
-                except Page.DoesNotExist:
-                    cache.set(Page.PAGE_BROKEN_LINK_KEY % page.id, True)
-                    tag['class'] = 'pagelink_broken'
-    return unicode(tree)
+    tags = []
+    for tag in tree.findAll('a'):
+        # find page link with class 'page_ID'
+        result = PAGE_CLASS_ID_REGEX.search(tag.get('class', ''))
+        if result:
+            tags.append((tag, int(result.group(1))))
+    if not tags:
+        return None, {}
+    from pages.models import Page
+    targets = dict([(page.id, page) for page in
+        Page.objects.filter(id__in=[target_id for tag, target_id in tags])])
+    links = {}
+    for tag, target_id in tags:
+        links[target_id] = target_id not in targets
+        if links[target_id]:
+            tag['class'] = 'pagelink_broken'
+        else:
+            tag['href'] = targets[target_id].get_absolute_url(language)
+    return unicode(tree), links
+
+DELTA_TOKEN_REGEX = re.compile(r'(\s+|<[^>]*>)')
+
+def make_delta(source, target):
+    """Return a delta that rebuilds ``target`` from ``source`` with
+    :func:`apply_delta` or ``None`` if the delta is not shorter than
+    ``target``. The delta is a JSON list of ``[start, end]`` slices of
+    ``source`` and of inserted strings.
+
+     >>> apply_delta(source, make_delta(source, target)) == target
+     True
+    """
+    from difflib import SequenceMatcher
+    source_tokens = [t for t in DELTA_TOKEN_REGEX.split(source) if t]
+    target_tokens = [t for t in DELTA_TOKEN_REGEX.split(target) if t]
+    offsets = [0]
+    for token in source_tokens:
+        offsets.append(offsets[-1] + len(token))
+    operations = []
+    matcher = SequenceMatcher(None, source_tokens, target_tokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([offsets[i1], offsets[i2]])
+        elif j2 > j1:
+            operations.append(u''.join(target_tokens[j1:j2]))
+    delta = simplejson.dumps(operations)
+    if len(delta) >= len(target):
+        return None
+    return delta
+
+def apply_delta(source, delta):
+    """Rebuild a string from ``source`` and a delta returned by
+    :func:`make_delta`."""
+    result = []
+    for operation in simplejson.loads(delta):
+        if isinstance(operation, list):
+            result.append(source[operation[0]:operation[1]])
+        else:
+            result.append(operation)
+    return u''.join(result)
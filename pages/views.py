@@ -1,10 +1,18 @@
 """Default example views"""
 from django.http import Http404, HttpResponsePermanentRedirect
+from django.http import HttpResponseNotModified
 from django.contrib.sites.models import SITE_CACHE
 from pages import settings
 from pages.models import Page, Content, PageAlias
 from pages.http import auto_render, get_language_from_request
+from pages.http import with_identity_map, cache_response
+from pages.http import conditional_page, get_page_validators
+from pages.http import surrogate_keys
+from pages.http import is_not_modified, set_page_headers
+from pages.cache import get_identity_map, get_page_from_path
 from pages.http import get_slug_and_relative_path
+from pages.navigation import get_navigation
+from pages.search import get_results_page
 
 def details(request, path=None, lang=None):
     """This view get the root pages for navigation
@@ -43,11 +51,17 @@ def details(request, path=None, lang=None):
     if lang not in [key for (key, value) in settings.PAGE_LANGUAGES]:
         raise Http404
 
+    navigation = get_navigation(lang)
+    if navigation is not None:
+        pages = context['pages'] = navigation.roots
+
     exclude_drafts = not(request.user.is_authenticated() and request.user.is_staff)
     if path:
-        current_page = Page.objects.from_path(path, lang, exclude_drafts=exclude_drafts)
+        current_page = get_page_from_path(path, lang,
+            exclude_drafts=exclude_drafts)
     elif pages:
         current_page = Page.objects.published().order_by("tree_id")[0]
+        get_identity_map().add_page(current_page)
 
     # if no pages has been found, we will try to find it via an Alias
     if not current_page:
@@ -68,6 +82,13 @@ def details(request, path=None, lang=None):
         return HttpResponsePermanentRedirect(
             current_page.redirect_to.get_absolute_url(lang))
     
+    if settings.PAGE_CONDITIONAL_GET:
+        validators = get_page_validators(request, current_page, lang)
+        get_identity_map().validators = validators
+        if is_not_modified(request, *validators):
+            return set_page_headers(request, HttpResponseNotModified(),
+                *validators)
+
     template_name = current_page.get_template()
     
     if request.is_ajax():
@@ -75,10 +96,46 @@ def details(request, path=None, lang=None):
 
     if current_page:
         context['current_page'] = current_page
+        get_identity_map().current_page = current_page
 
     if settings.PAGE_EXTRA_CONTEXT:
         context.update(settings.PAGE_EXTRA_CONTEXT())
         
     return template_name, context
 
-details = auto_render(details)
+details = with_identity_map(cache_response(surrogate_keys(
+    conditional_page(auto_render(details)))))
+
+def search(request, lang=None):
+    """This view displays the published pages matching the ``q``
+    parameter, ranked by relevance, ``PAGE_SEARCH_RESULTS_PER_PAGE`` at
+    a time: the ``page`` parameter is the number of the page of results.
+    The results are read from the search index, the view is only
+    available when ``PAGE_SEARCH_INDEX`` is enabled.
+
+    The ``pages/search.html`` template gets the navigation ``pages``,
+    the ``query`` and the ``results``, a :class:`Paginator
+    <django.core.paginator.Paginator>` page of page objects."""
+    if not settings.PAGE_SEARCH_INDEX:
+        raise Http404
+    if lang is None:
+        lang = get_language_from_request(request)
+    if lang not in [key for (key, value) in settings.PAGE_LANGUAGES]:
+        raise Http404
+    pages = Page.objects.navigation().order_by("tree_id")
+    navigation = get_navigation(lang)
+    if navigation is not None:
+        pages = navigation.roots
+    query = request.GET.get('q', '').strip()
+    try:
+        number = int(request.GET.get('page', 1))
+    except ValueError:
+        number = 1
+    return 'pages/search.html', {
+        'pages': pages,
+        'lang': lang,
+        'query': query,
+        'results': get_results_page(query, lang, number),
+    }
+
+search = with_identity_map(auto_render(search))